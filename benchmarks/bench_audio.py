@@ -0,0 +1,202 @@
+# benchmarks of the real-time audio and analysis paths: everything that runs once per audio
+# buffer (imslib's generators, the mixer and scheduler) or once per analysis hop (the game's
+# AudioBuffer and PitchDetector). Each case does one buffer of NUM_FRAMES frames.
+#
+# usage: python benchmarks/runner.py [-k pattern]     (or run this file directly)
+
+import sys, os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import atexit
+import shutil
+import tempfile
+import wave
+
+import numpy as np
+
+import pitchtrack
+from runner import benchmark, NUM_FRAMES, NUM_CHANNELS
+from imslib.audio import Audio
+from imslib.clock import AudioScheduler, SimpleTempoMap
+from imslib.mixer import Mixer
+from imslib.note import NoteGenerator, Envelope
+from imslib.wavegen import WaveGenerator, SpeedModulator, convert_channels
+from imslib.wavesrc import WaveFile, WaveBuffer
+
+_wave_path = None
+
+
+def wave_path():
+    """:returns: a 10 second stereo WAV file of noisy chords, written once per run."""
+    global _wave_path
+    if _wave_path is None:
+        tmp_dir = tempfile.mkdtemp(prefix="hh-bench-")
+        atexit.register(shutil.rmtree, tmp_dir, True)
+        _wave_path = os.path.join(tmp_dir, "stereo.wav")
+
+        rng = np.random.default_rng(1)
+        t = np.arange(10 * Audio.sample_rate) / Audio.sample_rate
+        left = 0.3 * np.sin(2 * np.pi * 220 * t) + 0.05 * rng.standard_normal(len(t))
+        right = 0.3 * np.sin(2 * np.pi * 330 * t) + 0.05 * rng.standard_normal(len(t))
+        data = np.empty(2 * len(t), dtype=np.int16)
+        data[0::2] = left * 32767
+        data[1::2] = right * 32767
+        with wave.open(_wave_path, "wb") as f:
+            f.setnchannels(2)
+            f.setsampwidth(2)
+            f.setframerate(Audio.sample_rate)
+            f.writeframes(data.tobytes())
+    return _wave_path
+
+
+def voice(num_samples, pitch=60, seed=1):
+    """:returns: a mono float32 signal like a sung note: a few harmonics and some noise."""
+    rng = np.random.default_rng(seed)
+    t = np.arange(num_samples) / Audio.sample_rate
+    freq = 440 * 2 ** ((pitch - 69) / 12.0)
+    signal = sum(np.sin(2 * np.pi * freq * h * t) / h for h in (1, 2, 3))
+    signal = 0.2 * signal + 0.02 * rng.standard_normal(num_samples)
+    return signal.astype(np.float32)
+
+
+def _game():
+    # the game module imports kivy: only do it for the cases that need it
+    os.environ.setdefault("SDL_VIDEODRIVER", "offscreen")
+    import pitch_detection
+
+    return pitch_detection
+
+
+def _cycle(buffers):
+    """:returns: a function returning the next of *buffers* at each call, round and round."""
+    state = {"i": 0}
+
+    def next_buffer():
+        i = state["i"]
+        state["i"] = (i + 1) % len(buffers)
+        return buffers[i]
+
+    return next_buffer
+
+
+@benchmark("audio_buffer.insert", chunk=[NUM_FRAMES, 4096])
+def audio_buffer_insert(chunk):
+    game = _game()
+    buffer = game.AudioBuffer(game.pitchtrack.HOP_SIZE, lambda data: None)
+    data = voice(chunk)
+    return lambda: buffer.insert(data)
+
+
+@benchmark("pitch_detector.process")
+def pitch_detector_process():
+    game = _game()
+    detector = game.PitchDetector()
+    hop_size = detector.hop_size
+    signal = voice(hop_size * 64)
+    next_hop = _cycle([signal[i : i + hop_size] for i in range(0, len(signal), hop_size)])
+    return lambda: detector.process(next_hop())
+
+
+@benchmark("pitch_detector.insert")
+def pitch_detector_insert():
+    # a whole input buffer: AudioBuffer, then every hop it completes, then get_readings
+    game = _game()
+    detector = game.PitchDetector()
+    signal = voice(NUM_FRAMES * 64)
+    next_buffer = _cycle([signal[i : i + NUM_FRAMES] for i in range(0, len(signal), NUM_FRAMES)])
+    clock = {"time": 0.0}
+
+    def work():
+        clock["time"] += NUM_FRAMES / Audio.sample_rate
+        detector.insert(next_buffer(), clock["time"])
+        detector.get_readings()
+
+    return work
+
+
+@benchmark("pitch_method", method=list(pitchtrack.METHODS))
+def pitch_method(method):
+    # one hop of each pitch detection method by itself (see harmony_hero.py evaluate)
+    pitch_o = pitchtrack.make_pitch_o(Audio.sample_rate, method)
+    hop_size = pitchtrack.HOP_SIZE
+    signal = voice(hop_size * 64)
+    next_hop = _cycle([signal[i : i + hop_size] for i in range(0, len(signal), hop_size)])
+    return lambda: pitch_o(next_hop())
+
+
+@benchmark("wave_generator.generate", source=["file", "buffer"])
+def wave_generator_generate(source):
+    if source == "file":
+        wave_source = WaveFile(wave_path())
+    else:
+        wave_source = WaveBuffer(wave_path(), 0, 10 * Audio.sample_rate)
+    gen = WaveGenerator(wave_source, loop=True)
+    return lambda: gen.generate(NUM_FRAMES, NUM_CHANNELS)
+
+
+@benchmark("speed_modulator.generate", speed=[1.0, 1.3])
+def speed_modulator_generate(speed):
+    wave_source = WaveBuffer(wave_path(), 0, 10 * Audio.sample_rate)
+    gen = SpeedModulator(WaveGenerator(wave_source, loop=True), speed)
+    return lambda: gen.generate(NUM_FRAMES, NUM_CHANNELS)
+
+
+@benchmark("note_generator.generate", timbre=["sine", "square"])
+def note_generator_generate(timbre):
+    gen = NoteGenerator(60, 0.5, timbre)
+    return lambda: gen.generate(NUM_FRAMES, NUM_CHANNELS)
+
+
+@benchmark("envelope.generate")
+def envelope_generate():
+    # a decay long enough that the envelope never ends
+    gen = Envelope(NoteGenerator(60, 0.5), 0.01, 1.0, 3600.0, 2.0)
+    return lambda: gen.generate(NUM_FRAMES, NUM_CHANNELS)
+
+
+@benchmark("mixer.generate", voices=[1, 8, 32])
+def mixer_generate(voices):
+    mixer = Mixer()
+    for i in range(voices):
+        mixer.add(Envelope(NoteGenerator(48 + i % 24, 0.5 / voices), 0.01, 1.0, 3600.0, 2.0))
+    return lambda: mixer.generate(NUM_FRAMES, NUM_CHANNELS)
+
+
+@benchmark("convert_channels", direction=["mono-stereo", "stereo-mono"])
+def convert_channels_bench(direction):
+    if direction == "mono-stereo":
+        data = voice(NUM_FRAMES).astype(float)
+        return lambda: convert_channels(data, 1, 2)
+    data = voice(NUM_FRAMES * 2).astype(float)
+    return lambda: convert_channels(data, 2, 1)
+
+
+@benchmark("audio_scheduler.generate", events=[0, 16, 128])
+def audio_scheduler_generate(events):
+    # *events* commands fire in every buffer, posted as the buffer before plays, the way a
+    # sequencer schedules just ahead of the audio. The commands do nothing and the audio is
+    # one note, so this times the scheduler: sorting the commands and generating the buffer
+    # in pieces between them.
+    tempo_map = SimpleTempoMap(120)
+    sched = AudioScheduler(tempo_map)
+    sched.set_generator(NoteGenerator(60, 0.5))
+
+    def command(*args):
+        pass
+
+    def work():
+        start = sched.cur_frame + NUM_FRAMES
+        for i in range(events):
+            frame = start + (i * NUM_FRAMES) // max(events, 1)
+            tick = tempo_map.time_to_tick(frame / Audio.sample_rate)
+            sched.post_at_tick(command, tick)
+        sched.generate(NUM_FRAMES, NUM_CHANNELS)
+
+    return work
+
+
+if __name__ == "__main__":
+    import runner
+
+    sys.exit(runner.main(sys.argv[1:]))
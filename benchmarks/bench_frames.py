@@ -0,0 +1,228 @@
+# headless benchmark of the game's frame loop. For each song, builds a GameDisplay under an
+# offscreen window and drives it with synthetic singing at a fixed virtual frame rate: no
+# microphone, audio device or real clock, so every run does exactly the same work. Reports the
+# time per frame (GameDisplay.on_update, the particle update, and drawing the window), the
+# number of canvas instructions per frame, and the memory allocated per frame (a second pass,
+# under tracemalloc, so that it doesn't skew the timings).
+#
+# Traces: "follow" sings the chart with vibrato and noise, "octave" sings it an octave low,
+# "wander" drifts around the song's range, "silent" never sings.
+#
+# usage: python benchmarks/bench_frames.py [song ...] [--trace follow] [--fps 60]
+#                                          [--seconds 60] [--no-draw] [--json out.json]
+
+import sys, os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import argparse
+import json
+import time
+import tracemalloc
+
+import numpy as np
+
+TRACES = ("follow", "octave", "wander", "silent")
+
+
+def _game():
+    # the game module imports kivy: only when this benchmark runs, not when the runner
+    # collects the bench_*.py modules
+    os.environ.setdefault("SDL_VIDEODRIVER", "offscreen")
+    import pitch_detection
+
+    return pitch_detection
+
+
+def chart_pitch(notes, times):
+    """:returns: the pitch of the note sounding at each of *times*, NaN between notes."""
+    idx = np.searchsorted(notes["start"], times, "right") - 1
+    pitch = np.full(len(times), np.nan)
+    valid = idx >= 0
+    idx = idx[valid]
+    inside = notes["start"][idx] + notes["duration"][idx] > times[valid]
+    pitch[np.flatnonzero(valid)[inside]] = notes["pitch"][idx[inside]]
+    return pitch
+
+
+def synthetic_readings(song, trace, seconds, hop_time, seed=1):
+    """
+    :returns: pitch readings like PitchDetector.get_readings returns them (columns time,
+        pitch, confidence, volume), one per hop for the first *seconds* of *song*.
+    """
+    rng = np.random.default_rng(seed)
+    times = np.arange(1, int(seconds / hop_time) + 1) * hop_time
+
+    if trace in ("follow", "octave"):
+        pitch = chart_pitch(song.notes, times)
+        pitch += 0.3 * np.sin(2 * np.pi * 5.5 * times) + 0.1 * rng.standard_normal(len(times))
+        if trace == "octave":
+            pitch -= 12
+    elif trace == "wander":
+        low, high = song.pitch_range
+        steps = 0.2 * rng.standard_normal(len(times))
+        pitch = np.clip(0.5 * (low + high) + np.cumsum(steps), low, high)
+    elif trace == "silent":
+        pitch = np.full(len(times), np.nan)
+    else:
+        raise ValueError("unknown trace {!r}".format(trace))
+
+    singing = ~np.isnan(pitch)
+    confidence = np.where(singing, rng.uniform(0.8, 1.0, len(times)), rng.uniform(0, 0.3, len(times)))
+    volume = np.where(singing, rng.uniform(20, 40, len(times)), rng.uniform(0, 2, len(times)))
+    return np.column_stack([times, np.where(singing, pitch, 0.0), confidence, volume])
+
+
+def play(game, song, readings, fps, seconds, draw=True, track_allocations=False):
+    """
+    Plays the first *seconds* of *song* at *fps*, feeding each frame the readings made since
+    the previous one, as GameScreen does.
+
+    :returns: a dictionary of per-frame arrays: ``"update"``, ``"particles"`` and ``"draw"``
+        times (ms), ``"instructions"``, and with *track_allocations*, ``"allocated"`` (KB
+        allocated at the frame's peak) and ``"retained"`` (KB still allocated after it).
+    """
+    from kivy.core.window import Window
+    from kivy.uix.widget import Widget
+    from imslib.gfxutil import count_canvas_items
+
+    game_display = game.GameDisplay(song)
+    ps = game_display.ps
+    # particles are advanced by hand, once per virtual frame, rather than by the kivy clock
+    ps.pause()
+    root = Widget()
+    root.canvas.add(game_display)
+    root.add_widget(ps)
+    Window.add_widget(root)
+
+    num_frames = int(seconds * fps)
+    dt = 1.0 / fps
+    frame_times = np.arange(1, num_frames + 1) * dt
+    ends = np.searchsorted(readings[:, 0], frame_times, "right")
+
+    stats = {
+        name: np.zeros(num_frames)
+        for name in ("update", "particles", "draw", "instructions", "allocated", "retained")
+    }
+    if track_allocations:
+        tracemalloc.start()
+    pitch = conf = volume = 0.0
+    start = 0
+    try:
+        for i, now_time in enumerate(frame_times):
+            frame_readings = readings[start : ends[i]]
+            start = ends[i]
+            if len(frame_readings):
+                _, pitch, conf, volume = frame_readings[-1]
+
+            if track_allocations:
+                tracemalloc.reset_peak()
+                before = tracemalloc.get_traced_memory()[0]
+
+            t0 = time.perf_counter()
+            game_display.on_update(pitch, conf, now_time, False, volume, frame_readings)
+            t1 = time.perf_counter()
+            ps._update(dt)
+            t2 = time.perf_counter()
+            if draw:
+                Window.dispatch("on_draw")
+                Window.dispatch("on_flip")
+            t3 = time.perf_counter()
+
+            if track_allocations:
+                current, peak = tracemalloc.get_traced_memory()
+                stats["allocated"][i] = (peak - before) / 1024
+                stats["retained"][i] = (current - before) / 1024
+
+            stats["update"][i] = 1000 * (t1 - t0)
+            stats["particles"][i] = 1000 * (t2 - t1)
+            stats["draw"][i] = 1000 * (t3 - t2)
+            stats["instructions"][i] = count_canvas_items(game_display) + sum(
+                count_canvas_items(c) for c in (ps.canvas.before, ps.canvas, ps.canvas.after)
+            )
+    finally:
+        if track_allocations:
+            tracemalloc.stop()
+        Window.remove_widget(root)
+
+    stats["score"] = game_display.score
+    return stats
+
+
+def bench_song(game, song, trace="follow", fps=60, seconds=60, draw=True):
+    """:returns: the JSON-serializable results of one song."""
+    from latency import percentiles
+
+    seconds = min(seconds, song.duration)
+    readings = synthetic_readings(song, trace, seconds, game.pitchtrack.HOP_SIZE / game.Audio.sample_rate)
+
+    timed = play(game, song, readings, fps, seconds, draw)
+    traced = play(game, song, readings, fps, seconds, draw=False, track_allocations=True)
+    frame = timed["update"] + timed["particles"] + timed["draw"]
+    return {
+        "frames": len(frame),
+        "seconds": seconds,
+        "score": timed["score"],
+        "frame_ms": percentiles(frame),
+        "update_ms": percentiles(timed["update"]),
+        "particles_ms": percentiles(timed["particles"]),
+        "draw_ms": percentiles(timed["draw"]) if draw else None,
+        "instructions": {
+            "mean": float(timed["instructions"].mean()),
+            "max": int(timed["instructions"].max()),
+        },
+        "allocated_kb": percentiles(traced["allocated"]),
+        # memory the song kept allocated: chart lines shown, particle buffers grown, ...
+        "retained_kb": float(traced["retained"].sum()),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Times GameDisplay's frame loop with synthetic singing.")
+    parser.add_argument("songs", nargs="*", help="song ids (default: the whole library)")
+    parser.add_argument("--library", metavar="DIR", help="library directory (default: library/)")
+    parser.add_argument("--trace", choices=TRACES, default="follow")
+    parser.add_argument("--fps", type=float, default=60.0, help="virtual frame rate")
+    parser.add_argument("--seconds", type=float, default=60.0, help="seconds of each song to play")
+    parser.add_argument("--no-draw", dest="draw", action="store_false", help="don't draw the window")
+    parser.add_argument("--json", metavar="FILE", help="write the results to FILE")
+    args = parser.parse_args(argv)
+
+    game = _game()
+    from songlib import SongIndex
+
+    index = SongIndex(args.library)
+    index.refresh()
+    song_ids = args.songs or [entry["id"] for entry in index.entries]
+
+    print(f"trace {args.trace}, {args.fps:g} fps; times in ms per frame, memory in KB per frame")
+    print(
+        f'{"song":<16} {"frames":>7} {"p50":>7} {"p90":>7} {"p99":>7} {"max":>7} '
+        f'{"update":>7} {"particles":>9} {"draw":>7} {"instr":>6} {"alloc":>7} {"retained":>9}'
+    )
+    results = {}
+    for song_id in song_ids:
+        song = index.load_song(song_id)
+        r = bench_song(game, song, args.trace, args.fps, args.seconds, args.draw)
+        results[song_id] = r
+        frame = r["frame_ms"]
+        draw = r["draw_ms"]["p50"] if args.draw else float("nan")
+        print(
+            f'{song_id:<16} {r["frames"]:>7} {frame["p50"]:>7.3f} {frame["p90"]:>7.3f} '
+            f'{frame["p99"]:>7.3f} {frame["max"]:>7.3f} {r["update_ms"]["p50"]:>7.3f} '
+            f'{r["particles_ms"]["p50"]:>9.3f} {draw:>7.3f} {r["instructions"]["max"]:>6} '
+            f'{r["allocated_kb"]["p50"]:>7.1f} {r["retained_kb"]:>9.1f}'
+        )
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(
+                {"trace": args.trace, "fps": args.fps, "draw": args.draw, "songs": results},
+                f,
+                indent=2,
+            )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
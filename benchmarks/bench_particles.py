@@ -0,0 +1,68 @@
+# benchmark of the numpy particle simulation (imslib/kivyparticle/simulation.py)
+# measures the cost of one update step for a single emitter holding thousands of particles.
+#
+# usage: python benchmarks/bench_particles.py [num_particles ...]
+
+import sys, os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from types import SimpleNamespace
+import time
+
+import numpy as np
+
+from imslib.kivyparticle.simulation import (
+    ParticleSimulation,
+    read_pex,
+    EMITTER_TYPE_GRAVITY,
+    EMITTER_TYPE_RADIAL,
+)
+
+config_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "particle", "particle.pex")
+frame_time = 1.0 / 60.0
+
+
+def make_emitter(num_particles, emitter_type):
+    params = read_pex(config_path)
+    params["max_num_particles"] = num_particles
+    params["emitter_type"] = emitter_type
+    # long-lived particles, so the emitter stays full for the whole run
+    params["life_span"] = 1000.0
+    params["life_span_variance"] = 0.0
+    return SimpleNamespace(**params)
+
+
+def bench(num_particles, emitter_type, num_steps=200):
+    """
+    :returns: (seconds per step, seconds to emit all particles in one batch)
+    """
+    emitter = make_emitter(num_particles, emitter_type)
+    sim = ParticleSimulation(num_particles, seed=1)
+
+    t0 = time.perf_counter()
+    sim.emit(emitter, np.linspace(frame_time, 0, num_particles))
+    emit_time = time.perf_counter() - t0
+    assert sim.count == num_particles
+
+    t0 = time.perf_counter()
+    for _ in range(num_steps):
+        sim.advance(emitter, frame_time)
+    step_time = (time.perf_counter() - t0) / num_steps
+    return step_time, emit_time
+
+
+def main(sizes):
+    print(f'{"particles":>10} {"emitter":>8} {"step (ms)":>10} {"us/particle":>12} {"emit (ms)":>10}')
+    for num_particles in sizes:
+        for name, emitter_type in (("gravity", EMITTER_TYPE_GRAVITY), ("radial", EMITTER_TYPE_RADIAL)):
+            step_time, emit_time = bench(num_particles, emitter_type)
+            print(
+                f"{num_particles:>10} {name:>8} {step_time * 1000:>10.3f} "
+                f"{step_time * 1e6 / num_particles:>12.3f} {emit_time * 1000:>10.3f}"
+            )
+
+
+if __name__ == "__main__":
+    sizes = [int(a) for a in sys.argv[1:]] or [100, 1000, 5000, 20000]
+    main(sizes)
@@ -0,0 +1,78 @@
+# checks that silence doesn't score. Builds a small chart (notes at midi 60 over [0, 1) and
+# [2, 7) seconds), and plays it through GameDisplay, headless, with pitch readings like the
+# detector makes them:
+#
+#   silent   nobody ever sings
+#   stops    the first note is sung, then nothing: quiet, unconfident readings that still
+#            report the note's pitch, as pitch trackers do on noise
+#
+# Both must earn no points while silent: "silent" must score 0, and "stops" no more than the
+# first note is worth. Exits with status 1 otherwise.
+#
+# usage: python benchmarks/check_scoring.py
+
+import sys, os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import shutil
+import tempfile
+
+import numpy as np
+
+from bench_frames import _game, play
+
+# (start, duration) of the chart's notes, all at NOTE_PITCH
+NOTES = ((0.0, 1.0), (2.0, 5.0))
+NOTE_PITCH = 60.0
+SUNG_SECONDS = 1.0
+FPS = 60.0
+
+
+def make_song(out_dir):
+    import songpkg
+
+    starts, durations = zip(*NOTES)
+    notes = songpkg.make_notes(starts, durations, [NOTE_PITCH] * len(NOTES))
+    _stems, artwork = songpkg.legacy_sources("valerie")
+    return songpkg.compile_package(
+        out_dir, "check_scoring", "Check", "Scoring", notes, {}, artwork
+    )
+
+
+def readings(trace, seconds, hop_time, seed=1):
+    """
+    :returns: readings (columns time, pitch, confidence, volume) of *trace*, one per hop.
+    """
+    rng = np.random.default_rng(seed)
+    times = np.arange(1, int(seconds / hop_time) + 1) * hop_time
+    sung = times <= SUNG_SECONDS if trace == "stops" else np.zeros(len(times), dtype=bool)
+    pitch = np.full(len(times), NOTE_PITCH)
+    confidence = np.where(sung, rng.uniform(0.9, 1.0, len(times)), rng.uniform(0, 0.3, len(times)))
+    volume = np.where(sung, rng.uniform(20, 40, len(times)), rng.uniform(0, 2, len(times)))
+    return np.column_stack([times, pitch, confidence, volume])
+
+
+def main():
+    game = _game()
+    hop_time = game.pitchtrack.HOP_SIZE / game.Audio.sample_rate
+    seconds = max(start + duration for start, duration in NOTES) + 0.5
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        song = make_song(os.path.join(tmp_dir, "check_scoring"))
+        first_note = NOTES[0][1] * game.songpkg.POINTS_PER_SECOND
+        limits = {"silent": 0.0, "stops": first_note}
+        failed = False
+        for trace, limit in limits.items():
+            score = play(game, song, readings(trace, seconds, hop_time), FPS, seconds, draw=False)["score"]
+            ok = score <= limit
+            failed |= not ok
+            print(f'{trace:<8} score {score:>9.1f}  at most {limit:>9.1f}  {"ok" if ok else "FAIL"}')
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
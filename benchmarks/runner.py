@@ -0,0 +1,238 @@
+# benchmark runner for the real-time paths. The bench_*.py modules of this directory register
+# cases with @benchmark: a function that sets the case up and returns a callable doing one unit
+# of work (one audio buffer, one analysis hop). The runner times many calls of each, prints a
+# table of the cost per call and, given a baseline, how it compares.
+#
+# Results are JSON: `--json out.json` writes them, `--save-baseline` makes them the baseline
+# (benchmarks/baseline.json) that later runs are compared against. A case more than
+# `--threshold` slower than its baseline is flagged, and makes the runner exit with status 1.
+#
+# usage: python benchmarks/runner.py [-k pattern ...] [--json out.json] [--baseline file]
+#                                    [--save-baseline] [--threshold 0.1] [--min-time 0.5]
+
+import sys, os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import argparse
+import fnmatch
+import glob
+import importlib.util
+import itertools
+import json
+import platform
+import time
+
+import numpy as np
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+default_baseline = os.path.join(bench_dir, "baseline.json")
+
+# every case works on buffers of this size, whatever Audio.buffer_size is on this platform, so
+# numbers from different machines stay comparable
+NUM_FRAMES = 512
+NUM_CHANNELS = 2
+
+FORMAT_VERSION = 1
+
+# name -> setup function, for each registered case
+cases = {}
+
+
+def benchmark(name, **params):
+    """
+    Registers a benchmark. The decorated function is called with one value of each of
+    *params* (every combination of them is a case, named ``name[key=value,...]``) and returns
+    the callable to time.
+    """
+
+    def register(setup):
+        keys = sorted(params)
+        for values in itertools.product(*(params[k] for k in keys)):
+            kwargs = dict(zip(keys, values))
+            label = ",".join(f"{k}={v}" for k, v in kwargs.items())
+            case = f"{name}[{label}]" if label else name
+            cases[case] = (setup, kwargs)
+        return setup
+
+    return register
+
+
+def load_benchmarks():
+    """Imports every bench_*.py module next to this one, which registers its cases."""
+    # so that the modules' `from runner import benchmark` finds this module, and not a second
+    # copy of it, when run as a script
+    sys.modules.setdefault("runner", sys.modules[__name__])
+    for path in sorted(glob.glob(os.path.join(bench_dir, "bench_*.py"))):
+        name = os.path.splitext(os.path.basename(path))[0]
+        if name in sys.modules:
+            continue
+        spec = importlib.util.spec_from_file_location(name, path)
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[name] = module
+        spec.loader.exec_module(module)
+
+
+def measure(work, min_time=0.5, repeats=7):
+    """
+    Times *work*: calls it in *repeats* batches, each large enough to take about
+    ``min_time / repeats`` seconds (after one warm-up call).
+
+    :returns: a dictionary of the cost per call (in microseconds) over the batches, and the
+        number of calls timed.
+    """
+    work()
+    # calibrate the batch size on the warm-up rounds
+    number = 1
+    while True:
+        t0 = time.perf_counter()
+        for _ in range(number):
+            work()
+        elapsed = time.perf_counter() - t0
+        if elapsed >= min_time / repeats / 4 or number >= 1 << 20:
+            break
+        number *= 2
+    number = max(1, int(number * (min_time / repeats) / max(elapsed, 1e-9)))
+
+    per_call = []
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        for _ in range(number):
+            work()
+        per_call.append((time.perf_counter() - t0) / number * 1e6)
+
+    per_call = np.array(per_call)
+    return {
+        "median": float(np.median(per_call)),
+        "min": float(per_call.min()),
+        "max": float(per_call.max()),
+        "stdev": float(per_call.std()),
+        "calls": number * repeats,
+    }
+
+
+def run(patterns=None, min_time=0.5, repeats=7, out=sys.stdout):
+    """
+    Runs the registered cases whose names match any of the glob *patterns* (a plain word
+    matches any name containing it), printing each as it completes.
+
+    :returns: the results, as written by ``--json``.
+    """
+    results = {}
+    for case, (setup, kwargs) in cases.items():
+        if patterns and not any(_matches(case, p) for p in patterns):
+            continue
+        work = setup(**kwargs)
+        stats = measure(work, min_time, repeats)
+        results[case] = stats
+        print(
+            f"{case:<48} {stats['median']:>10.2f} {stats['min']:>10.2f} "
+            f"{stats['stdev']:>8.2f}",
+            file=out,
+        )
+        out.flush()
+
+    return {
+        "version": FORMAT_VERSION,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "machine": {
+            "platform": platform.platform(),
+            "processor": platform.processor() or platform.machine(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+        },
+        "num_frames": NUM_FRAMES,
+        "num_channels": NUM_CHANNELS,
+        "results": results,
+    }
+
+
+def _matches(case, pattern):
+    if any(c in pattern for c in "*?["):
+        return fnmatch.fnmatchcase(case, pattern)
+    return pattern in case
+
+
+def compare(results, baseline, threshold=0.1):
+    """
+    :returns: a list of ``(case, baseline median, median, ratio, status)`` for the cases of
+        *results*, where status is ``"slower"`` or ``"faster"`` when the medians differ by
+        more than *threshold* (a fraction), ``"new"`` when the case isn't in *baseline*, and
+        ``""`` otherwise.
+    """
+    rows = []
+    old = baseline.get("results", {})
+    for case, stats in results["results"].items():
+        if case not in old:
+            rows.append((case, None, stats["median"], None, "new"))
+            continue
+        ratio = stats["median"] / old[case]["median"]
+        if ratio > 1 + threshold:
+            status = "slower"
+        elif ratio < 1 / (1 + threshold):
+            status = "faster"
+        else:
+            status = ""
+        rows.append((case, old[case]["median"], stats["median"], ratio, status))
+    return rows
+
+
+def print_comparison(rows, baseline, out=sys.stdout):
+    print(f"\ncompared to the baseline of {baseline.get('created', '?')}:", file=out)
+    for case, old, new, ratio, status in rows:
+        if ratio is None:
+            print(f"{case:<48} {'':>10} {new:>10.2f} {'':>7} {status}", file=out)
+        else:
+            print(f"{case:<48} {old:>10.2f} {new:>10.2f} {ratio:>6.2f}x {status}", file=out)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Times the real-time audio and analysis paths.")
+    parser.add_argument("-k", dest="patterns", action="append", metavar="PATTERN",
+                        help="only run the cases matching PATTERN (repeatable)")
+    parser.add_argument("--list", action="store_true", help="list the cases and exit")
+    parser.add_argument("--json", metavar="FILE", help="write the results to FILE")
+    parser.add_argument("--baseline", default=default_baseline, metavar="FILE",
+                        help="results to compare against (default: benchmarks/baseline.json)")
+    parser.add_argument("--save-baseline", action="store_true",
+                        help="write the results to the baseline file instead of comparing")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="flag cases whose median changed by more than this fraction")
+    parser.add_argument("--min-time", type=float, default=0.5,
+                        help="seconds to spend timing each case")
+    parser.add_argument("--repeats", type=int, default=7)
+    args = parser.parse_args(argv)
+
+    load_benchmarks()
+    if args.list:
+        for case in cases:
+            print(case)
+        return 0
+
+    print(f"{NUM_FRAMES} frames, {NUM_CHANNELS} channels per buffer; times in us per call")
+    print(f'{"case":<48} {"median":>10} {"min":>10} {"stdev":>8}')
+    results = run(args.patterns, args.min_time, args.repeats)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"\nsaved the baseline to {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print(f"\nno baseline at {args.baseline}: run with --save-baseline to create one")
+        return 0
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    rows = compare(results, baseline, args.threshold)
+    print_comparison(rows, baseline)
+    return 1 if any(row[-1] == "slower" for row in rows) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,89 @@
+# soak test of the particle emitter lifecycle, in virtual time.
+# Simulates a long session of note hits (sustain while on pitch, a burst at the start of
+# each note, stop on a miss) against the same particle config the game uses, and checks
+# that canvas instructions and memory stay bounded for the whole session.
+#
+# usage: python benchmarks/soak_particles.py [minutes]
+
+import sys, os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import random
+import time
+import tracemalloc
+
+from imslib.gfxutil import count_canvas_items
+from imslib.kivyparticle import ParticleSystem
+
+config_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "particle", "particle.pex")
+
+
+def count_instructions(ps):
+    return sum(count_canvas_items(c) for c in (ps.canvas.before, ps.canvas, ps.canvas.after))
+
+
+def soak(minutes, seed=0):
+    rnd = random.Random(seed)
+    ps = ParticleSystem(config_path)
+    # drive updates by hand rather than from the kivy clock
+    ps.pause()
+
+    dt = ps.update_interval
+    num_updates = int(minutes * 60 / dt)
+    updates_per_minute = int(60 / dt)
+
+    on_pitch = False
+    state_left = 0.0
+    samples = []
+
+    tracemalloc.start()
+    t_start = time.perf_counter()
+    for i in range(num_updates):
+        # alternate between singing a note (on pitch) and rests / misses
+        state_left -= dt
+        if state_left <= 0:
+            on_pitch = not on_pitch
+            state_left = rnd.uniform(0.1, 2.0)
+            if on_pitch:
+                ps.emitter_x = rnd.uniform(0, 800)
+                ps.emitter_y = rnd.uniform(0, 600)
+                ps.burst(rnd.randint(5, 50))
+
+        if on_pitch:
+            ps.sustain()
+        else:
+            ps.stop()
+
+        ps._update(dt)
+
+        if i % updates_per_minute == 0:
+            current, _peak = tracemalloc.get_traced_memory()
+            samples.append((i * dt / 60, ps.num_particles, ps.capacity, count_instructions(ps), current))
+
+    elapsed = time.perf_counter() - t_start
+    tracemalloc.stop()
+    return samples, elapsed
+
+
+def main(minutes):
+    samples, elapsed = soak(minutes)
+
+    print(f'{"minute":>7} {"particles":>10} {"capacity":>9} {"instructions":>13} {"memory (KB)":>12}')
+    for minute, particles, capacity, instructions, memory in samples:
+        print(f"{minute:>7.0f} {particles:>10} {capacity:>9} {instructions:>13} {memory / 1024:>12.1f}")
+    print(f"simulated {minutes} minutes in {elapsed:.1f}s")
+
+    # after the first minute everything is allocated. From then on, nothing may grow.
+    settled = samples[1:] or samples
+    instructions = {s[3] for s in settled}
+    capacities = {s[2] for s in settled}
+    memory = [s[4] for s in settled]
+    assert len(instructions) == 1, f"canvas instruction count changed: {sorted(instructions)}"
+    assert len(capacities) == 1, f"particle storage was reallocated: {sorted(capacities)}"
+    assert max(memory) - min(memory) < 256 * 1024, "memory kept growing during the session"
+    print("ok: instructions, storage and memory stayed bounded")
+
+
+if __name__ == "__main__":
+    main(float(sys.argv[1]) if len(sys.argv) > 1 else 30)
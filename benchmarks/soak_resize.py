@@ -0,0 +1,60 @@
+# soak test of GameDisplay's resize handling. Builds a GameDisplay under an offscreen window
+# and resizes it many times, to random window sizes, checking that resizing moves the existing
+# canvas instructions in place: the instruction count must stay the same after every resize.
+#
+# usage: python benchmarks/soak_resize.py [song] [--resizes 1000]
+
+import sys, os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import argparse
+import random
+
+
+def soak(song_id=None, num_resizes=1000, library_dir=None, seed=0):
+    """
+    :returns: ``(counts, sizes)``: the instruction count of the display before any resize and
+        after each one, and the window sizes it was resized to.
+    """
+    # the game module opens a window: offscreen, for this test
+    os.environ.setdefault("SDL_VIDEODRIVER", "offscreen")
+    import pitch_detection
+    from imslib.gfxutil import count_canvas_items
+    from songlib import SongIndex
+
+    index = SongIndex(library_dir)
+    index.refresh()
+    song = index.load_song(song_id or index.entries[0]["id"])
+
+    rnd = random.Random(seed)
+    game_display = pitch_detection.GameDisplay(song)
+    counts = [count_canvas_items(game_display)]
+    sizes = []
+    for _ in range(num_resizes):
+        win_size = (rnd.randint(400, 2560), rnd.randint(300, 1440))
+        game_display.apply_resize(win_size)
+        counts.append(count_canvas_items(game_display))
+        sizes.append(win_size)
+    return counts, sizes
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Checks that resizing doesn't add canvas instructions.")
+    parser.add_argument("song", nargs="?", help="song id (default: the first in the library)")
+    parser.add_argument("--library", metavar="DIR", help="library directory (default: library/)")
+    parser.add_argument("--resizes", type=int, default=1000, help="number of resizes")
+    args = parser.parse_args(argv)
+
+    counts, sizes = soak(args.song, args.resizes, args.library)
+    print(f"{len(sizes)} resizes, instructions before: {counts[0]}, after: {counts[-1]}")
+    for i, count in enumerate(counts[1:]):
+        if count != counts[0]:
+            print(f"fail: {count} instructions after resize {i + 1} (to {sizes[i]}), {counts[0]} before")
+            return 1
+    print("ok: the instruction count didn't change")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
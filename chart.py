@@ -0,0 +1,213 @@
+# offline chart generation. A vocal stem is streamed through the game's aubio YIN pitch
+# tracker (see pitchtrack.py) in large blocks, and regions of stable pitch are turned into
+# notes. When a song only has a full mix and an instrumental, the vocal stem is their
+# difference. Charts are written in the game's txt format (start, Hz, duration, velocity),
+# so they can be compiled into song packages like the hand-made ones.
+
+import os
+import wave
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+import pitchtrack
+
+# frames read and analysed per block. A multiple of the hop size, about 6 sec at 44.1kHz
+CHUNK_FRAMES = pitchtrack.HOP_SIZE * 256
+
+# a hop is voiced when YIN is at least this confident and the stem is at least this loud (rms)
+MIN_CONFIDENCE = 0.8
+MIN_RMS = 0.01
+
+# hops of pitch smoothing (median filter) before segmentation
+SMOOTHING = 5
+
+# notes shorter than this are dropped (sec)
+MIN_DURATION = 0.1
+
+# velocity written to generated charts, the same as the hand-made ones (100 / 127)
+VELOCITY = 100 / 127
+
+
+def _read_mono(wav, num_frames):
+    raw = wav.readframes(num_frames)
+    samples = np.frombuffer(raw, dtype=np.int16).astype(np.float32)
+    samples *= 1 / 32768.0
+    channels = wav.getnchannels()
+    if channels > 1:
+        samples = samples.reshape(-1, channels).mean(axis=1)
+    return samples
+
+
+def read_stem(path, minus_path=None, chunk_frames=CHUNK_FRAMES):
+    """
+    Streams a 16 bit wave file as mono float32 blocks, without loading the whole file.
+
+    :param path: the wave file.
+    :param minus_path: optional wave file (ie, the instrumental) subtracted from *path*,
+        sample by sample, to isolate the vocals.
+    :param chunk_frames: frames per block. The last block may be shorter.
+
+    :returns: a generator of blocks, and the sample rate, as ``(blocks, sample_rate)``.
+    """
+    wav = wave.open(path, "rb")
+    if wav.getsampwidth() != 2:
+        raise ValueError("{}: only 16 bit wave files are supported".format(path))
+    minus = None
+    if minus_path is not None:
+        minus = wave.open(minus_path, "rb")
+        if minus.getframerate() != wav.getframerate() or minus.getsampwidth() != 2:
+            raise ValueError("{} and {} have different formats".format(path, minus_path))
+
+    def blocks():
+        try:
+            while True:
+                block = _read_mono(wav, chunk_frames)
+                if len(block) == 0:
+                    break
+                if minus is not None:
+                    other = _read_mono(minus, len(block))
+                    block[: len(other)] -= other
+                yield block
+        finally:
+            wav.close()
+            if minus is not None:
+                minus.close()
+
+    return blocks(), wav.getframerate()
+
+
+def track_pitch(blocks, sample_rate, hop_size=pitchtrack.HOP_SIZE):
+    """
+    Runs the game's pitch tracker configuration over a stream of audio blocks, with the
+    faster offline YIN implementation (see ``pitchtrack.OFFLINE_METHOD``).
+
+    :returns: arrays ``(times, pitch, confidence, rms)`` with one entry per hop. Times are
+        the centers of the analysis windows, in seconds. Pitch is in midi.
+    """
+    pitch_o = pitchtrack.make_pitch_o(
+        sample_rate, pitchtrack.OFFLINE_METHOD, hop_size=hop_size
+    )
+    pitches, confidences, levels = [], [], []
+    leftover = np.zeros(0, dtype=np.float32)
+
+    for block in blocks:
+        block = np.concatenate((leftover, block)).astype(np.float32)
+        num_hops = len(block) // hop_size
+        hops = block[: num_hops * hop_size].reshape(num_hops, hop_size)
+        leftover = block[num_hops * hop_size :]
+
+        pitch = np.empty(num_hops, dtype=np.float32)
+        conf = np.empty(num_hops, dtype=np.float32)
+        for i in range(num_hops):
+            pitch[i] = pitch_o(hops[i])[0]
+            conf[i] = pitch_o.get_confidence()
+        pitches.append(pitch)
+        confidences.append(conf)
+        levels.append(np.sqrt(np.mean(np.square(hops), axis=1)))
+
+    if not pitches:
+        empty = np.zeros(0)
+        return empty, empty, empty, empty
+
+    pitch = np.concatenate(pitches)
+    # a reading covers the last buf_size samples that were fed in
+    times = ((np.arange(len(pitch)) + 1) * hop_size - pitchtrack.BUF_SIZE / 2) / sample_rate
+    return times, pitch, np.concatenate(confidences), np.concatenate(levels)
+
+
+def segment_notes(
+    times,
+    pitch,
+    confidence,
+    rms,
+    min_confidence=MIN_CONFIDENCE,
+    min_rms=MIN_RMS,
+    min_duration=MIN_DURATION,
+    smoothing=SMOOTHING,
+):
+    """
+    Turns a pitch track into notes: runs of voiced hops that stay on the same semitone.
+
+    :returns: arrays ``(start, duration, pitch)`` of the notes, in seconds and midi. The pitch
+        of a note is the median of its (unrounded) readings.
+    """
+    if len(times) == 0:
+        empty = np.zeros(0)
+        return empty, empty, empty
+
+    # median filter, so that single-hop octave errors don't split notes
+    if smoothing > 1 and len(pitch) >= smoothing:
+        padded = np.pad(pitch, smoothing // 2, mode="edge")
+        pitch = np.median(sliding_window_view(padded, smoothing), axis=1)[: len(times)]
+
+    voiced = (confidence >= min_confidence) & (rms >= min_rms) & (pitch > 0)
+    label = np.where(voiced, np.round(pitch), -1)
+
+    # runs of equal labels
+    bounds = np.flatnonzero(np.diff(label)) + 1
+    starts = np.concatenate(([0], bounds))
+    ends = np.concatenate((bounds, [len(label)]))
+    hop_time = times[-1] - times[-2] if len(times) > 1 else 0.0
+
+    keep = label[starts] >= 0
+    starts, ends = starts[keep], ends[keep]
+    start_time = times[starts]
+    duration = times[ends - 1] - start_time + hop_time
+    keep = duration >= min_duration
+    starts, ends = starts[keep], ends[keep]
+
+    note_pitch = np.array([np.median(pitch[a:b]) for a, b in zip(starts, ends)])
+    return start_time[keep], duration[keep], note_pitch
+
+
+def write_chart(filepath, start, duration, pitch, velocity=VELOCITY):
+    """
+    Writes notes in the game's txt chart format: start (sec), pitch (Hz), duration (sec)
+    and velocity, separated by tabs, one note per line.
+    """
+    hz = 440.0 * 2 ** ((np.asarray(pitch) - 69) / 12)
+    with open(filepath, "w") as f:
+        for row in zip(start, hz, duration):
+            f.write("{:.9g}\t{:.6g}\t{:.9g}\t{:.6g}\n".format(*row, velocity))
+
+
+def chart_song(out_path, path, minus_path=None, **kwargs):
+    """
+    Generates the chart of one song and writes it to *out_path*.
+
+    :param path: the vocal stem, or the full mix if *minus_path* is given.
+    :param minus_path: the instrumental, subtracted from *path*.
+    :param kwargs: passed on to :func:`segment_notes`.
+
+    :returns: the number of notes written.
+    """
+    blocks, sample_rate = read_stem(path, minus_path)
+    track = track_pitch(blocks, sample_rate)
+    start, duration, pitch = segment_notes(*track, **kwargs)
+
+    tmp_path = out_path + ".tmp"
+    write_chart(tmp_path, start, duration, pitch)
+    os.replace(tmp_path, out_path)
+    return len(start)
+
+
+def _chart_job(job):
+    return chart_song(*job)
+
+
+def chart_songs(jobs, processes=1):
+    """
+    Generates several charts, optionally in parallel.
+
+    :param jobs: list of ``(out_path, path, minus_path)`` tuples (see :func:`chart_song`).
+    :param processes: number of worker processes. 1 runs everything in this process.
+
+    :returns: the number of notes of each chart, in the order of *jobs*.
+    """
+    if processes > 1 and len(jobs) > 1:
+        from multiprocessing import Pool
+
+        with Pool(min(processes, len(jobs))) as pool:
+            return pool.map(_chart_job, jobs)
+    return [_chart_job(job) for job in jobs]
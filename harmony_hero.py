@@ -0,0 +1,637 @@
+# command line tools for Harmony Hero. Run pitch_detection.py to play the game itself.
+#
+# usage: python harmony_hero.py <command> [options]
+#
+# commands:
+#   compile     build song packages from the loose song files in the repo
+#   index       refresh the song library index and list its songs
+#   import      build a song package from a note list in songs/
+#   chart       generate txt charts from vocal stems by offline pitch tracking
+#   build-library   build every song package in parallel, skipping unchanged songs
+#   replay      score a recorded session log again, headless (or on screen with --render)
+#   latency     loopback self-test of the pitch pipeline's latency, without audio devices
+#   evaluate    accuracy, latency and cost of the pitch detection methods on labelled vocals
+
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+import pitchtrack
+import songlib
+import songpkg
+
+
+def cmd_compile(args):
+    songs = args.songs or sorted(songpkg.LEGACY_SONGS)
+    parts = {}
+    for part in args.parts:
+        name, sep, path = part.partition("=")
+        if not sep or not name or not path:
+            print("--part must be NAME=FILE, not {!r}".format(part))
+            return 1
+        parts[name] = path
+    if parts and len(songs) != 1:
+        print("--part needs exactly one song id")
+        return 1
+
+    for song_id in songs:
+        if song_id not in songpkg.LEGACY_SONGS:
+            print("unknown song: {}".format(song_id))
+            return 1
+        t = time.perf_counter()
+        song = songpkg.compile_legacy_song(song_id, args.library, args.src, parts)
+        print(
+            "{}: {} notes, {} parts, max score {} ({:.2f}s) -> {}".format(
+                song.id,
+                len(song.notes),
+                len(song.parts),
+                song.max_score,
+                time.perf_counter() - t,
+                song.path,
+            )
+        )
+    songlib.SongIndex(args.library).refresh()
+    return 0
+
+
+def cmd_index(args):
+    index = songlib.SongIndex(args.library)
+    t = time.perf_counter()
+    added, updated, removed = index.refresh()
+    print(
+        "{} songs ({} added, {} updated, {} removed) in {:.3f}s".format(
+            len(index), added, updated, removed, time.perf_counter() - t
+        )
+    )
+    for entry in index.entries:
+        print(
+            "  {:<16} {} by {} ({:.0f}s, {} notes)".format(
+                entry["id"],
+                entry["title"],
+                entry["artist"],
+                entry["duration"],
+                entry["num_notes"],
+            )
+        )
+    return 0
+
+
+def cmd_import(args):
+    import songimport
+
+    song_id = args.song
+    if song_id not in songpkg.LEGACY_SONGS:
+        print("unknown song: {}".format(song_id))
+        return 1
+    info = songpkg.LEGACY_SONGS[song_id]
+    if args.file is None and song_id not in songimport.LEGACY_IMPORT_FILES:
+        print("no note list for {}, use --file".format(song_id))
+        return 1
+    import_file = args.file or os.path.join(
+        songpkg.root_dir, songimport.LEGACY_IMPORT_FILES[song_id]
+    )
+
+    # imported notes are transposed like the song's txt chart, which they are checked against
+    transpose = info["transpose"] + args.transpose
+    t = time.perf_counter()
+    reference = songpkg.read_notes_txt(
+        os.path.join(songpkg.root_dir, info["notes"]), info["transpose"]
+    )
+    # the notes held out of the fit check it
+    fitted, held_out = songimport.split_reference(reference)
+    if songimport.is_tuple_list(import_file):
+        data = songimport.read_tuples(import_file, args.third)
+        if args.bpm is None:
+            tempo_map = songimport.fit_tempo_map(data, fitted)
+        else:
+            last_tick = np.max(data[:, 1] + data[:, 2])
+            tempo_map = songimport.constant_tempo_map(args.bpm, last_tick)
+        notes = songimport.tuples_to_notes(data, tempo_map, transpose)
+        source = "{} tuples".format(len(data))
+    else:
+        notes = songpkg.read_notes_txt(import_file, transpose)
+        notes, offset = songimport.fit_offset(notes, fitted)
+        source = "a txt chart, shifted by {:+.3f}s".format(offset)
+    print(
+        "{}: {} notes from {} ({:.1f} ms)".format(
+            import_file, len(notes), source, (time.perf_counter() - t) * 1000
+        )
+    )
+
+    check = songimport.check_consistency(notes, reference, held_out)
+    print("compared to {}:".format(info["notes"]))
+    for key, value in check.items():
+        print("  {:<16} {}".format(key, value))
+    problems = songimport.consistency_problems(check)
+    if problems:
+        print("{} doesn't line up with {}:".format(import_file, info["notes"]))
+        for problem in problems:
+            print("  " + problem)
+        if not args.force:
+            print("not writing {} (use --force to write it anyway)".format(song_id))
+            return 1
+
+    out_id = args.id or song_id + "_midi"
+    stems, artwork = songpkg.legacy_sources(song_id)
+    song = songpkg.compile_package(
+        os.path.join(args.library, out_id),
+        out_id,
+        info["title"] + " (midi)",
+        info["artist"],
+        notes,
+        stems,
+        artwork,
+    )
+    songlib.SongIndex(args.library).refresh()
+    print("-> {}".format(song.path))
+    return 0
+
+
+def cmd_chart(args):
+    import chart
+
+    jobs = []
+    if args.vocals:
+        if len(args.songs) != 1:
+            print("--vocals needs exactly one song id")
+            return 1
+        jobs.append((args.songs[0], args.vocals, None))
+    else:
+        # the vocals are what the full mix has on top of the instrumental
+        for song_id in args.songs or sorted(songpkg.LEGACY_SONGS):
+            mix = os.path.join(args.src, song_id + ".wav")
+            music = os.path.join(args.src, song_id + "_music.wav")
+            if not (os.path.exists(mix) and os.path.exists(music)):
+                print("skipping {}: needs {} and {}".format(song_id, mix, music))
+                continue
+            jobs.append((song_id, mix, music))
+
+    os.makedirs(args.out, exist_ok=True)
+    jobs = [
+        (os.path.join(args.out, song_id + "_notes.txt"), path, minus_path)
+        for song_id, path, minus_path in jobs
+    ]
+    t = time.perf_counter()
+    counts = chart.chart_songs(jobs, args.processes)
+    for (out_path, _, _), count in zip(jobs, counts):
+        print("{}: {} notes".format(out_path, count))
+    print("{} charts in {:.2f}s".format(len(jobs), time.perf_counter() - t))
+    return 0
+
+
+def cmd_build_library(args):
+    import songbuild
+
+    sources = songbuild.find_sources(args.src, legacy=not args.no_legacy)
+    workers = args.workers or os.cpu_count()
+
+    def progress(result):
+        timings = " ".join(
+            "{}={:.2f}s".format(k, v) for k, v in result["timings"].items()
+        )
+        line = "{:<8} {:<24} {}".format(result["status"], result["id"], timings)
+        if result["error"]:
+            line += "  " + result["error"]
+        print(line)
+
+    t = time.perf_counter()
+    results = songbuild.build_library(
+        sources, args.library, workers, args.force, progress
+    )
+    elapsed = time.perf_counter() - t
+    songlib.SongIndex(args.library).refresh()
+
+    counts = {}
+    for result in results:
+        counts[result["status"]] = counts.get(result["status"], 0) + 1
+    print(
+        "{} songs in {:.2f}s on {} workers: {}".format(
+            len(results),
+            elapsed,
+            workers,
+            ", ".join("{} {}".format(n, status) for status, n in sorted(counts.items())),
+        )
+    )
+    print("total time per stage (summed over workers):")
+    for stage in songbuild.STAGES:
+        total = sum(r["timings"].get(stage, 0.0) for r in results)
+        print("  {:<8} {:.2f}s".format(stage, total))
+    return 1 if counts.get("failed") else 0
+
+
+def cmd_replay(args):
+    if not args.render:
+        # no window is shown, and nothing is drawn
+        os.environ.setdefault("SDL_VIDEODRIVER", "offscreen")
+    import pitch_detection as game
+    import sessionlog
+
+    reader = sessionlog.SessionReader(args.log)
+    num_singers = reader.meta.get("num_singers", 1)
+    if num_singers > 1:
+        print(
+            "warning: the session had {} singers, only the first one was recorded and "
+            "is replayed".format(num_singers)
+        )
+
+    if args.render:
+        sm = game.ScreenManager()
+        sm.add_screen(
+            game.ReplayScreen(args.log, args.library, args.speed, name="replay")
+        )
+        game.run(sm)
+        return 0
+
+    times = [r.time for r in reader if isinstance(r, sessionlog.Frame)]
+    song_time = times[-1] - times[0] if times else 0.0
+
+    t = time.perf_counter()
+    game_display, recorded, num_frames = game.replay_session(args.log, args.library)
+    elapsed = time.perf_counter() - t
+
+    print(
+        "{}: {} frames ({:.1f}s of song) replayed in {:.2f}s, {:.0f}x real time".format(
+            reader.meta["song"],
+            num_frames,
+            song_time,
+            elapsed,
+            song_time / max(elapsed, 1e-9),
+        )
+    )
+    print("score: {:.3f} of {}".format(game_display.score, game_display.max_points))
+    if game_display.max_points != reader.meta["max_score"]:
+        print(
+            "warning: the chart changed since the session was recorded "
+            "(max score was {})".format(reader.meta["max_score"])
+        )
+    if recorded is None:
+        print("recorded score: none (the log was cut short)")
+        return 0
+    print("recorded score: {:.3f}".format(recorded))
+    return 0 if abs(game_display.score - recorded) < 1e-6 else 1
+
+
+def cmd_latency(args):
+    os.environ.setdefault("SDL_VIDEODRIVER", "offscreen")
+    import pitch_detection as game
+    import latency
+    from imslib.audio import Audio
+
+    if args.buffer_size:
+        Audio.buffer_size = args.buffer_size
+    hop_size = args.hop_size or pitchtrack.HOP_SIZE
+    probe = latency.LatencyProbe()
+    detector = game.PitchDetector(hop_size=hop_size, probe=probe, method=args.method)
+    result = latency.loopback_test(
+        detector,
+        args.duration,
+        args.input_latency / 1000,
+        args.output_latency / 1000,
+        probe,
+    )
+
+    print(
+        "{}, buffer size {}, hop size {}, simulated latency in {} ms / out {} ms".format(
+            args.method,
+            Audio.buffer_size,
+            hop_size,
+            args.input_latency,
+            args.output_latency,
+        )
+    )
+    print("bursts detected (ms after they were played, in audio time):")
+    for name in ("round_trip", "compensated"):
+        stats = result[name]
+        print(
+            "  {:<12} {}".format(
+                name,
+                " ".join(
+                    "{}={:.1f}".format(k, v) for k, v in stats.items() if k != "count"
+                )
+                or "no data",
+            )
+        )
+    print("  missed       {}".format(result["missed"]))
+    print(probe.format_report())
+    return 1 if result["missed"] else 0
+
+
+def cmd_evaluate(args):
+    import tempfile
+
+    import pitcheval
+
+    tmp_dir = None
+    corpus = args.corpus
+    if corpus is None:
+        tmp_dir = tempfile.TemporaryDirectory(prefix="hh-corpus-")
+        corpus = tmp_dir.name
+    if args.synthetic or args.corpus is None:
+        pitcheval.make_corpus(corpus, args.synthetic or 8)
+
+    pairs = pitcheval.find_corpus(corpus)
+    if not pairs:
+        print("no labelled recordings (<name>.wav with <name>.csv) in {}".format(corpus))
+        return 1
+    t = time.perf_counter()
+    results = pitcheval.evaluate(
+        pairs, args.methods, args.processes, min_confidence=args.min_confidence
+    )
+    elapsed = time.perf_counter() - t
+    if tmp_dir is not None:
+        tmp_dir.cleanup()
+
+    print(
+        "{} recordings, {} methods in {:.1f}s on {} processes".format(
+            len(pairs), len(args.methods), elapsed, args.processes
+        )
+    )
+    print(
+        "{:<8} {:>6} {:>6} {:>6} {:>6} {:>7} {:>7} {:>7} {:>6} {:>7} {:>6} {:>7}".format(
+            "method",
+            "pitch",
+            "chroma",
+            "recall",
+            "false",
+            "overall",
+            "lat p50",
+            "lat p90",
+            "missed",
+            "cpu us",
+            "core",
+            "hop p99",
+        )
+    )
+    for method, r in results.items():
+        latency = r["latency_ms"]
+        print(
+            "{:<8} {:>6.1%} {:>6.1%} {:>6.1%} {:>6.1%} {:>7.1%} {:>7.1f} {:>7.1f} "
+            "{:>6} {:>7.0f} {:>6.1%} {:>7.0f}".format(
+                method,
+                r["raw_pitch"],
+                r["raw_chroma"],
+                r["voicing_recall"],
+                r["voicing_false_alarm"],
+                r["overall"],
+                latency.get("p50", float("nan")),
+                latency.get("p90", float("nan")),
+                "{}/{}".format(r["missed"], r["onsets"]),
+                r["cpu_us"],
+                r["core"],
+                r["hop_us"].get("p99", float("nan")),
+            )
+        )
+
+    best = pitcheval.cheapest(results, args.target)
+    if best is None:
+        print("no method reaches {:.0%} raw pitch accuracy".format(args.target))
+    else:
+        print(
+            "cheapest method with at least {:.0%} raw pitch accuracy: {}".format(
+                args.target, best
+            )
+        )
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"corpus": args.corpus, "results": results}, f, indent=2)
+    return 0
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(prog="harmony_hero", description=__doc__)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    p = commands.add_parser("compile", help="build song packages from loose song files")
+    p.add_argument(
+        "songs", nargs="*", help="song ids to build (default: all of them)"
+    )
+    p.add_argument(
+        "--library",
+        default=songpkg.library_dir,
+        help="directory to write packages to (default: %(default)s)",
+    )
+    p.add_argument(
+        "--src",
+        default=songpkg.root_dir,
+        help="directory holding the loose song files (default: %(default)s)",
+    )
+    p.add_argument(
+        "--part",
+        dest="parts",
+        action="append",
+        default=[],
+        metavar="NAME=FILE",
+        help="add a harmony part for duet mode, from a notes file in the song's format "
+        "(relative to --src, repeatable, one song only)",
+    )
+    p.set_defaults(func=cmd_compile)
+
+    p = commands.add_parser("index", help="refresh and list the song library index")
+    p.add_argument(
+        "--library",
+        default=songpkg.library_dir,
+        help="library directory (default: %(default)s)",
+    )
+    p.set_defaults(func=cmd_index)
+
+    p = commands.add_parser("import", help="build a song package from a note list")
+    p.add_argument("song", help="id of the song (its txt chart is used for checking)")
+    p.add_argument(
+        "--file",
+        help="the tuple list, or a notes file in the txt chart format (default: the "
+        "one in songs/)",
+    )
+    p.add_argument(
+        "--third",
+        choices=("len", "end"),
+        help="meaning of the third tuple value (default: guessed)",
+    )
+    p.add_argument(
+        "--bpm",
+        type=float,
+        help="constant tempo of the ticks (default: a tempo map fitted to the txt chart)",
+    )
+    p.add_argument(
+        "--transpose",
+        type=int,
+        default=0,
+        help="semitones to add to every note, on top of the song's own transpose",
+    )
+    p.add_argument(
+        "--force",
+        action="store_true",
+        help="write the package even if its notes don't line up with the txt chart",
+    )
+    p.add_argument("--id", help="id of the new package (default: <song>_midi)")
+    p.add_argument(
+        "--library",
+        default=songpkg.library_dir,
+        help="library directory (default: %(default)s)",
+    )
+    p.set_defaults(func=cmd_import)
+
+    p = commands.add_parser("chart", help="generate charts from vocal stems")
+    p.add_argument("songs", nargs="*", help="song ids to chart (default: all of them)")
+    p.add_argument(
+        "--vocals",
+        help="isolated vocal stem of a single song, instead of <song>.wav - <song>_music.wav",
+    )
+    p.add_argument(
+        "--src",
+        default=songpkg.root_dir,
+        help="directory holding <song>.wav and <song>_music.wav (default: %(default)s)",
+    )
+    p.add_argument(
+        "--out",
+        default=os.path.join(songpkg.root_dir, "charts"),
+        help="directory to write <song>_notes.txt charts to (default: %(default)s)",
+    )
+    p.add_argument(
+        "--processes",
+        type=int,
+        default=os.cpu_count(),
+        help="songs charted in parallel (default: %(default)s)",
+    )
+    p.set_defaults(func=cmd_chart)
+
+    p = commands.add_parser(
+        "build-library", help="build all song packages in parallel, incrementally"
+    )
+    p.add_argument(
+        "--src",
+        action="append",
+        default=[],
+        help="directory of song sources (subdirectories with a song.json). Repeatable",
+    )
+    p.add_argument(
+        "--no-legacy",
+        action="store_true",
+        help="leave out the songs stored as loose files in the repo",
+    )
+    p.add_argument(
+        "--workers", type=int, help="worker processes (default: number of cpus)"
+    )
+    p.add_argument(
+        "--force", action="store_true", help="rebuild songs even if unchanged"
+    )
+    p.add_argument(
+        "--library",
+        default=songpkg.library_dir,
+        help="library directory (default: %(default)s)",
+    )
+    p.set_defaults(func=cmd_build_library)
+
+    p = commands.add_parser(
+        "replay", help="score a session log recorded with pitch_detection.py --record"
+    )
+    p.add_argument("log", help="session log (.hhs)")
+    p.add_argument(
+        "--render", action="store_true", help="show the replay in the game window"
+    )
+    p.add_argument(
+        "--speed",
+        type=float,
+        default=1.0,
+        help="playback speed with --render (default: %(default)s)",
+    )
+    p.add_argument(
+        "--library",
+        default=songpkg.library_dir,
+        help="library directory (default: %(default)s)",
+    )
+    p.set_defaults(func=cmd_replay)
+
+    p = commands.add_parser(
+        "latency", help="measure the pitch pipeline's latency with a loopback self-test"
+    )
+    p.add_argument(
+        "--duration",
+        type=float,
+        default=10.0,
+        help="seconds of tone bursts (default: %(default)s)",
+    )
+    p.add_argument(
+        "--buffer-size", type=int, help="audio buffer size (default: the game's)"
+    )
+    p.add_argument(
+        "--hop-size", type=int, help="pitch detector hop size (default: the game's)"
+    )
+    p.add_argument(
+        "--input-latency",
+        type=float,
+        default=5.0,
+        help="simulated input latency in ms (default: %(default)s)",
+    )
+    p.add_argument(
+        "--output-latency",
+        type=float,
+        default=20.0,
+        help="simulated output latency in ms (default: %(default)s)",
+    )
+    p.add_argument(
+        "--method",
+        choices=pitchtrack.METHODS,
+        default=pitchtrack.METHOD,
+        help="pitch detection method (default: %(default)s)",
+    )
+    p.set_defaults(func=cmd_latency)
+
+    p = commands.add_parser(
+        "evaluate",
+        help="compare the pitch detection methods on labelled vocal recordings",
+    )
+    p.add_argument(
+        "corpus",
+        nargs="?",
+        help="directory of <name>.wav recordings with <name>.csv pitch labels (time, Hz) "
+        "(default: synthetic vocals, in a temporary directory)",
+    )
+    p.add_argument(
+        "--methods",
+        nargs="+",
+        choices=pitchtrack.METHODS,
+        default=list(pitchtrack.METHODS),
+        help="methods to evaluate (default: all of them)",
+    )
+    p.add_argument(
+        "--synthetic",
+        type=int,
+        metavar="N",
+        help="first write N synthetic recordings to the corpus (default without a "
+        "corpus: 8)",
+    )
+    p.add_argument(
+        "--processes",
+        type=int,
+        default=os.cpu_count(),
+        help="recordings evaluated in parallel (default: %(default)s)",
+    )
+    p.add_argument(
+        "--min-confidence",
+        type=float,
+        default=0.7,
+        help="confidence of a voiced reading (default: %(default)s)",
+    )
+    p.add_argument(
+        "--target",
+        type=float,
+        default=0.9,
+        help="raw pitch accuracy the recommended method must reach (default: %(default)s)",
+    )
+    p.add_argument("--json", metavar="FILE", help="write the results to FILE")
+    p.set_defaults(func=cmd_evaluate)
+
+    return parser
+
+
+def main(argv=None):
+    args = make_parser().parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
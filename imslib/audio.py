@@ -14,10 +14,16 @@ except:
     # to print out audio devices. In that case, we don't need anything from imslib.core anyway
     pass
 
-import pyaudio
 import numpy as np
 import time
 import platform
+import wave
+
+# pyaudio is only needed by the default backend (see PyAudioBackend)
+try:
+    import pyaudio
+except ImportError:
+    pyaudio = None
 
 system  = platform.system()
 
@@ -48,6 +54,10 @@ class Audio(object):
     :param Audio.in_dev: Can specify a non-default audio input device (via integer index).
         See :meth:`print_audio_devices`. Default is None, which chooses the default input device.
 
+    :param Audio.backend: The backend that moves audio to and from the outside world. Default is
+        None, which uses :class:`PyAudioBackend` (the sound card). Set it to a :class:`FileBackend`
+        to run without any audio device.
+
 
 
     .. note::
@@ -64,6 +74,7 @@ class Audio(object):
     buffer_size = 1024 if system == 'Linux' else 512
     out_dev = None
     in_dev = None
+    backend = None
 
     def __init__(self, num_channels, input_func = None, num_input_channels = 1):
         super(Audio, self).__init__()
@@ -73,39 +84,18 @@ class Audio(object):
         self.input_func = input_func
         self.num_input_channels = num_input_channels
 
-        self.audio = pyaudio.PyAudio()
         self.listen_funcs = []
 
-        # on windows, if '-asio' found in command-line-args, use ASIO drivers
-        if '-asio' in sys.argv:
-            Audio.out_dev, Audio.in_dev = self._find_asio_devices()
+        backend = Audio.backend if Audio.backend is not None else PyAudioBackend()
 
         print(f'''using audio params:
     sample rate:     {Audio.sample_rate}
     buffer size:     {Audio.buffer_size}
-    output device:   {'default' if Audio.out_dev is None else Audio.out_dev}
-    input device:    {'default' if Audio.in_dev is None else Audio.in_dev}
+    backend:         {backend.describe()}
 ''')
 
-        # create output stream
-        self.stream = self.audio.open(format = pyaudio.paFloat32,
-                                      channels = num_channels,
-                                      frames_per_buffer = Audio.buffer_size,
-                                      rate = Audio.sample_rate,
-                                      output = True,
-                                      input = False,
-                                      output_device_index = Audio.out_dev)
-
-        # create input stream
-        self.input_stream = None
-        if input_func:
-            self.input_stream = self.audio.open(format = pyaudio.paFloat32,
-                                                channels = self.num_input_channels,
-                                                frames_per_buffer = Audio.buffer_size,
-                                                rate = Audio.sample_rate,
-                                                output = False,
-                                                input = True,
-                                                input_device_index = Audio.in_dev)
+        # create output stream, and input stream if needed
+        self.stream = backend.open_stream(num_channels, self.num_input_channels if input_func else 0)
 
         self.generator = None
         self.cpu_time = 0
@@ -132,6 +122,28 @@ class Audio(object):
         self.listen_funcs.append(fn)
 
 
+    def get_clock_time(self):
+        """
+        :returns: the backend's monotonic clock, in seconds: the wall clock for the sound card,
+            virtual time for a :class:`FileBackend`.
+        """
+        return self.stream.get_time()
+
+    def get_latency(self):
+        """
+        :returns: ``(input_latency, output_latency)`` in seconds, as reported by the backend: how
+            long audio takes to get from the microphone to :meth:`on_update`, and from
+            :meth:`on_update` to the speakers.
+        """
+        return self.stream.get_latency()
+
+    def get_underruns(self):
+        """
+        :returns: The number of times the output ran out of audio (because :meth:`on_update` wasn't
+            called often enough) since the stream was opened.
+        """
+        return self.stream.underruns
+
     def get_cpu_load(self):
         """
         :returns: Time spent (in milliseconds) processing audio input and output.
@@ -147,20 +159,20 @@ class Audio(object):
         """
 
         t_start = time.time()
+        self.stream.tick()
 
         # get input audio if desired
-        if self.input_stream:
+        if self.input_func:
             try:
-                num_frames = self.input_stream.get_read_available() # number of frames to ask for
+                num_frames = self.stream.read_available() # number of frames to ask for
                 if num_frames:
-                    data_str = self.input_stream.read(num_frames, False)
-                    data_np = np.fromstring(data_str, dtype=np.float32)
+                    data_np = self.stream.read(num_frames)
                     self.input_func(data_np, self.num_input_channels)
             except IOError as e:
                 print('got error', e)
 
         # Ask the generator to generate some audio samples.
-        num_frames = self.stream.get_write_available() # number of frames to supply
+        num_frames = self.stream.write_available() # number of frames to supply
         if self.generator and num_frames != 0:
             (data, continue_flag) = self.generator.generate(num_frames, self.num_channels)
 
@@ -171,7 +183,7 @@ class Audio(object):
             # convert type if needed and write to stream
             if data.dtype != np.float32:
                 data = data.astype(np.float32)
-            self.stream.write(data.tobytes())
+            self.stream.write(data)
 
             # send data to listener functions as well
             for fn in self.listen_funcs:
@@ -187,6 +199,108 @@ class Audio(object):
             self.cpu_time = a * self.cpu_time + (1-a) * dt
 
     def _close(self):
+        self.stream.close()
+
+
+class PyAudioBackend(object):
+    """
+    Audio backend that streams to and from the sound card with PyAudio. This is the default.
+
+    A backend stands for an audio device. Each :class:`Audio` object opens its own stream on it
+    with :meth:`open_stream`, and then calls the stream's :meth:`~PyAudioStream.tick` at the
+    start of each :meth:`Audio.on_update`, followed by reads and writes of float32 samples
+    (interleaved if multi-channel), and :meth:`~PyAudioStream.close` when the app exits.
+    """
+
+    def __init__(self):
+        super(PyAudioBackend, self).__init__()
+        if pyaudio is None:
+            raise ImportError('pyaudio is needed to use the sound card. Use a FileBackend to run without it.')
+
+    def describe(self):
+        return f"pyaudio (output device: {'default' if Audio.out_dev is None else Audio.out_dev}, " \
+               f"input device: {'default' if Audio.in_dev is None else Audio.in_dev})"
+
+    def open_stream(self, num_channels, num_input_channels):
+        """
+        :param num_channels: number of output channels.
+        :param num_input_channels: number of input channels. 0 for no input.
+
+        :returns: a new stream.
+        """
+        return PyAudioStream(num_channels, num_input_channels)
+
+
+class PyAudioStream(object):
+    """Output (and optionally input) stream on the sound card. See :class:`PyAudioBackend`."""
+
+    def __init__(self, num_channels, num_input_channels):
+        super(PyAudioStream, self).__init__()
+        self.audio = pyaudio.PyAudio()
+
+        # on windows, if '-asio' found in command-line-args, use ASIO drivers
+        if '-asio' in sys.argv:
+            Audio.out_dev, Audio.in_dev = self._find_asio_devices()
+
+        # create output stream
+        self.stream = self.audio.open(format = pyaudio.paFloat32,
+                                      channels = num_channels,
+                                      frames_per_buffer = Audio.buffer_size,
+                                      rate = Audio.sample_rate,
+                                      output = True,
+                                      input = False,
+                                      output_device_index = Audio.out_dev)
+
+        # create input stream
+        self.input_stream = None
+        if num_input_channels:
+            self.input_stream = self.audio.open(format = pyaudio.paFloat32,
+                                                channels = num_input_channels,
+                                                frames_per_buffer = Audio.buffer_size,
+                                                rate = Audio.sample_rate,
+                                                output = False,
+                                                input = True,
+                                                input_device_index = Audio.in_dev)
+
+        self.underruns = 0
+
+    def tick(self):
+        """Called at the start of every :meth:`Audio.on_update`."""
+        pass
+
+    def get_time(self):
+        """:returns: a monotonic clock, in seconds."""
+        return time.perf_counter()
+
+    def read_available(self):
+        """:returns: the number of input frames that can be read without waiting."""
+        return self.input_stream.get_read_available() if self.input_stream else 0
+
+    def read(self, num_frames):
+        """:returns: *num_frames* frames of input, as float32 samples."""
+        data_str = self.input_stream.read(num_frames, False)
+        return np.frombuffer(data_str, dtype=np.float32)
+
+    def write_available(self):
+        """:returns: the number of output frames that can be written without waiting."""
+        return self.stream.get_write_available()
+
+    def write(self, data):
+        """Sends float32 samples to the output."""
+        try:
+            self.stream.write(data.tobytes(), exception_on_underflow=True)
+        except IOError as e:
+            # the data was written, after the output had run dry
+            if pyaudio.paOutputUnderflowed not in e.args:
+                raise
+            self.underruns += 1
+
+    def get_latency(self):
+        """:returns: ``(input_latency, output_latency)`` in seconds."""
+        in_latency = self.input_stream.get_input_latency() if self.input_stream else 0.0
+        return in_latency, self.stream.get_output_latency()
+
+    def close(self):
         self.stream.stop_stream()
         self.stream.close()
         if self.input_stream:
@@ -210,6 +324,213 @@ class Audio(object):
         return out_dev, in_dev
 
 
+class FileBackend(object):
+    """
+    Audio backend that needs no audio device. Input comes from a WAV file (then silence once the
+    file ends). Output is kept in memory, mixed across streams, and optionally written to a WAV
+    file by :meth:`close`.
+
+    Time is virtual. With *speed*, it follows the wall clock, *speed* times faster. Without, each
+    stream advances by exactly :attr:`Audio.buffer_size` frames per :meth:`Audio.on_update`, so a
+    loop calling on_update runs as fast as the machine allows and always processes the same audio.
+
+    :param input_path: WAV file to use as microphone input. Must be at :attr:`Audio.sample_rate`.
+        Its channels are mixed down to mono, then copied to every input channel. Default is
+        None, for silence.
+
+    :param output_path: if given, the output is written to this WAV file (16 bit) on close.
+
+    :param speed: how many times faster than real time to run, following the wall clock. Default
+        is None, for one buffer per update.
+
+    :param keep_output: if False, output audio is discarded instead of kept in memory (unless it
+        is to be written to *output_path*).
+
+    :param loopback: if True, input is the output (mixed down to mono) instead of *input_path*,
+        as if a microphone were placed in front of the speakers.
+
+    :param input_latency: the input latency (sec) to simulate and report. In loopback, output
+        reaches the input this much later, plus *output_latency*.
+
+    :param output_latency: the output latency (sec) to simulate and report. Default is None,
+        for one :attr:`Audio.buffer_size`.
+    """
+
+    def __init__(self, input_path = None, output_path = None, speed = None, keep_output = True,
+                 loopback = False, input_latency = 0.0, output_latency = None):
+        super(FileBackend, self).__init__()
+        self.input_path = input_path
+        self.output_path = output_path
+        self.speed = speed
+        self.keep_output = keep_output or output_path is not None
+        self.loopback = loopback
+        self.input_latency = input_latency
+        self.output_latency = output_latency
+
+        self.input = np.zeros(0, dtype=np.float32)
+        if input_path is not None:
+            self.input = self._read_wave(input_path)
+
+        # in loopback, the mono mix of all output so far
+        self.loop = np.zeros(0, dtype=np.float32)
+
+        self.streams = []
+        self.start_time = None
+
+    def _read_wave(self, path):
+        with wave.open(path, 'rb') as wav:
+            if wav.getframerate() != Audio.sample_rate:
+                raise ValueError(f'{path}: sample rate is {wav.getframerate()}, expected {Audio.sample_rate}')
+            if wav.getsampwidth() != 2:
+                raise ValueError(f'{path}: only 16 bit WAV files are supported')
+            data = np.frombuffer(wav.readframes(wav.getnframes()), dtype=np.int16)
+            data = data.reshape(-1, wav.getnchannels()).mean(axis=1)
+        return (data / 32768.0).astype(np.float32)
+
+    def describe(self):
+        source = 'loopback' if self.loopback else self.input_path or 'silence'
+        pace = 'one buffer per update' if self.speed is None else f'{self.speed}x real time'
+        return f'file (input: {source}, {pace})'
+
+    def open_stream(self, num_channels, num_input_channels):
+        stream = FileStream(self, num_channels, num_input_channels)
+        self.streams.append(stream)
+        return stream
+
+    def wall_frame(self):
+        """:returns: the virtual time in frames, when following the wall clock."""
+        now = time.perf_counter()
+        if self.start_time is None:
+            self.start_time = now
+        return int((now - self.start_time) * self.speed * Audio.sample_rate)
+
+    def get_latency(self):
+        """:returns: ``(input_latency, output_latency)`` in seconds."""
+        output_latency = self.output_latency
+        if output_latency is None:
+            output_latency = Audio.buffer_size / Audio.sample_rate
+        return self.input_latency, output_latency
+
+    def mix_loop(self, start_frame, data):
+        """Adds mono output, starting at *start_frame*, to the loopback mix."""
+        end_frame = start_frame + len(data)
+        if end_frame > len(self.loop):
+            loop = np.zeros(max(end_frame, 2 * len(self.loop)), dtype=np.float32)
+            loop[:len(self.loop)] = self.loop
+            self.loop = loop
+        self.loop[start_frame:end_frame] += data
+
+    def input_done(self):
+        """:returns: True once every input stream has read the whole input file."""
+        inputs = [s for s in self.streams if s.num_input_channels]
+        return bool(inputs) and all(s.read_frame >= len(self.input) for s in inputs)
+
+    def get_output(self):
+        """
+        :returns: the output of all streams so far, mixed, as an array of shape
+            ``(num_frames, num_channels)``.
+        """
+        outputs = [s.get_output() for s in self.streams]
+        num_frames = max([len(o) for o in outputs], default=0)
+        num_channels = max([s.num_channels for s in self.streams], default=1)
+        mix = np.zeros((num_frames, num_channels), dtype=np.float32)
+        for o in outputs:
+            # mono streams play on every channel
+            mix[:len(o)] += o
+        return mix
+
+    def close(self):
+        """Writes the output to *output_path*, if given. Called once, when the app exits."""
+        if self.output_path is not None:
+            data = np.clip(self.get_output(), -1, 1)
+            with wave.open(self.output_path, 'wb') as wav:
+                wav.setnchannels(data.shape[1])
+                wav.setsampwidth(2)
+                wav.setframerate(Audio.sample_rate)
+                wav.writeframes((data * 32767).astype(np.int16).tobytes())
+            self.output_path = None
+
+
+class FileStream(object):
+    """A stream on a :class:`FileBackend`, with its own virtual clock."""
+
+    def __init__(self, backend, num_channels, num_input_channels):
+        super(FileStream, self).__init__()
+        self.backend = backend
+        self.num_channels = num_channels
+        self.num_input_channels = num_input_channels
+        self.frame = 0          # virtual time, in frames
+        self.read_frame = 0     # input frames read so far
+        self.written_frames = 0 # output frames written so far
+        self.output = []
+        self.underruns = 0
+
+    def tick(self):
+        if self.backend.speed is None:
+            self.frame += Audio.buffer_size
+        else:
+            self.frame = self.backend.wall_frame()
+
+    def get_time(self):
+        """:returns: the virtual time, in seconds."""
+        if self.backend.speed is not None:
+            return self.backend.wall_frame() / Audio.sample_rate
+        return self.frame / Audio.sample_rate
+
+    def read_available(self):
+        return max(self.frame - self.read_frame, 0) if self.num_input_channels else 0
+
+    def read(self, num_frames):
+        backend = self.backend
+        start = self.read_frame
+        if backend.loopback:
+            # output is heard after the output latency, and recorded after the input latency
+            start -= int(round(sum(backend.get_latency()) * Audio.sample_rate))
+            source = backend.loop
+        else:
+            source = backend.input
+        data = source[max(start, 0):max(start + num_frames, 0)]
+        pad = num_frames - len(data)
+        if pad:
+            # silence before the start (in loopback) and after the end of the input
+            before = min(max(-start, 0), pad)
+            data = np.concatenate((np.zeros(before, dtype=np.float32), data,
+                                   np.zeros(pad - before, dtype=np.float32)))
+        self.read_frame += num_frames
+        if self.num_input_channels > 1:
+            data = np.repeat(data, self.num_input_channels)
+        return data
+
+    def write_available(self):
+        # like a sound card, keep one buffer queued ahead of what has been played
+        return max(self.frame + Audio.buffer_size - self.written_frames, 0)
+
+    def write(self, data):
+        num_frames = len(data) // self.num_channels
+        # the output played everything written so far before this came. Only happens when
+        # following the wall clock: otherwise the stream waits for the app.
+        if self.written_frames and self.frame > self.written_frames:
+            self.underruns += 1
+        if self.backend.loopback:
+            mono = data.reshape(num_frames, self.num_channels).mean(axis=1)
+            self.backend.mix_loop(self.written_frames, mono)
+        self.written_frames += num_frames
+        if self.backend.keep_output:
+            self.output.append(data.copy())
+
+    def get_output(self):
+        """:returns: this stream's output so far, of shape ``(num_frames, num_channels)``."""
+        if not self.output:
+            return np.zeros((0, self.num_channels), dtype=np.float32)
+        return np.concatenate(self.output).reshape(-1, self.num_channels)
+
+    def get_latency(self):
+        return self.backend.get_latency()
+
+    def close(self):
+        pass
+
+
 
 def get_audio_devices():
     """
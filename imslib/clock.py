@@ -73,6 +73,86 @@ class Clock(object):
             self.stop()
 
 
+class AudioClock(object):
+    """
+    Smooth clock that follows what is being heard from an audio stream.
+
+    The position of a stream (frames generated / sample rate) jumps by a whole buffer at each
+    write, and runs ahead of the speakers by the output latency. This clock is fed that position
+    after every write, subtracts the latency, and in between interpolates with a monotonic wall
+    clock. Small differences between the two are smoothed out over several writes; large ones
+    (seeking, underruns) are jumped to at once.
+
+    :param latency: output latency, in seconds, to subtract from the stream position.
+
+    :param gain: fraction of the difference between the stream and the clock corrected at each
+        write.
+
+    :param max_error: differences (sec) above which the clock jumps instead of smoothing.
+
+    :param time_func: the monotonic clock to interpolate with. Use :meth:`Audio.get_clock_time`
+        so that virtual time is followed when running on a :class:`FileBackend`.
+    """
+    def __init__(self, latency = 0, gain = 0.1, max_error = 0.1, time_func = time.perf_counter):
+        super(AudioClock, self).__init__()
+        self.latency = latency
+        self.time_func = time_func
+        self.gain = gain
+        self.max_error = max_error
+
+        self.paused = True
+        self.offset = None      # stream time minus wall time, while playing
+        self.position = 0.0     # stream time, while paused
+        self.last_frame = None
+        self.last_now = 0.0
+
+    def update(self, frame, paused):
+        """
+        Call after each audio write.
+
+        :param frame: the stream's position, in frames generated so far.
+        :param paused: True if the stream is not advancing.
+        """
+        position = max(frame / Audio.sample_rate - self.latency, 0.0)
+        changed = frame != self.last_frame
+        self.last_frame = frame
+
+        if paused:
+            self.paused = True
+            self.position = position
+            self.offset = None
+            return
+
+        wall = self.time_func()
+        if self.offset is None:
+            # (re)starting: wait for the stream to advance, then lock on to it
+            self.paused = False
+            self.position = position
+            if changed:
+                self.offset = position - wall
+            return
+
+        if changed:
+            error = position - (wall + self.offset)
+            if abs(error) > self.max_error:
+                self.offset += error
+                self.last_now = wall + self.offset
+            else:
+                self.offset += self.gain * error
+
+    def now(self):
+        """
+        :returns: the stream time being heard now, in seconds. It never goes backwards while
+            playing.
+        """
+        if self.paused or self.offset is None:
+            t = self.position
+        else:
+            t = max(self.time_func() + self.offset, self.last_now)
+        self.last_now = t
+        return t
+
+
 # For tempo maps - converting bpm to ticks
 kTicksPerQuarter = 480
 
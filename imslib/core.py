@@ -16,6 +16,15 @@ from kivy.core.window import Window
 from kivy.uix.widget import Widget
 import traceback
 
+import csv
+import gc
+import json
+import threading
+import time
+import tracemalloc
+
+import numpy as np
+
 
 
 class BaseWidget(Widget):
@@ -100,6 +109,9 @@ class BaseWidget(Widget):
         self.on_close()
 
     def _update(self, _dt):
+        # a frame goes from one update to the next, drawing included
+        metrics.end_frame()
+        gc_policy.on_frame()
         self.on_update()
 
         # calls self.on_resize() if window size has changed
@@ -108,6 +120,310 @@ class BaseWidget(Widget):
             self.on_resize(self.window_size)
 
 
+class FrameMetrics(object):
+    """
+    Rolling per-frame metrics of an app's subsystems: timings of sections of code, and values
+    such as counters and queue depths. The last *size* frames are kept, for an overlay (see
+    :class:`imslib.gfxutil.MetricsHUD`) or for offline analysis (:meth:`export`).
+
+    Nothing is collected unless enabled: disabled (the default), every call returns right away,
+    so instrumentation can stay in the code. The app has one instance, :data:`metrics`.
+
+    Sections are timed with :meth:`begin` and :meth:`end`, in milliseconds. Time spent in a
+    section begun inside another one only counts for the inner one. Each frame ends with
+    :meth:`end_frame`, which :class:`BaseWidget` calls. While enabled, drawing the window
+    (``'draw'``) and garbage collection (``'gc'``) are timed too.
+
+    Only the thread that enabled the metrics (the UI thread) is measured.
+
+    With *trace_allocations*, :meth:`enable` also starts ``tracemalloc``, and each frame records
+    ``'alloc kB'``, the most memory allocated at once during the frame, and ``'heap kB'``, the
+    memory allocated by Python at its end. Tracing slows down every allocation, so it is off
+    by default.
+    """
+
+    def __init__(self, size=600):
+        """
+        :param size: number of frames to keep.
+        """
+        super(FrameMetrics, self).__init__()
+        self.enabled = False
+        self.thread = None
+        self.trace_allocations = False
+        self.tracing = False
+        self.heap = 0
+        self.reset(size)
+
+    def reset(self, size=None):
+        """
+        Forgets all collected frames.
+
+        :param size: if given, the new number of frames to keep.
+        """
+        if size is not None:
+            self.size = size
+        self.columns = {}  # name -> ring of per-frame values
+        self.kinds = {}  # name -> 'time' or 'value'
+        self.times = np.zeros(self.size)  # when each frame ended
+        self.num_frames = 0
+        self.current = {}
+        self.stack = []
+
+    def enable(self):
+        if self.enabled:
+            return
+        self.enabled = True
+        self.thread = threading.get_ident()
+        self.current = {}
+        self.stack = []
+        gc.callbacks.append(self._on_gc)
+        Window.bind(on_draw=self._on_draw, on_flip=self._on_flip)
+        if self.trace_allocations and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.tracing = True
+        self.heap = tracemalloc.get_traced_memory()[0]
+
+    def disable(self):
+        if not self.enabled:
+            return
+        self.enabled = False
+        gc.callbacks.remove(self._on_gc)
+        Window.unbind(on_draw=self._on_draw, on_flip=self._on_flip)
+        if self.tracing:
+            tracemalloc.stop()
+            self.tracing = False
+
+    def begin(self, name):
+        """Starts timing the section *name*."""
+        if self.enabled and threading.get_ident() == self.thread:
+            self.stack.append([name, time.perf_counter(), 0.0])
+
+    def end(self, name):
+        """Stops timing the section *name*, adding its time to the current frame."""
+        if not self.enabled or not self.stack or self.stack[-1][0] != name:
+            return
+        if threading.get_ident() != self.thread:
+            return
+        _, start, inner = self.stack.pop()
+        elapsed = time.perf_counter() - start
+        self._add(name, 1000 * (elapsed - inner), 'time')
+        if self.stack:
+            self.stack[-1][2] += elapsed
+
+    def add(self, name, value):
+        """Adds *value* to the metric *name* of the current frame (for counters)."""
+        if self.enabled:
+            self._add(name, value, 'value')
+
+    def set(self, name, value):
+        """Sets the metric *name* of the current frame (for levels, like a queue's depth)."""
+        if self.enabled:
+            self.current[name] = value
+            self.kinds.setdefault(name, 'value')
+
+    def _add(self, name, value, kind):
+        self.current[name] = self.current.get(name, 0.0) + value
+        self.kinds.setdefault(name, kind)
+
+    def end_frame(self):
+        """Stores the current frame's metrics and starts a new frame."""
+        if not self.enabled:
+            return
+        if tracemalloc.is_tracing():
+            heap, peak = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            self.set('alloc kB', max(peak - self.heap, 0) / 1024)
+            self.set('heap kB', heap / 1024)
+            self.heap = heap
+        row = self.num_frames % self.size
+        for name in self.current:
+            if name not in self.columns:
+                self.columns[name] = np.zeros(self.size)
+        for name, column in self.columns.items():
+            column[row] = self.current.get(name, 0.0)
+        self.times[row] = time.perf_counter()
+        self.num_frames += 1
+        self.current = {}
+
+    def top_allocations(self, count = 10):
+        """
+        :returns: text listing the *count* lines of code that hold the most memory, while
+            allocations are traced.
+        """
+        if not tracemalloc.is_tracing():
+            return 'allocations are not traced'
+        stats = tracemalloc.take_snapshot().statistics('lineno')
+        return '\n'.join(str(stat) for stat in stats[:count])
+
+    def _on_draw(self, *args):
+        self.begin('draw')
+
+    def _on_flip(self, *args):
+        self.end('draw')
+
+    def _on_gc(self, phase, info):
+        if phase == 'start':
+            self.begin('gc')
+        else:
+            self.end('gc')
+            if threading.get_ident() == self.thread:
+                self.add('gc collections', 1)
+
+    def _ordered(self, values):
+        # the kept frames of a ring, oldest first
+        n = min(self.num_frames, self.size)
+        if self.num_frames <= self.size:
+            return values[:n]
+        row = self.num_frames % self.size
+        return np.concatenate((values[row:], values[:row]))
+
+    def get_frames(self):
+        """
+        :returns: ``(times, values)``: when each kept frame ended (``time.perf_counter()``), and
+            a dictionary of each metric's per-frame values, oldest frame first.
+        """
+        values = {name: self._ordered(column) for name, column in self.columns.items()}
+        return self._ordered(self.times), values
+
+    def summary(self):
+        """
+        :returns: a dictionary of the kept frames' statistics. ``'frame'`` is the time between
+            frames (ms); then, for each metric, its ``mean``, ``p99``, ``max`` and ``last``
+            value.
+        """
+        times, values = self.get_frames()
+        result = {}
+        if len(times) > 1:
+            values = dict(frame=1000 * np.diff(times), **values)
+        for name, v in values.items():
+            if len(v):
+                result[name] = {'mean': float(v.mean()), 'p99': float(np.percentile(v, 99)),
+                                'max': float(v.max()), 'last': float(v[-1])}
+        return result
+
+    def format_summary(self):
+        """:returns: the :meth:`summary` as text, one metric per line."""
+        summary = self.summary()
+        frame = summary.pop('frame', None)
+        if frame is None:
+            return 'no frames yet'
+        lines = [f'fps {1000 / frame["mean"]:5.1f}   frame {frame["mean"]:5.1f}ms  p99 {frame["p99"]:5.1f}ms',
+                 f'{"":<16}{"mean":>8}{"p99":>8}{"max":>8}']
+        for name, s in summary.items():
+            if self.kinds.get(name) == 'time':
+                lines.append(f'{name:<16}{s["mean"]:>8.2f}{s["p99"]:>8.2f}{s["max"]:>8.2f}')
+            else:
+                lines.append(f'{name:<16}{s["mean"]:>8.1f}{"":>8}{s["max"]:>8.0f}  now {s["last"]:g}')
+        return '\n'.join(lines)
+
+    def export(self, path):
+        """
+        Writes the kept frames to *path*: CSV (one row per frame) if it ends with ``.csv``,
+        otherwise JSON (one list per metric, and the :meth:`summary`). Times are in ms, and
+        frame times are relative to the first frame kept.
+        """
+        times, values = self.get_frames()
+        times = 1000 * (times - times[0]) if len(times) else times
+        names = list(values)
+        if path.endswith('.csv'):
+            with open(path, 'w', newline='') as f:
+                writer = csv.writer(f)
+                writer.writerow(['time'] + names)
+                for i in range(len(times)):
+                    writer.writerow([f'{times[i]:.3f}'] + [f'{values[n][i]:g}' for n in names])
+        else:
+            with open(path, 'w') as f:
+                json.dump({'time': times.tolist(),
+                           'metrics': {n: values[n].tolist() for n in names},
+                           'units': {n: 'ms' if self.kinds[n] == 'time' else '' for n in names},
+                           'summary': self.summary()}, f)
+
+
+# the app's metrics. Instrumented code calls metrics.begin(name) / metrics.end(name)
+metrics = FrameMetrics()
+
+
+class GCPolicy(object):
+    """
+    Garbage collection policy for the real-time parts of an app, like a song being played. A
+    collection stops everything, and when audio is refilled from the UI thread, a long one
+    can be heard. Between :meth:`begin` and :meth:`end`, depending on :attr:`mode`:
+
+    - ``'default'``: the collector is left alone.
+    - ``'relaxed'``: collections are made rarer, with higher thresholds (*thresholds*),
+      mostly for the older generations, whose collections take longest.
+    - ``'defer'``: the collector is off. Young objects are collected when the app pauses
+      (:meth:`pause`), and everything at :meth:`end`. In case objects pile up anyway, the
+      youngest generation is collected once more than *max_pending* are waiting.
+
+    In every mode but default, :meth:`begin` collects, then freezes (``gc.freeze()``) all the
+    objects alive, like the loaded song and the app's widgets, so that no collection scans
+    them again until :meth:`end`.
+
+    Most of what a frame allocates is freed by reference counting, which no policy changes:
+    the collector is only needed for reference cycles. The app has one instance,
+    :data:`gc_policy`.
+    """
+
+    MODES = ('default', 'relaxed', 'defer')
+
+    def __init__(self, mode = 'default', thresholds = (2000, 50, 1000), max_pending = 20000):
+        super(GCPolicy, self).__init__()
+        assert mode in GCPolicy.MODES, f'unknown gc mode {mode}'
+        self.mode = mode
+        self.thresholds = thresholds
+        self.max_pending = max_pending
+        self.active = False
+        self.saved = None
+
+    def begin(self):
+        """Starts a real-time section."""
+        if self.active:
+            return
+        self.active = True
+        self.saved = (gc.isenabled(), gc.get_threshold())
+        if self.mode == 'default':
+            return
+
+        gc.collect()
+        gc.freeze()
+        if self.mode == 'relaxed':
+            gc.set_threshold(*self.thresholds)
+        elif self.mode == 'defer':
+            gc.disable()
+
+    def pause(self):
+        """Call when the real-time section pauses: a good time for a short collection."""
+        if self.active and self.mode == 'defer':
+            gc.collect(1)
+
+    def end(self):
+        """Ends the real-time section, with a full collection, and restores the collector."""
+        if not self.active:
+            return
+        self.active = False
+        enabled, thresholds = self.saved
+        gc.set_threshold(*thresholds)
+        if enabled:
+            gc.enable()
+        if self.mode != 'default':
+            gc.unfreeze()
+            gc.collect()
+
+    def on_frame(self):
+        """Called every frame by :class:`BaseWidget`."""
+        if not self.active:
+            return
+        pending = gc.get_count()[0]
+        metrics.set('gc pending', pending)
+        if self.mode == 'defer' and pending > self.max_pending:
+            gc.collect(0)
+
+
+# the app's garbage collection policy
+gc_policy = GCPolicy()
+
+
 # to guarantee a termination/shutdown function being called at the end of the
 # app's lifetime, you can register the function by calling register_terminate_func.
 # it will get called at the end, even if the app crashed.
@@ -12,11 +12,16 @@ from kivy.clock import Clock as kivyClock
 from kivy.graphics.instructions import InstructionGroup
 from kivy.graphics import Rectangle, Ellipse, Color, Line, BindTexture
 from kivy.uix.label import Label
-from kivy.core.text import LabelBase
+from kivy.core.text import LabelBase, Label as CoreLabel
+from kivy.metrics import sp
 from kivy.core.window import Window
 
+import time
+
 import numpy as np
 
+from .core import metrics
+
 font_path = str(Path(Path(__file__).parent, 'fonts', 'Inconsolata-SemiBold.ttf'))
 LabelBase.register(name='Inconsolata', fn_regular=font_path)
 
@@ -111,6 +116,240 @@ class CLabelRect(InstructionGroup):
     cpos = property(get_cpos, set_cpos)
 
 
+class GlyphCache(object):
+    """
+    Rasterizes each character of a font once and keeps its texture. Use :meth:`get` to
+    share one cache per font and size instead of creating new ones.
+    """
+
+    _caches = {}
+
+    @classmethod
+    def get(cls, font_size = 21, font_name = "Arial"):
+        """
+        :returns: The shared GlyphCache for this font and size.
+        """
+        key = (font_size, font_name)
+        if key not in cls._caches:
+            cls._caches[key] = cls(font_size, font_name)
+        return cls._caches[key]
+
+    def __init__(self, font_size = 21, font_name = "Arial"):
+        """
+        :param font_size: The size of the glyphs, in sp (like :class:`CLabelRect`).
+
+        :param font_name: The font of the glyphs.
+        """
+        super(GlyphCache, self).__init__()
+        self.font_size = font_size
+        self.font_name = font_name
+        self.glyphs = {}
+
+    def get_glyph(self, char):
+        """
+        :param char: A single character.
+
+        :returns: The texture of *char*. It is only rasterized the first time it is asked for.
+        """
+        texture = self.glyphs.get(char)
+        if texture is None:
+            label = CoreLabel(text=char, font_size=sp(self.font_size), font_name=self.font_name)
+            label.refresh()
+            texture = label.texture
+            self.glyphs[char] = texture
+        return texture
+
+    def preload(self, chars):
+        """
+        Rasterizes all of *chars* now, so that they don't cost anything during gameplay.
+
+        :param chars: A string of characters.
+        """
+        for c in chars:
+            self.get_glyph(c)
+
+
+class CGlyphLabel(InstructionGroup):
+    """
+    A drop-in replacement for :class:`CLabelRect` for text that changes often, like a score or
+    an fps counter. The text is composed from cached glyph textures (see :class:`GlyphCache`),
+    so changing it never rasterizes text, and setting the same text again does nothing.
+    """
+
+    def __init__(self, cpos, text = "", font_size = 21, font_name = "Arial", prefix = ""):
+        """
+        :param cpos: The position of the label as a tuple (x, y).
+
+        :param text: The text dispayed on the label.
+
+        :param font_size: The size of the label text.
+
+        :param font_name: The font of the label text.
+
+        :param prefix: Text put in front of the value passed to :meth:`set_value`.
+        """
+        super(CGlyphLabel, self).__init__()
+
+        self.glyphs = GlyphCache.get(font_size, font_name)
+        self.glyphs.preload(prefix + '0123456789-.')
+        self.prefix = prefix
+
+        # one Rectangle per character. Grows as needed, never shrinks.
+        self.rects = []
+        self.text = None
+        self.value = None
+        self.text_size = (0, 0)
+        self._cpos = cpos
+        self.set_text(text)
+
+    def set_text(self, text):
+        """
+        Changes the label's text. Only the characters that changed are updated.
+
+        :param text: The new text for the label to display.
+        """
+        if text == self.text:
+            return
+        self.text = text
+
+        while len(self.rects) < len(text):
+            rect = Rectangle(size=(0, 0))
+            self.rects.append(rect)
+            self.add(rect)
+
+        width = 0
+        height = 0
+        for rect, char in zip(self.rects, text):
+            texture = self.glyphs.get_glyph(char)
+            if rect.texture is not texture:
+                rect.texture = texture
+            rect.size = texture.size
+            width += texture.width
+            height = max(height, texture.height)
+
+        # hide unused rectangles
+        for rect in self.rects[len(text):]:
+            rect.size = (0, 0)
+
+        self.text_size = (width, height)
+        self.cpos = self._cpos  # to recompute rect positions
+
+    def set_value(self, value):
+        """
+        Displays *prefix* followed by *value*. Cheaper than :meth:`set_text` when called every
+        frame with a value that rarely changes.
+
+        :param value: Usually a number.
+        """
+        if value != self.value:
+            self.value = value
+            self.set_text(self.prefix + str(value))
+
+    def set_cpos(self, cpos):
+        """
+        Set the center position of the text.
+
+        :param cpos: The new (x,y) position for the text label.
+        """
+        self._cpos = cpos
+        x = cpos[0] - self.text_size[0] * 0.5
+        y = cpos[1] - self.text_size[1] * 0.5
+        for rect in self.rects[:len(self.text)]:
+            rect.pos = (x, y)
+            x += rect.size[0]
+
+    def get_cpos(self):
+        """
+        Get the center position of the text
+        """
+        return self._cpos
+
+    cpos = property(get_cpos, set_cpos)
+
+
+class MetricsHUD(InstructionGroup):
+    """
+    Overlay in the top-left corner of the window showing :data:`imslib.core.metrics`: the frame
+    rate, and the mean, 99th percentile and max of every metric over the frames kept. Showing
+    it enables the metrics, and hiding it disables them again (unless they were already
+    enabled).
+
+    Call :meth:`on_update` every frame. The text is only updated every *refresh* seconds, one
+    :class:`CGlyphLabel` per line, so it never rasterizes text once its glyphs are cached.
+    """
+
+    def __init__(self, refresh = 0.25, font_size = 14):
+        super(MetricsHUD, self).__init__()
+        self.refresh = refresh
+        self.font_size = font_size
+        self.background = Rectangle(size=(0, 0))
+        # one label per line of text. Grows as needed, never shrinks.
+        self.lines = InstructionGroup()
+        self.labels = []
+        self.visible = False
+        self.owns_metrics = False
+        self.last_refresh = 0
+
+    def toggle(self):
+        if self.visible:
+            self.hide()
+        else:
+            self.show()
+
+    def show(self):
+        if self.visible:
+            return
+        self.visible = True
+        self.owns_metrics = not metrics.enabled
+        metrics.enable()
+        self.add(Color(0, 0, 0, 0.7))
+        self.add(self.background)
+        self.add(Color(1, 1, 1, 1))
+        self.add(self.lines)
+        self.last_refresh = 0
+
+    def hide(self):
+        if not self.visible:
+            return
+        self.visible = False
+        if self.owns_metrics:
+            metrics.disable()
+        self.clear()
+
+    def on_update(self):
+        if not self.visible:
+            return
+        now = time.perf_counter()
+        if now - self.last_refresh < self.refresh:
+            return
+        self.last_refresh = now
+
+        text = metrics.format_summary().split('\n')
+        while len(self.labels) < len(text):
+            label = CGlyphLabel((0, 0), font_size=self.font_size, font_name='Inconsolata')
+            self.labels.append(label)
+            self.lines.add(label)
+
+        # hide unused lines
+        for label in self.labels[len(text):]:
+            label.set_text('')
+
+        margin = 8
+        line_height = GlyphCache.get(self.font_size, 'Inconsolata').get_glyph('0').height
+        width = 0
+        y = Window.height - margin - line_height * 0.5
+        for label, line in zip(self.labels, text):
+            label.set_text(line)
+            # labels are centered: align their left edges
+            label.cpos = (margin + label.text_size[0] * 0.5, y)
+            width = max(width, label.text_size[0])
+            y -= line_height
+
+        height = line_height * len(text)
+        self.background.pos = (margin / 2, Window.height - height - margin * 1.5)
+        self.background.size = (width + margin, height + margin)
+
+
 class CEllipse(Ellipse):
     """
     Override Ellipse class to add centered functionality.
@@ -2,25 +2,23 @@
 
 from kivy.uix.widget import Widget
 from kivy.clock import Clock
-from kivy.graphics import Color, Callback, Rotate, PushMatrix, PopMatrix, Translate, Quad
+from kivy.graphics import Callback, Mesh, RenderContext
 from kivy.graphics.opengl import glBlendFunc, GL_SRC_ALPHA, GL_ONE, GL_ZERO, GL_SRC_COLOR, GL_ONE_MINUS_SRC_COLOR, GL_ONE_MINUS_SRC_ALPHA, GL_DST_ALPHA, GL_ONE_MINUS_DST_ALPHA, GL_DST_COLOR, GL_ONE_MINUS_DST_COLOR
 from kivy.core.image import Image
 from kivy.logger import Logger
-from xml.dom.minidom import parse as parse_xml
-from .utils import random_variance, random_color_variance
+from .simulation import ParticleSimulation, read_pex, EMITTER_TYPE_GRAVITY, EMITTER_TYPE_RADIAL
+from .simulation import X, Y, SCALE, ROTATION, COLOR
 from kivy.properties import NumericProperty, BooleanProperty, ListProperty, StringProperty, ObjectProperty
 from kivy import metrics
+from ..core import metrics as frame_metrics
 
 import sys
-import os
 import math
+import numpy as np
 
-__all__ = ['EMITTER_TYPE_GRAVITY', 'EMITTER_TYPE_RADIAL', 'Particle', 'ParticleSystem']
+__all__ = ['EMITTER_TYPE_GRAVITY', 'EMITTER_TYPE_RADIAL', 'ParticleSystem']
 
 
-EMITTER_TYPE_GRAVITY = 0
-EMITTER_TYPE_RADIAL = 1
-
 BLEND_FUNC = {0: GL_ZERO,
             1: GL_ONE,
             0x300: GL_SRC_COLOR,
@@ -37,17 +35,31 @@ BLEND_FUNC = {0: GL_ZERO,
 # and will look the same even if the display is a high-density display
 px = metrics.sp(1) 
 
-class Particle(object):
-    x, y, rotation, current_time = -256, -256, 0, 0
-    scale, total_time = 1.0, 0.
-    color = [1.0, 1.0, 1.0, 1.0]
-    color_delta = [0.0, 0.0, 0.0, 0.0]
-    start_x, start_y, velocity_x, velocity_y = 0, 0, 0, 0
-    radial_acceleration, tangent_acceleration = 0, 0
-    emit_radius, emit_radius_delta = 0, 0
-    emit_rotation, emit_rotation_delta = 0, 0
-    rotation_delta, scale_delta = 0, 0
+# all particles of an emitter are drawn as one Mesh. Each vertex carries its own color,
+# which kivy's default shader doesn't support, hence this shader.
+PARTICLE_VS = """$HEADER$
+attribute vec4 vColor;
+void main (void) {
+  frag_color = vColor * color * vec4(1.0, 1.0, 1.0, opacity);
+  tex_coord0 = vTexCoords0;
+  gl_Position = projection_mat * modelview_mat * vec4(vPosition.xy, 0.0, 1.0);
+}
+"""
+
+PARTICLE_FS = """$HEADER$
+void main (void){
+    gl_FragColor = frag_color * texture2D(texture0, tex_coord0);
+}
+"""
+
+PARTICLE_VERTEX_FORMAT = [(b'vPosition', 2, 'float'), (b'vTexCoords0', 2, 'float'), (b'vColor', 4, 'float')]
 
+# mesh indices are 16 bit, so one mesh can hold at most this many quads
+MAX_QUADS_PER_MESH = 65536 // 4
+
+# corners of a particle quad, in the same order as Quad.points / texture.tex_coords
+CORNERS_X = np.array([-1.0, 1.0, 1.0, -1.0])
+CORNERS_Y = np.array([-1.0, -1.0, 1.0, 1.0])
 
 class ParticleSystem(Widget):
     """
@@ -94,6 +106,7 @@ class ParticleSystem(Widget):
     emitter_type = NumericProperty(0)
 
     update_interval = NumericProperty(1. / 30.)
+    sustain_time = NumericProperty(0.1)
     _is_paused = BooleanProperty(False)
 
     def __init__(self, config, **kwargs):
@@ -112,65 +125,104 @@ class ParticleSystem(Widget):
             | ``gravity_x`` - Gravity in the x direction.
             | ``gravity_y`` - Gravity in the y direction.
         """
-        super(ParticleSystem, self).__init__(**kwargs)
-        self.capacity = 0
-        self.particles = list()
-        self.particles_dict = dict()
+        # particle state lives in numpy arrays (see simulation.py). Created before the
+        # properties are set, since setting them updates the simulation.
+        self.sim = ParticleSimulation(self.max_num_particles, px)
         self.emission_time = 0.0
         self.frame_time = 0.0
-        self.num_particles = 0
+
+        # render buffers: 4 vertices of 8 floats per particle (see PARTICLE_VERTEX_FORMAT)
+        self.vertices = np.zeros((0, 4, 8), dtype=np.float32)
+        self.indices = np.zeros(0, dtype=np.uint16)
+        self.meshes = []
+        self.num_rendered = 0
+
+        super(ParticleSystem, self).__init__(**kwargs)
+
+        self.render_context = RenderContext(use_parent_projection=True, use_parent_modelview=True,
+                                            use_parent_frag_modelview=True)
+        self.render_context.shader.vs = PARTICLE_VS
+        self.render_context.shader.fs = PARTICLE_FS
+        self.canvas.add(self.render_context)
 
         if config is not None:
             self._parse_config(config)
         self.emission_rate = self.max_num_particles / self.life_span
-        self.initial_capacity = self.max_num_particles
-        self.max_capacity = self.max_num_particles
-        self._raise_capacity(self.initial_capacity)
+        self.sim.set_limit(self.max_num_particles)
 
         with self.canvas.before:
             Callback(self._set_blend_func)
         with self.canvas.after:
             Callback(self._reset_blend_func)
 
-        Clock.schedule_once(self._update, self.update_interval)
+        self._update_event = Clock.schedule_interval(self._update, self.update_interval)
+
+    @property
+    def num_particles(self):
+        """
+        The number of live particles.
+        """
+        return self.sim.count
+
+    @property
+    def capacity(self):
+        return self.sim.capacity
 
     def start(self, duration=sys.maxsize):
         """
-        Starts particle emission.
+        Starts particle emission. Safe to call every frame: if already emitting, emission
+        continues uninterrupted and only gets extended if *duration* is longer than what remains.
         
         :param duration: The amount of time for which you want the particles to be emitted.
             Defaults to sys.maxsize.
         """
         if self.emission_rate != 0:
-            self.emission_time = duration
+            self.emission_time = max(self.emission_time, duration)
+
+    def sustain(self, hold=None):
+        """
+        Keeps emitting for as long as this is called (typically every frame), stopping by itself
+        *hold* seconds after the last call. No need to call :meth:`stop`.
+
+        :param hold: Seconds of emission after this call. Defaults to ``sustain_time``.
+        """
+        self.start(self.sustain_time if hold is None else hold)
 
     def stop(self, clear=False):
         """
-        Stops particle emission.
+        Stops particle emission. Safe to call when already stopped.
 
         :param clear: If *True*, clears canvas of already emitted particles. Defaults to *False*.
         """
         self.emission_time = 0.0
-        if clear:
-            self.num_particles = 0
-            self.particles_dict = dict()
-            self.canvas.clear()
+        if clear and self.sim.count:
+            self.sim.clear()
+            self._render()
+
+    def burst(self, count=None):
+        """
+        Emits a batch of particles right now, independent of the emission rate.
+
+        :param count: Number of particles. Defaults to a tenth of ``max_num_particles``.
+            Limited by the particles still available.
+
+        :returns: The number of particles emitted.
+        """
+        if count is None:
+            count = max(1, int(self.max_num_particles) // 10)
+        return self.sim.emit(self, np.zeros(int(count)))
 
     def on_max_num_particles(self, instance, value):
-        self.max_capacity = value
-        if self.capacity < value:
-            self._raise_capacity(self.max_capacity - self.capacity)
-        elif self.capacity > value:
-            self._lower_capacity(self.capacity - self.max_capacity)
+        self.sim.set_limit(value)
         self.emission_rate = self.max_num_particles / self.life_span
 
     def on_texture(self, instance, value):
-        for p in self.particles:
-            try:
-                self.particles_dict[p]['rect'].texture = self.texture
-            except KeyError:
-                # if particle isn't initialized yet, you can't change its texture.
-                pass
+        if self.texture is None:
+            return
+        self.sim.texture_width = self.texture.width
+        self.vertices[:, :, 2:4] = np.reshape(self.texture.tex_coords, (4, 2))
+        for mesh in self.meshes:
+            mesh.texture = self.texture
 
     def on_life_span(self, instance, value):
         self.emission_rate = self.max_num_particles / value
@@ -184,260 +236,107 @@ class ParticleSystem(Widget):
         glBlendFunc(GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA)
 
     def _parse_config(self, config):
-        self._config = parse_xml(config)
-
-        texture_path = self._parse_data('texture', 'name')
-        config_dir_path = os.path.dirname(os.path.abspath(config))
-        path = os.path.join(config_dir_path, texture_path)
-        if os.path.exists(path):
-            self.texture_path = path
-        else:
-            self.texture_path = texture_path
-
+        values = read_pex(config)
+        self.texture_path = values.pop('texture_path')
         self.texture = Image(self.texture_path).texture
-        self.emitter_x = float(self._parse_data('sourcePosition', 'x'))
-        self.emitter_y = float(self._parse_data('sourcePosition', 'y'))
-        self.emitter_x_variance = float(self._parse_data('sourcePositionVariance', 'x'))
-        self.emitter_y_variance = float(self._parse_data('sourcePositionVariance', 'y'))
-        self.gravity_x = float(self._parse_data('gravity', 'x'))
-        self.gravity_y = float(self._parse_data('gravity', 'y'))
-        self.emitter_type = int(self._parse_data('emitterType'))
-        self.max_num_particles = int(float(self._parse_data('maxParticles')))
-        self.life_span = max(0.01, float(self._parse_data('particleLifeSpan')))
-        self.life_span_variance = float(self._parse_data('particleLifespanVariance'))
-        self.start_size = float(self._parse_data('startParticleSize'))
-        self.start_size_variance = float(self._parse_data('startParticleSizeVariance'))
-        self.end_size = float(self._parse_data('finishParticleSize'))
-        self.end_size_variance = float(self._parse_data('FinishParticleSizeVariance'))
-        self.emit_angle = math.radians(float(self._parse_data('angle')))
-        self.emit_angle_variance = math.radians(float(self._parse_data('angleVariance')))
-        self.start_rotation = math.radians(float(self._parse_data('rotationStart')))
-        self.start_rotation_variance = math.radians(float(self._parse_data('rotationStartVariance')))
-        self.end_rotation = math.radians(float(self._parse_data('rotationEnd')))
-        self.end_rotation_variance = math.radians(float(self._parse_data('rotationEndVariance')))
-        self.speed = float(self._parse_data('speed'))
-        self.speed_variance = float(self._parse_data('speedVariance'))
-        self.radial_acceleration = float(self._parse_data('radialAcceleration'))
-        self.radial_acceleration_variance = float(self._parse_data('radialAccelVariance'))
-        self.tangential_acceleration = float(self._parse_data('tangentialAcceleration'))
-        self.tangential_acceleration_variance = float(self._parse_data('tangentialAccelVariance'))
-        self.max_radius = float(self._parse_data('maxRadius'))
-        self.max_radius_variance = float(self._parse_data('maxRadiusVariance'))
-        self.min_radius = float(self._parse_data('minRadius'))
-        self.rotate_per_second = math.radians(float(self._parse_data('rotatePerSecond')))
-        self.rotate_per_second_variance = math.radians(float(self._parse_data('rotatePerSecondVariance')))
-        self.start_color = self._parse_color('startColor')
-        self.start_color_variance = self._parse_color('startColorVariance')
-        self.end_color = self._parse_color('finishColor')
-        self.end_color_variance = self._parse_color('finishColorVariance')
-        self.blend_factor_source = self._parse_blend('blendFuncSource')
-        self.blend_factor_dest = self._parse_blend('blendFuncDestination')
-
-    def _parse_data(self, name, attribute='value'):
-        return self._config.getElementsByTagName(name)[0].getAttribute(attribute)
-
-    def _parse_color(self, name):
-        return [float(self._parse_data(name, 'red')), float(self._parse_data(name, 'green')), float(self._parse_data(name, 'blue')), float(self._parse_data(name, 'alpha'))]
-
-    def _parse_blend(self, name):
-        value = int(self._parse_data(name))
-        return BLEND_FUNC[value]
+
+        values['blend_factor_source'] = BLEND_FUNC[values['blend_factor_source']]
+        values['blend_factor_dest'] = BLEND_FUNC[values['blend_factor_dest']]
+        for name, value in values.items():
+            setattr(self, name, value)
 
     def pause(self):
         """
         Pauses particle emission
         """
-        self._is_paused = True
+        if not self._is_paused:
+            self._is_paused = True
+            self._update_event.cancel()
 
     def resume(self):
         """
         Resumes particle emission
         """
-        self._is_paused = False
-        Clock.schedule_once(self._update, self.update_interval)
+        if self._is_paused:
+            self._is_paused = False
+            self._update_event = Clock.schedule_interval(self._update, self.update_interval)
 
     def _update(self, dt):
+        frame_metrics.begin('particles')
         self._advance_time(dt)
         self._render()
-        if not self._is_paused:
-            Clock.schedule_once(self._update, self.update_interval)
-
-    def _create_particle(self):
-        return Particle()
-
-    def _init_particle(self, particle):
-        life_span = random_variance(self.life_span, self.life_span_variance)
-        if life_span <= 0.0:
-            return
-
-        particle.current_time = 0.0
-        particle.total_time = life_span
-
-        particle.x = random_variance(self.emitter_x, self.emitter_x_variance)
-        particle.y = random_variance(self.emitter_y, self.emitter_y_variance)
-        particle.start_x = self.emitter_x
-        particle.start_y = self.emitter_y
-
-        angle = random_variance(self.emit_angle, self.emit_angle_variance)
-        speed = random_variance(self.speed, self.speed_variance) * px
-        particle.velocity_x = speed * math.cos(angle)
-        particle.velocity_y = speed * math.sin(angle)
-
-        particle.emit_radius = random_variance(self.max_radius, self.max_radius_variance)
-        particle.emit_radius_delta = (self.max_radius - self.min_radius) / life_span
-
-        particle.emit_rotation = random_variance(self.emit_angle, self.emit_angle_variance)
-        particle.emit_rotation_delta = random_variance(self.rotate_per_second, self.rotate_per_second_variance)
-
-        particle.radial_acceleration = random_variance(self.radial_acceleration, self.radial_acceleration_variance)
-        particle.tangent_acceleration = random_variance(self.tangential_acceleration, self.tangential_acceleration_variance)
-
-        start_size = random_variance(self.start_size, self.start_size_variance)
-        end_size = random_variance(self.end_size, self.end_size_variance)
-
-        start_size = max(0.1, start_size) * px
-        end_size = max(0.1, end_size) * px
-
-        particle.scale = start_size / self.texture.width
-        particle.scale_delta = ((end_size - start_size) / life_span) / self.texture.width
-
-        # colors
-        start_color = random_color_variance(self.start_color, self.start_color_variance)
-        end_color = random_color_variance(self.end_color, self.end_color_variance)
-
-        particle.color_delta = [(end_color[i] - start_color[i]) / life_span for i in range(4)]
-        particle.color = start_color
-
-        # rotation
-        start_rotation = random_variance(self.start_rotation, self.start_rotation_variance)
-        end_rotation = random_variance(self.end_rotation, self.end_rotation_variance)
-        particle.rotation = start_rotation
-        particle.rotation_delta = (end_rotation - start_rotation) / life_span
-
-    def _advance_particle(self, particle, passed_time):
-        passed_time = min(passed_time, particle.total_time - particle.current_time)
-        particle.current_time += passed_time
-
-        if self.emitter_type == EMITTER_TYPE_RADIAL:
-            particle.emit_rotation += particle.emit_rotation_delta * passed_time
-            particle.emit_radius -= particle.emit_radius_delta * passed_time
-            particle.x = self.emitter_x - math.cos(particle.emit_rotation) * particle.emit_radius
-            particle.y = self.emitter_y - math.sin(particle.emit_rotation) * particle.emit_radius
-
-            if particle.emit_radius < self.min_radius:
-                particle.current_time = particle.total_time
-
-        else:
-            distance_x = particle.x - particle.start_x
-            distance_y = particle.y - particle.start_y
-            distance_scalar = math.sqrt(distance_x * distance_x + distance_y * distance_y)
-            if distance_scalar < 0.01:
-                distance_scalar = 0.01
-
-            radial_x = distance_x / distance_scalar
-            radial_y = distance_y / distance_scalar
-            tangential_x = radial_x
-            tangential_y = radial_y
-
-            radial_x *= particle.radial_acceleration
-            radial_y *= particle.radial_acceleration
-
-            new_y = tangential_x
-            tangential_x = -tangential_y * particle.tangent_acceleration
-            tangential_y = new_y * particle.tangent_acceleration
-
-            particle.velocity_x += passed_time * (self.gravity_x + radial_x + tangential_x)
-            particle.velocity_y += passed_time * (self.gravity_y + radial_y + tangential_y)
-
-            particle.x += particle.velocity_x * passed_time
-            particle.y += particle.velocity_y * passed_time
-
-        particle.scale += particle.scale_delta * passed_time
-        particle.rotation += particle.rotation_delta * passed_time
-
-        particle.color = [particle.color[i] + particle.color_delta[i] * passed_time for i in range(4)]
-
-    def _raise_capacity(self, by_amount):
-        old_capacity = self.capacity
-        new_capacity = min(self.max_capacity, self.capacity + by_amount)
-
-        for i in range(int(new_capacity - old_capacity)):
-            self.particles.append(self._create_particle())
-
-        self.num_particles = int(new_capacity)
-        self.capacity = new_capacity
-
-    def _lower_capacity(self, by_amount):
-        old_capacity = self.capacity
-        new_capacity = max(0, self.capacity - by_amount)
-
-        for i in range(int(old_capacity - new_capacity)):
-            try:
-                self.canvas.remove(self.particles_dict[self.particles.pop()]['rect'])
-            except:
-                pass
-
-        self.num_particles = int(new_capacity)
-        self.capacity = new_capacity
+        frame_metrics.end('particles')
 
     def _advance_time(self, passed_time):
-        particle_index = 0
-
-        # advance existing particles
-        while particle_index < self.num_particles:
-            particle = self.particles[particle_index]
-            if particle.current_time < particle.total_time:
-                self._advance_particle(particle, passed_time)
-                particle_index += 1
-            else:
-                if particle_index != self.num_particles - 1:
-                    next_particle = self.particles[self.num_particles - 1]
-                    self.particles[self.num_particles - 1] = particle
-                    self.particles[particle_index] = next_particle
-                self.num_particles -= 1
-                if self.num_particles == 0:
-                    Logger.debug('Particle: COMPLETE')
+        # advance existing particles, dropping the ones that died
+        had_particles = self.sim.count > 0
+        self.sim.advance(self, passed_time)
+        if had_particles and self.sim.count == 0:
+            Logger.debug('Particle: COMPLETE')
 
         # create and advance new particles
         if self.emission_time > 0:
             time_between_particles = 1.0 / self.emission_rate
             self.frame_time += passed_time
 
-            while self.frame_time > 0:
-                if self.num_particles < self.max_capacity:
-                    if self.num_particles == self.capacity:
-                        self._raise_capacity(self.capacity)
-
-                    particle = self.particles[self.num_particles]
-                    self.num_particles += 1
-                    self._init_particle(particle)
-                    self._advance_particle(particle, self.frame_time)
-
-                self.frame_time -= time_between_particles
+            if self.frame_time > 0:
+                # one particle per emission interval that elapsed, each advanced by how
+                # long ago it was emitted. Emission beyond capacity is dropped.
+                num_steps = int(math.ceil(self.frame_time / time_between_particles))
+                ages = self.frame_time - time_between_particles * np.arange(num_steps)
+                self.sim.emit(self, ages)
+                self.frame_time -= num_steps * time_between_particles
 
             if self.emission_time != sys.maxsize:
                 self.emission_time = max(0.0, self.emission_time - passed_time)
 
+    def _allocate_render_buffers(self):
+        capacity = self.sim.capacity
+        self.vertices = np.zeros((capacity, 4, 8), dtype=np.float32)
+        if self.texture is not None:
+            self.vertices[:, :, 2:4] = np.reshape(self.texture.tex_coords, (4, 2))
+
+        # two triangles per quad: (0, 1, 2) and (2, 3, 0)
+        num_quads = min(capacity, MAX_QUADS_PER_MESH)
+        quad = np.array([0, 1, 2, 2, 3, 0], dtype=np.uint16)
+        self.indices = (quad[None, :] + 4 * np.arange(num_quads, dtype=np.uint16)[:, None]).reshape(-1)
+
+        num_meshes = max(1, -(-capacity // MAX_QUADS_PER_MESH))
+        while len(self.meshes) < num_meshes:
+            mesh = Mesh(fmt=PARTICLE_VERTEX_FORMAT, mode='triangles', texture=self.texture)
+            self.meshes.append(mesh)
+            self.render_context.add(mesh)
+        self.num_rendered = -1
+
     def _render(self):
-        if self.num_particles == 0:
+        n = self.sim.count
+        if n == 0 and self.num_rendered == 0:
             return
-        for i in range(self.num_particles):
-            particle = self.particles[i]
-            size = (self.texture.size[0] * particle.scale, self.texture.size[1] * particle.scale)
-            if particle not in self.particles_dict:
-                self.particles_dict[particle] = dict()
-                color = particle.color[:]
-                with self.canvas:
-                    self.particles_dict[particle]['color'] = Color(color[0], color[1], color[2], color[3])
-                    PushMatrix()
-                    self.particles_dict[particle]['translate'] = Translate()
-                    self.particles_dict[particle]['rotate'] = Rotate()
-                    self.particles_dict[particle]['rotate'].set(particle.rotation, 0, 0, 1)
-                    self.particles_dict[particle]['rect'] = Quad(texture=self.texture, points=(-size[0] * 0.5, -size[1] * 0.5, size[0] * 0.5, -size[1] * 0.5, size[0] * 0.5,  size[1] * 0.5, -size[0] * 0.5,  size[1] * 0.5))
-                    self.particles_dict[particle]['translate'].xy = (particle.x, particle.y)
-                    PopMatrix()
-            else:
-                self.particles_dict[particle]['rotate'].angle = particle.rotation
-                self.particles_dict[particle]['translate'].xy = (particle.x, particle.y)
-                self.particles_dict[particle]['color'].rgba = particle.color
-                self.particles_dict[particle]['rect'].points = (-size[0] * 0.5, -size[1] * 0.5, size[0] * 0.5, -size[1] * 0.5, size[0] * 0.5,  size[1] * 0.5, -size[0] * 0.5,  size[1] * 0.5)
+        if len(self.vertices) != self.sim.capacity:
+            self._allocate_render_buffers()
+
+        # corners of every particle quad, scaled and rotated around the particle position
+        state = self.sim.state
+        angle = np.radians(state[ROTATION, :n])[:, None]
+        cos, sin = np.cos(angle), np.sin(angle)
+        dx = CORNERS_X * (state[SCALE, :n] * (self.texture.size[0] * 0.5))[:, None]
+        dy = CORNERS_Y * (state[SCALE, :n] * (self.texture.size[1] * 0.5))[:, None]
+
+        vertices = self.vertices
+        vertices[:n, :, 0] = state[X, :n, None] + dx * cos - dy * sin
+        vertices[:n, :, 1] = state[Y, :n, None] + dx * sin + dy * cos
+        vertices[:n, :, 4:8] = state[COLOR, :n].T[:, None, :]
+
+        for i, mesh in enumerate(self.meshes):
+            lo = i * MAX_QUADS_PER_MESH
+            num_quads = max(0, min(n - lo, MAX_QUADS_PER_MESH))
+            if num_quads == 0:
+                # kivy can't take an empty memoryview: clear the mesh with empty lists
+                if self.num_rendered < 0 or self.num_rendered > lo:
+                    mesh.vertices = []
+                    mesh.indices = []
+                continue
+            mesh.vertices = memoryview(vertices[lo:lo + num_quads].reshape(-1))
+            if num_quads != min(max(0, self.num_rendered - lo), MAX_QUADS_PER_MESH):
+                mesh.indices = memoryview(self.indices[:6 * num_quads])
+        self.num_rendered = n
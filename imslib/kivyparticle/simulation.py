@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+
+from xml.dom.minidom import parse as parse_xml
+
+import numpy as np
+import math
+import os
+
+__all__ = ['EMITTER_TYPE_GRAVITY', 'EMITTER_TYPE_RADIAL', 'ParticleSimulation', 'read_pex']
+
+
+EMITTER_TYPE_GRAVITY = 0
+EMITTER_TYPE_RADIAL = 1
+
+# rows of ParticleSimulation.state. One row per particle attribute, one column per particle.
+X, Y, START_X, START_Y, VELOCITY_X, VELOCITY_Y, \
+RADIAL_ACCEL, TANGENT_ACCEL, EMIT_RADIUS, EMIT_RADIUS_DELTA, EMIT_ROTATION, EMIT_ROTATION_DELTA, \
+SCALE, SCALE_DELTA, ROTATION, ROTATION_DELTA, CURRENT_TIME, TOTAL_TIME, \
+R, G, B, A, R_DELTA, G_DELTA, B_DELTA, A_DELTA = range(26)
+NUM_FIELDS = 26
+
+COLOR = slice(R, A + 1)
+COLOR_DELTA = slice(R_DELTA, A_DELTA + 1)
+
+
+def read_pex(config):
+    """
+    Reads a .pex particle config file.
+
+    :param config: path of the .pex file.
+
+    :returns: a dictionary of :class:`ParticleSystem` property names to values. Angles are in
+        radians. ``texture_path`` is resolved relative to the config file when that file exists.
+        Blend factors are the raw values from the file.
+    """
+    xml = parse_xml(config)
+
+    def data(name, attribute='value'):
+        return xml.getElementsByTagName(name)[0].getAttribute(attribute)
+
+    def color(name):
+        return [float(data(name, 'red')), float(data(name, 'green')), float(data(name, 'blue')), float(data(name, 'alpha'))]
+
+    texture_path = data('texture', 'name')
+    path = os.path.join(os.path.dirname(os.path.abspath(config)), texture_path)
+    if os.path.exists(path):
+        texture_path = path
+
+    return {
+        'texture_path': texture_path,
+        'emitter_x': float(data('sourcePosition', 'x')),
+        'emitter_y': float(data('sourcePosition', 'y')),
+        'emitter_x_variance': float(data('sourcePositionVariance', 'x')),
+        'emitter_y_variance': float(data('sourcePositionVariance', 'y')),
+        'gravity_x': float(data('gravity', 'x')),
+        'gravity_y': float(data('gravity', 'y')),
+        'emitter_type': int(data('emitterType')),
+        'max_num_particles': int(float(data('maxParticles'))),
+        'life_span': max(0.01, float(data('particleLifeSpan'))),
+        'life_span_variance': float(data('particleLifespanVariance')),
+        'start_size': float(data('startParticleSize')),
+        'start_size_variance': float(data('startParticleSizeVariance')),
+        'end_size': float(data('finishParticleSize')),
+        'end_size_variance': float(data('FinishParticleSizeVariance')),
+        'emit_angle': math.radians(float(data('angle'))),
+        'emit_angle_variance': math.radians(float(data('angleVariance'))),
+        'start_rotation': math.radians(float(data('rotationStart'))),
+        'start_rotation_variance': math.radians(float(data('rotationStartVariance'))),
+        'end_rotation': math.radians(float(data('rotationEnd'))),
+        'end_rotation_variance': math.radians(float(data('rotationEndVariance'))),
+        'speed': float(data('speed')),
+        'speed_variance': float(data('speedVariance')),
+        'radial_acceleration': float(data('radialAcceleration')),
+        'radial_acceleration_variance': float(data('radialAccelVariance')),
+        'tangential_acceleration': float(data('tangentialAcceleration')),
+        'tangential_acceleration_variance': float(data('tangentialAccelVariance')),
+        'max_radius': float(data('maxRadius')),
+        'max_radius_variance': float(data('maxRadiusVariance')),
+        'min_radius': float(data('minRadius')),
+        'rotate_per_second': math.radians(float(data('rotatePerSecond'))),
+        'rotate_per_second_variance': math.radians(float(data('rotatePerSecondVariance'))),
+        'start_color': color('startColor'),
+        'start_color_variance': color('startColorVariance'),
+        'end_color': color('finishColor'),
+        'end_color_variance': color('finishColorVariance'),
+        'blend_factor_source': int(data('blendFuncSource')),
+        'blend_factor_dest': int(data('blendFuncDestination')),
+    }
+
+
+class ParticleSimulation(object):
+    """
+    Particle state stored as a structure of arrays: ``state[FIELD, i]`` is one attribute of
+    particle *i*. Live particles always occupy columns ``0 .. count-1``; dead particles are
+    compacted away after every step, so emission and integration are whole-array numpy operations.
+
+    Emission parameters are read from an *emitter* object with the same attribute names as
+    :class:`ParticleSystem` (which is what normally gets passed in).
+    """
+
+    def __init__(self, capacity, px=1.0, texture_width=1.0, seed=None):
+        """
+        :param capacity: the maximum number of live particles. Storage for them is allocated up front.
+        :param px: the size of a pixel (see ``kivy.metrics.sp``). Scales speeds and sizes.
+        :param texture_width: the width of the particle texture. Particle scale is relative to it.
+        :param seed: optional seed for the random number generator.
+        """
+        super(ParticleSimulation, self).__init__()
+        self.px = px
+        self.texture_width = texture_width
+        self.rng = np.random.default_rng(seed)
+        self.count = 0
+        self.limit = int(capacity)
+        self.state = np.zeros((NUM_FIELDS, int(capacity)))
+
+    @property
+    def capacity(self):
+        """
+        The number of particles the preallocated storage can hold.
+        """
+        return self.state.shape[1]
+
+    def set_limit(self, limit):
+        """
+        Sets the maximum number of live particles. Storage is only reallocated if *limit* is
+        above the current capacity; it never shrinks, so toggling the limit doesn't allocate.
+        If lowered below the number of live particles, the most recently emitted ones are dropped.
+        """
+        limit = int(limit)
+        if limit > self.capacity:
+            state = np.zeros((NUM_FIELDS, limit))
+            state[:, :self.count] = self.state[:, :self.count]
+            self.state = state
+        self.limit = limit
+        self.count = min(self.count, limit)
+
+    def clear(self):
+        """Kills all particles."""
+        self.count = 0
+
+    def emit(self, emitter, ages):
+        """
+        Emits one particle per entry of *ages*, as many as fit under the limit.
+
+        :param emitter: object providing the emission parameters (see :class:`ParticleSystem`).
+        :param ages: array of how long ago each new particle was emitted. Each particle is
+            advanced by its own age so that particles emitted within one frame don't clump.
+
+        :returns: the number of particles actually emitted.
+        """
+        n = min(len(ages), self.limit - self.count)
+        if n <= 0:
+            return 0
+
+        lo, hi = self.count, self.count + n
+        s = self.state[:, lo:hi]
+        rand = self.rng.uniform(-1.0, 1.0, (14, n))
+
+        def variance(i, base, var):
+            return base + var * rand[i]
+
+        life_span = variance(0, emitter.life_span, emitter.life_span_variance)
+        # particles with no life die on the next step
+        life_span = np.maximum(life_span, 0.0)
+        safe_life = np.where(life_span > 0.0, life_span, 1.0)
+        s[CURRENT_TIME] = 0.0
+        s[TOTAL_TIME] = life_span
+
+        s[X] = variance(1, emitter.emitter_x, emitter.emitter_x_variance)
+        s[Y] = variance(2, emitter.emitter_y, emitter.emitter_y_variance)
+        s[START_X] = emitter.emitter_x
+        s[START_Y] = emitter.emitter_y
+
+        angle = variance(3, emitter.emit_angle, emitter.emit_angle_variance)
+        speed = variance(4, emitter.speed, emitter.speed_variance) * self.px
+        s[VELOCITY_X] = speed * np.cos(angle)
+        s[VELOCITY_Y] = speed * np.sin(angle)
+
+        s[EMIT_RADIUS] = variance(5, emitter.max_radius, emitter.max_radius_variance)
+        s[EMIT_RADIUS_DELTA] = (emitter.max_radius - emitter.min_radius) / safe_life
+
+        s[EMIT_ROTATION] = variance(6, emitter.emit_angle, emitter.emit_angle_variance)
+        s[EMIT_ROTATION_DELTA] = variance(7, emitter.rotate_per_second, emitter.rotate_per_second_variance)
+
+        s[RADIAL_ACCEL] = variance(8, emitter.radial_acceleration, emitter.radial_acceleration_variance)
+        s[TANGENT_ACCEL] = variance(9, emitter.tangential_acceleration, emitter.tangential_acceleration_variance)
+
+        start_size = np.maximum(0.1, variance(10, emitter.start_size, emitter.start_size_variance)) * self.px
+        end_size = np.maximum(0.1, variance(11, emitter.end_size, emitter.end_size_variance)) * self.px
+        s[SCALE] = start_size / self.texture_width
+        s[SCALE_DELTA] = ((end_size - start_size) / safe_life) / self.texture_width
+
+        # colors
+        color_rand = self.rng.uniform(-1.0, 1.0, (2, 4, n))
+        start_color = np.clip(np.asarray(emitter.start_color, dtype=float)[:, None] +
+                              np.asarray(emitter.start_color_variance, dtype=float)[:, None] * color_rand[0], 0.0, 1.0)
+        end_color = np.clip(np.asarray(emitter.end_color, dtype=float)[:, None] +
+                            np.asarray(emitter.end_color_variance, dtype=float)[:, None] * color_rand[1], 0.0, 1.0)
+        s[COLOR] = start_color
+        s[COLOR_DELTA] = (end_color - start_color) / safe_life
+
+        # rotation
+        start_rotation = variance(12, emitter.start_rotation, emitter.start_rotation_variance)
+        end_rotation = variance(13, emitter.end_rotation, emitter.end_rotation_variance)
+        s[ROTATION] = start_rotation
+        s[ROTATION_DELTA] = (end_rotation - start_rotation) / safe_life
+
+        self.count = hi
+        self._advance(emitter, s, np.asarray(ages[:n], dtype=float))
+        return n
+
+    def advance(self, emitter, passed_time):
+        """
+        Advances all live particles by *passed_time* seconds and compacts away the ones that died.
+        """
+        if self.count:
+            self._advance(emitter, self.state[:, :self.count], passed_time)
+        self.compact()
+
+    def compact(self):
+        """Moves live particles to the front of the arrays, preserving their order."""
+        n = self.count
+        alive = self.state[CURRENT_TIME, :n] < self.state[TOTAL_TIME, :n]
+        k = int(np.count_nonzero(alive))
+        if k != n:
+            self.state[:, :k] = self.state[:, :n][:, alive]
+            self.count = k
+
+    def _advance(self, emitter, s, passed_time):
+        passed_time = np.minimum(passed_time, s[TOTAL_TIME] - s[CURRENT_TIME])
+        s[CURRENT_TIME] += passed_time
+
+        if emitter.emitter_type == EMITTER_TYPE_RADIAL:
+            s[EMIT_ROTATION] += s[EMIT_ROTATION_DELTA] * passed_time
+            s[EMIT_RADIUS] -= s[EMIT_RADIUS_DELTA] * passed_time
+            s[X] = emitter.emitter_x - np.cos(s[EMIT_ROTATION]) * s[EMIT_RADIUS]
+            s[Y] = emitter.emitter_y - np.sin(s[EMIT_ROTATION]) * s[EMIT_RADIUS]
+
+            done = s[EMIT_RADIUS] < emitter.min_radius
+            s[CURRENT_TIME] = np.where(done, s[TOTAL_TIME], s[CURRENT_TIME])
+
+        else:
+            distance_x = s[X] - s[START_X]
+            distance_y = s[Y] - s[START_Y]
+            distance_scalar = np.maximum(np.hypot(distance_x, distance_y), 0.01)
+
+            radial_x = distance_x / distance_scalar
+            radial_y = distance_y / distance_scalar
+
+            # tangential direction is the radial direction rotated by 90 degrees
+            accel_x = emitter.gravity_x + radial_x * s[RADIAL_ACCEL] - radial_y * s[TANGENT_ACCEL]
+            accel_y = emitter.gravity_y + radial_y * s[RADIAL_ACCEL] + radial_x * s[TANGENT_ACCEL]
+
+            s[VELOCITY_X] += passed_time * accel_x
+            s[VELOCITY_Y] += passed_time * accel_y
+
+            s[X] += s[VELOCITY_X] * passed_time
+            s[Y] += s[VELOCITY_Y] * passed_time
+
+        s[SCALE] += s[SCALE_DELTA] * passed_time
+        s[ROTATION] += s[ROTATION_DELTA] * passed_time
+
+        s[COLOR] += s[COLOR_DELTA] * passed_time
@@ -0,0 +1,155 @@
+#####################################################################
+#
+# This software is to be used for MIT's class Interactive Music Systems only.
+# Since this file may contain answers to homework problems, you MAY NOT release it publicly.
+#
+#####################################################################
+
+
+import os
+import sys
+import threading
+import time
+
+
+class SamplingProfiler(object):
+    """
+    Statistical profiler for a running app. A background thread looks at the stack of every
+    other thread (``sys._current_frames()``) *rate* times per second and counts each distinct
+    stack, per thread. Nothing in the profiled code is instrumented, so apart from the GIL
+    taken by each sample, the app runs at full speed: unlike ``cProfile``, the timings it
+    shows stay true.
+
+    :meth:`write` saves the counts as collapsed stacks, one line per stack:
+    ``thread;outer_function;...;inner_function count``, the input of flame graph tools
+    (``flamegraph.pl``, speedscope, ...). The main thread is named ``ui``: it runs kivy's
+    frame loop, and with it :class:`imslib.audio.Audio`'s input and output.
+    """
+
+    def __init__(self, rate = 200, path = None):
+        """
+        :param rate: samples per second. While another thread keeps the CPU busy, each sample
+            waits for it to release the GIL, which limits the rate to about one sample per
+            ``sys.getswitchinterval()`` (5ms).
+
+        :param path: if given, every :meth:`stop` writes all the samples so far there.
+        """
+        super(SamplingProfiler, self).__init__()
+        self.interval = 1.0 / rate
+        self.path = path
+        self.counts = {}  # (thread name, stack of code objects) -> number of samples
+        self.num_samples = 0
+        self.duration = 0.0
+        self.thread = None
+        self.running = False
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if not self.running:
+            return
+        self.running = False
+        self.thread.join()
+        self.thread = None
+        if self.path is not None:
+            num_samples = self.write(self.path)
+            print(f'profiler: wrote {num_samples} samples to {self.path}')
+
+    def toggle(self):
+        """:returns: True if the profiler is now running."""
+        if self.running:
+            self.stop()
+        else:
+            self.start()
+        return self.running
+
+    def clear(self):
+        self.counts = {}
+        self.num_samples = 0
+        self.duration = 0.0
+
+    def _run(self):
+        own = threading.get_ident()
+        main = threading.main_thread().ident
+        names = {}
+        start = time.perf_counter()
+        next_sample = start
+        while self.running:
+            frames = sys._current_frames()
+            if not names.keys() >= frames.keys():
+                names = {t.ident: t.name for t in threading.enumerate()}
+                names[main] = 'ui'
+
+            for ident, frame in frames.items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(frame.f_code)
+                    frame = frame.f_back
+                key = (names.get(ident, str(ident)), tuple(stack))
+                self.counts[key] = self.counts.get(key, 0) + 1
+            self.num_samples += 1
+            del frames
+
+            # keep to the rate on average, without catching up after a stall
+            next_sample = max(next_sample + self.interval, time.perf_counter())
+            time.sleep(max(0.0, next_sample - time.perf_counter()))
+        self.duration += time.perf_counter() - start
+
+    @staticmethod
+    def _describe(code):
+        filename = os.path.basename(code.co_filename)
+        return f'{code.co_name} ({filename}:{code.co_firstlineno})'
+
+    def get_stacks(self):
+        """
+        :returns: a dictionary of ``"thread;outer;...;inner"`` -> number of samples, merging
+            the stacks that only differ by line.
+        """
+        # copied, since the sampling thread may be adding to it
+        counts = dict(self.counts)
+        stacks = {}
+        for (thread, codes), count in counts.items():
+            names = [thread] + [self._describe(c) for c in reversed(codes)]
+            stack = ';'.join(n.replace(';', ':') for n in names)
+            stacks[stack] = stacks.get(stack, 0) + count
+        return stacks
+
+    def write(self, path):
+        """
+        Writes the collapsed stacks of all samples so far to *path*, most frequent first.
+
+        :returns: the number of samples written.
+        """
+        stacks = self.get_stacks()
+        with open(path, 'w') as f:
+            for stack, count in sorted(stacks.items(), key=lambda x: -x[1]):
+                f.write(f'{stack} {count}\n')
+        return self.num_samples
+
+    def summary(self, top = 10):
+        """
+        :returns: text listing, for each thread, the functions that were running (innermost
+            frame) in the most samples.
+        """
+        own = {}
+        totals = {}
+        for (thread, codes), count in dict(self.counts).items():
+            totals[thread] = totals.get(thread, 0) + count
+            if codes:
+                key = (thread, self._describe(codes[0]))
+                own[key] = own.get(key, 0) + count
+
+        lines = [f'{self.num_samples} samples over {self.duration:.1f}s']
+        for thread, total in sorted(totals.items(), key=lambda x: -x[1]):
+            lines.append(f'thread {thread}:')
+            functions = sorted(((c, f) for (t, f), c in own.items() if t == thread), reverse=True)
+            for count, function in functions[:top]:
+                lines.append(f'  {100 * count / total:5.1f}%  {function}')
+        return '\n'.join(lines)
@@ -49,7 +49,7 @@ class WaveFile(object):
         raw_bytes = self.wave.readframes(num_frames)
 
         # convert raw data to numpy array, assuming int16 arrangement
-        samples = np.fromstring(raw_bytes, dtype = np.int16)
+        samples = np.frombuffer(raw_bytes, dtype = np.int16)
 
         # convert from integer type to floating point, and scale to [-1, 1]
         samples = samples.astype(float)
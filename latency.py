@@ -0,0 +1,236 @@
+# latency instrumentation. A LatencyProbe timestamps every analysis hop as it goes through
+# the game's pipeline:
+#
+#   capture   when the last sample of the hop reached the microphone (estimated from the
+#             input callback and the input latency reported by the audio backend)
+#   input     the input callback that delivered it (Audio.on_update -> receive_audio)
+#   hop       AudioBuffer handed the complete hop to PitchDetector.process
+#   pitch     aubio returned its pitch
+#   frame     GameScreen.on_update passed the reading to GameDisplay
+#   draw      the frame was drawn (kivy's Window.on_flip)
+#
+# loopback_test() measures the audio-time side of the pipeline: it plays tone bursts through
+# a loopback FileBackend and times how long the pitch detector takes to report them.
+
+import time
+
+import numpy as np
+
+from imslib.audio import Audio, FileBackend
+
+STAGES = ("capture", "input", "hop", "pitch", "frame", "draw")
+
+PERCENTILES = (50, 90, 99)
+
+
+def percentiles(values, percents=PERCENTILES):
+    """
+    :returns: a dictionary of ``"p<percent>"`` (and ``"max"``, ``"count"``) for *values*,
+        ignoring NaNs. Empty if there are none.
+    """
+    values = np.asarray(values, dtype=float)
+    values = values[~np.isnan(values)]
+    if len(values) == 0:
+        return {}
+    stats = np.percentile(values, percents)
+    result = {"p{}".format(p): float(v) for p, v in zip(percents, stats)}
+    result["max"] = float(values.max())
+    result["count"] = len(values)
+    return result
+
+
+class LatencyProbe(object):
+    """
+    Collects per-hop timestamps (``time.perf_counter()``) for each of :data:`STAGES`. The last
+    *size* hops are kept.
+    """
+
+    def __init__(self, size=10000):
+        super(LatencyProbe, self).__init__()
+        self.times = np.full((size, len(STAGES)), np.nan)
+        self.count = 0
+        # rows waiting for the next stage: read but not consumed by a frame, consumed but not
+        # drawn yet
+        self.unconsumed = []
+        self.undrawn = []
+
+        # reported by the audio backend (see Audio.get_latency)
+        self.input_latency = 0.0
+        self.output_latency = 0.0
+        self.input_time = None
+
+    def set_audio_latency(self, latency):
+        """
+        :param latency: ``(input_latency, output_latency)`` in seconds.
+        """
+        self.input_latency, self.output_latency = latency
+
+    def input(self):
+        """Records that the input callback ran."""
+        self.input_time = time.perf_counter()
+
+    def hop(self, samples_after):
+        """
+        Records a hop handed to the pitch detector.
+
+        :param samples_after: how many samples the last input callback delivered after the
+            hop's last one.
+
+        :returns: the hop's row, for :meth:`mark`.
+        """
+        row = self.count % len(self.times)
+        self.count += 1
+        now = time.perf_counter()
+        t = self.times[row]
+        t[:] = np.nan
+        t[0] = self.input_time - samples_after / Audio.sample_rate - self.input_latency
+        t[1] = self.input_time
+        t[2] = now
+        return row
+
+    def mark(self, row, stage):
+        self.times[row, STAGES.index(stage)] = time.perf_counter()
+        if stage == "pitch":
+            self.unconsumed.append(row)
+
+    def consumed(self):
+        """Marks the hops read so far as consumed by a frame."""
+        now = time.perf_counter()
+        for row in self.unconsumed:
+            self.times[row, STAGES.index("frame")] = now
+        self.undrawn.extend(self.unconsumed)
+        self.unconsumed = []
+
+    def drawn(self, *args):
+        """Marks the consumed hops as drawn. Can be bound to ``Window.on_flip``."""
+        now = time.perf_counter()
+        for row in self.undrawn:
+            self.times[row, STAGES.index("draw")] = now
+        self.undrawn = []
+
+    def report(self):
+        """
+        :returns: a dictionary of :func:`percentiles` (in ms) of the time between consecutive
+            stages (``"input-hop"``, ...), of ``"capture-draw"``, the time from the voice to
+            the indicator, and of the backend's reported latencies (in ms).
+        """
+        times = self.times[: min(self.count, len(self.times))]
+        report = {}
+        for i in range(len(STAGES) - 1):
+            name = "{}-{}".format(STAGES[i], STAGES[i + 1])
+            report[name] = percentiles(1000 * (times[:, i + 1] - times[:, i]))
+        report["capture-draw"] = percentiles(1000 * (times[:, -1] - times[:, 0]))
+        report["input_latency"] = 1000 * self.input_latency
+        # how far ahead of what is heard the song clock runs (see AudioController.get_time)
+        report["output_latency"] = 1000 * self.output_latency
+        return report
+
+    def format_report(self):
+        lines = ["latency (ms) over {} hops:".format(min(self.count, len(self.times)))]
+        for name, stats in self.report().items():
+            if isinstance(stats, dict):
+                values = " ".join(
+                    "{}={:.2f}".format(k, v) for k, v in stats.items() if k != "count"
+                )
+                lines.append("  {:<14} {}".format(name, values or "no data"))
+            else:
+                lines.append("  {:<14} {:.2f}".format(name, stats))
+        return "\n".join(lines)
+
+
+class ToneBursts(object):
+    """
+    Generator of sine bursts: *length* seconds at *pitch* (midi) every *period* seconds,
+    starting one period in.
+    """
+
+    def __init__(self, pitch=69, period=1.0, length=0.3, gain=0.5):
+        super(ToneBursts, self).__init__()
+        self.freq = 440 * 2 ** ((pitch - 69) / 12.0)
+        self.period = period
+        self.length = length
+        self.gain = gain
+        self.frame = 0
+
+    def onsets(self, duration):
+        """:returns: the start times of the bursts played in the first *duration* seconds."""
+        return np.arange(self.period, duration, self.period)
+
+    def generate(self, num_frames, num_channels):
+        t = (self.frame + np.arange(num_frames)) / Audio.sample_rate
+        self.frame += num_frames
+        phase = t - self.period * np.floor(t / self.period)
+        on = (phase < self.length) & (t >= self.period)
+        data = np.where(on, self.gain * np.sin(2 * np.pi * self.freq * t), 0.0)
+        return np.repeat(data, num_channels).astype(np.float32), True
+
+
+def loopback_test(
+    detector,
+    duration=10.0,
+    input_latency=0.005,
+    output_latency=0.02,
+    probe=None,
+    pitch=69,
+    min_confidence=0.7,
+):
+    """
+    Plays :class:`ToneBursts` through a loopback :class:`FileBackend` with the given simulated
+    latencies, feeds the input to *detector* and times when each burst is first detected.
+
+    :param detector: a pitch detector like the game's PitchDetector: ``insert(data, time)``
+        and ``get_readings()``. Given a *probe*, it should report its hops to it.
+
+    :returns: a dictionary with :func:`percentiles` (in ms) of ``"round_trip"``, from each
+        burst being generated to its detection, in audio time; of ``"compensated"``, the same
+        minus the latency reported by the backend, which leaves the detector's own delay; and
+        the number of bursts ``"missed"``.
+    """
+    previous = Audio.backend
+    backend = FileBackend(
+        loopback=True,
+        keep_output=False,
+        input_latency=input_latency,
+        output_latency=output_latency,
+    )
+    Audio.backend = backend
+    try:
+        def receive_audio(frames, num_channels):
+            # timestamped with the input stream's clock, as the game does with the song's
+            detector.insert(frames, audio.stream.read_frame / Audio.sample_rate)
+
+        audio = Audio(1, input_func=receive_audio, num_input_channels=1)
+        bursts = ToneBursts(pitch)
+        audio.set_generator(bursts)
+        if probe is not None:
+            probe.set_audio_latency(audio.get_latency())
+
+        readings = []
+        num_updates = int(np.ceil(duration * Audio.sample_rate / Audio.buffer_size))
+        for _ in range(num_updates):
+            audio.on_update()
+            readings.append(detector.get_readings())
+            if probe is not None:
+                probe.consumed()
+        audio._close()
+    finally:
+        Audio.backend = previous
+
+    readings = np.concatenate(readings)
+    times, pitches, confidences, _ = readings.T
+    heard = times[(confidences >= min_confidence) & (np.abs(pitches - pitch) < 0.5)]
+
+    onsets = bursts.onsets(duration - bursts.length)
+    idx = np.searchsorted(heard, onsets)
+    found = idx < len(heard)
+    delays = np.full(len(onsets), np.nan)
+    delays[found] = heard[idx[found]] - onsets[found]
+    # a detection after the burst that follows is not this burst's
+    delays[delays > bursts.period] = np.nan
+
+    reported = sum(backend.get_latency())
+    return {
+        "round_trip": percentiles(1000 * delays),
+        "compensated": percentiles(1000 * (delays - reported)),
+        "missed": int(np.sum(np.isnan(delays))),
+    }
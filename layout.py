@@ -0,0 +1,147 @@
+# layout of the game view. Every on-screen element of GameDisplay is positioned
+# relative to the background artwork, which keeps a fixed aspect ratio and is
+# letterboxed into the window. GameLayout computes the absolute anchors once per
+# window size so the display objects can move their instructions in place.
+
+from kivy.clock import Clock as kivyClock
+
+# etablish relative positioning factors (fractions of the background artwork)
+now_height = 0.2282
+now_cent = 0.3402
+now_width = 0.002
+record_x = 0.3975
+record_y = 0.5800
+ind_size = 0.05
+
+# height / width of the background artwork
+img_aspect = 0.7307
+
+# how fast notes scroll towards the nowbar, in pixels per second
+scroll_speed = 300
+
+# how long the window size must stay unchanged before a resize is applied
+resize_delay = 0.1
+
+# pixels between the volume bars of the singers (the bars are 25 pixels wide)
+volume_spacing = 30
+
+
+class GameLayout(object):
+    """
+    Absolute anchors of the game view for a given window size. Anchors are plain
+    attributes, recomputed by :meth:`update` and read by the display objects.
+
+    With several singers, the note lane is split into *num_lanes* lanes stacked along the
+    nowbar, and each singer's display has a layout for its own lane (*lane_index*, from the
+    top). The artwork and the nowbar are the same in all of them.
+    """
+
+    def __init__(self, win_size, min_pitch, max_pitch, lane_index=0, num_lanes=1):
+        """
+        :param win_size: ``(width, height)`` of the window.
+        :param min_pitch: lowest pitch of the chart, drawn at the bottom of the note lane.
+        :param max_pitch: highest pitch of the chart, drawn at the top of the note lane.
+        :param lane_index: which of the *num_lanes* lanes this layout is for.
+        :param num_lanes: number of lanes sharing the nowbar.
+        """
+        super(GameLayout, self).__init__()
+        self.min_pitch = min_pitch
+        self.max_pitch = max_pitch
+        self.lane_index = lane_index
+        self.num_lanes = num_lanes
+        self.win_size = (0, 0)
+        self.update(win_size)
+
+    def update(self, win_size):
+        """
+        Recomputes every anchor for a new window size.
+
+        :param win_size: ``(width, height)`` of the window.
+
+        :returns: True if the anchors changed, False if *win_size* was already applied.
+        """
+        win_size = (win_size[0], win_size[1])
+        if win_size == self.win_size:
+            return False
+        self.win_size = win_size
+        w, h = win_size
+
+        # letterboxed background artwork
+        if h > img_aspect * w:
+            self.img_size = (w, img_aspect * w)
+        else:
+            self.img_size = (h / img_aspect, h)
+        img_w, img_h = self.img_size
+        self.img_origin = ((w - img_w) / 2, (h - img_h) / 2)
+        self.img_cent = (w / 2, h / 2)
+
+        # the nowbar and the note lane that runs to its right
+        self.now_x = record_x * img_w + self.img_origin[0]
+        self.now_y = now_cent * img_h + self.img_origin[1]
+        self.nowbar_size = (now_width * img_w, now_height * img_h)
+        self.lane_height = now_height * img_h / self.num_lanes
+        lane_top = self.now_y + now_height * img_h / 2
+        self.lane_origin = (self.now_x, lane_top - (self.lane_index + 1) * self.lane_height)
+        self.lane_size = (w - self.now_x, self.lane_height)
+        self.divisions = self.lane_height / (self.max_pitch - self.min_pitch + 1)
+
+        # center of the spinning record
+        self.record_cent = (self.now_x, record_y * img_h + self.img_origin[1])
+
+        updated_size = min(ind_size * w, ind_size * h)
+        self.ind_size = (updated_size, updated_size)
+
+        # hud elements are relative to the window itself. The singers' scores are listed
+        # from the top, and their volume bars side by side, the first one leftmost.
+        lanes_after = self.num_lanes - 1 - self.lane_index
+        self.scoreboard_cpos = (
+            4 * w / 5 - volume_spacing * (self.num_lanes - 1),
+            (9 / 10 - self.lane_index / 20) * h,
+        )
+        self.return_home_cpos = (8 * w / 10, 1 * h / 10)
+        self.volume_pos = (9 * w / 10 - volume_spacing * lanes_after, 8.5 * h / 10)
+        return True
+
+    def time_to_xpos(self, time):
+        """
+        :param time: seconds until the nowbar (negative once past it).
+        :returns: x position of that moment in the note lane.
+        """
+        return self.now_x + time * scroll_speed
+
+    def pitch_to_ypos(self, pitch):
+        """
+        :returns: y position of *pitch* in the note lane.
+        """
+        return self.lane_origin[1] + self.divisions * (pitch - self.min_pitch + 1)
+
+
+class ResizeDebouncer(object):
+    """
+    Collapses a burst of resize events (ie, dragging the window edge) into a single
+    call of *apply_func* with the last window size, once the size has stopped
+    changing for *delay* seconds.
+    """
+
+    def __init__(self, apply_func, delay=resize_delay):
+        super(ResizeDebouncer, self).__init__()
+        self.apply_func = apply_func
+        self.win_size = None
+        self.event = kivyClock.create_trigger(self._apply, delay)
+
+    def on_resize(self, win_size):
+        self.win_size = win_size
+        # restart the countdown on every event
+        self.event.cancel()
+        self.event()
+
+    def flush(self):
+        """Applies a pending resize right away."""
+        if self.win_size is not None:
+            self.event.cancel()
+            self._apply(0)
+
+    def _apply(self, _dt):
+        win_size, self.win_size = self.win_size, None
+        if win_size is not None:
+            self.apply_func(win_size)
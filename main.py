@@ -7,10 +7,31 @@ import sys, os
 
 sys.path.insert(0, os.path.abspath(".."))
 
-from imslib.core import BaseWidget, run, lookup
-from imslib.audio import Audio
-from imslib.gfxutil import topleft_label, CLabelRect, CEllipse, Line, CRectangle
+# command line arguments are the game's (see the bottom of this file), not kivy's
+os.environ.setdefault("KIVY_NO_ARGS", "1")
+
+from imslib.core import (
+    BaseWidget,
+    run,
+    lookup,
+    register_terminate_func,
+    metrics,
+    GCPolicy,
+    gc_policy,
+)
+from imslib.audio import Audio, FileBackend
+from imslib.gfxutil import (
+    topleft_label,
+    CLabelRect,
+    CGlyphLabel,
+    CEllipse,
+    Line,
+    CRectangle,
+    MetricsHUD,
+)
 from imslib.mixer import Mixer
+from imslib.clock import AudioClock
+from imslib.profiler import SamplingProfiler
 from kivy.clock import Clock as kivyClock
 from kivy.core.window import Window
 from kivy.graphics.instructions import InstructionGroup
@@ -24,21 +45,23 @@ from kivy.graphics import PushMatrix, PopMatrix, Scale, Rotate, Translate
 from librosa import feature
 from imslib.screen import Screen, ScreenManager
 from kivy.uix.button import Button
-
+from layout import GameLayout, ResizeDebouncer
+from songlib import SongIndex
+import pitchtrack
+from scoring import ScoringEngine, RangeDetector
+from smoothing import PitchSmoother
+import sessionlog
+from latency import LatencyProbe
+import songpkg
+
+import argparse
 import math
+import time
 
 
 import numpy as np
 import aubio
 
-# etablish relative positioning factors
-now_height = 0.2282
-now_cent = 0.3402
-now_width = 0.002
-record_x = 0.3975
-record_y = 0.5800
-ind_size = 0.05
-
 
 class AudioBuffer(object):
     """converts a variable buffer size to a fixed buffer size. Audio data is received
@@ -78,102 +101,136 @@ class PitchDetector(object):
     When enough input data has come in to produce a reading, that reading is stored in
     self.pitch and a confidence stored in self.conf"""
 
-    def __init__(self):
+    def __init__(
+        self, hop_size=pitchtrack.HOP_SIZE, probe=None, method=pitchtrack.METHOD
+    ):
+        """
+        :param hop_size: samples per reading. Defaults to the game's.
+        :param probe: optional :class:`latency.LatencyProbe` to report each hop to.
+        :param method: pitch detection method, one of ``pitchtrack.METHODS``. Defaults to
+            the game's.
+        """
         super(PitchDetector, self).__init__()
 
-        self.buf_size = 4096  # the algorithm's window size
-        self.hop_size = (
-            1024  # this is the amount we feed into aubio.pitch at each time step
-        )
+        # window and hop sizes, and the pitch method's configuration, are shared with the
+        # offline chart generator (see pitchtrack.py)
+        self.buf_size = pitchtrack.BUF_SIZE  # the algorithm's window size
+        self.hop_size = hop_size  # the amount fed into the pitch method at each step
+        self.method = method
+        self.probe = probe
 
         self.buffer = AudioBuffer(self.hop_size, self.process)
 
-        self.pitch_o = aubio.pitch(
-            "yin", self.buf_size, self.hop_size, Audio.sample_rate
+        self.pitch_o = pitchtrack.make_pitch_o(
+            Audio.sample_rate,
+            method=method,
+            buf_size=self.buf_size,
+            hop_size=self.hop_size,
         )
-        self.pitch_o.set_tolerance(0.5)
-        self.pitch_o.set_unit("midi")
 
         self.pitch = 0
         self.conf = 0
 
         self.volume = 0
 
-    def insert(self, data):
+        # every reading since the last get_readings(), as
+        # (song time at the end of the hop, pitch, confidence, volume)
+        self.readings = []
+        self.insert_time = None
+        self.pending = 0
+
+    def insert(self, data, time=None):
+        """
+        :param time: song time at the end of *data*, used to timestamp the readings. Readings
+            are only kept when it is given.
+        """
+        self.insert_time = time
+        if self.probe is not None:
+            self.probe.input()
+        # samples left to process, counting the ones buffered from the previous insert
+        self.pending = len(self.buffer.buffer) + len(data)
+        metrics.begin("pitch")
         self.buffer.insert(data)
+        metrics.end("pitch")
 
     def process(self, data):
         assert len(data) == self.hop_size
+        if self.probe is not None:
+            row = self.probe.hop(self.pending - self.hop_size)
         self.pitch = self.pitch_o(data)[0]
         self.conf = self.pitch_o.get_confidence()
+        if self.probe is not None:
+            self.probe.mark(row, "pitch")
         self.volume = feature.rms(y=data)[0][0] * 500
 
+        self.pending -= self.hop_size
+        if self.insert_time is not None:
+            time = self.insert_time - self.pending / Audio.sample_rate
+            self.readings.append((time, self.pitch, self.conf, self.volume))
+
+    def get_readings(self):
+        """
+        :returns: the readings made since the last call, as an array of shape ``(n, 4)`` with
+            columns time, pitch, confidence and volume.
+        """
+        readings, self.readings = self.readings, []
+        return np.array(readings, dtype=float).reshape(-1, 4)
+
 
 class PitchIndicator(InstructionGroup):
-    def __init__(self, min_pitch, max_pitch):
+    def __init__(self, layout):
         super(PitchIndicator, self).__init__()
 
         self.pitch = 60
         self.confidence = 0
-        self.base_pitch = 48
-        self.recent_sung = []
 
-        w = Window.width
-        h = Window.height
+        self.layout = layout
+        self.min_pitch = layout.min_pitch
+        self.max_pitch = layout.max_pitch
 
-        self.ind_size = (ind_size * w, ind_size * h)
-        self.ind_cent = (record_x * w, now_cent * h - now_height / 2 * h)
-        self.texture = Image("failarrow.png").texture
+        # arrow textures are loaded once and swapped when the player hits / misses
+        self.textures = {
+            "hit": Image("arrow.png").texture,
+            "fail": Image("failarrow.png").texture,
+        }
+        self.texture = self.textures["fail"]
 
-        self.min_pitch = min_pitch
-        self.max_pitch = max_pitch
-        self.divisions = now_height * h / (self.max_pitch - self.min_pitch + 1)
+        self.color = Color(1, 0, 0)
+        self.add(self.color)
 
         self.indicator = CRectangle(
             texture=self.texture,
-            csize=self.ind_size,
-            cpos=(self.ind_cent[0], self.ind_cent[1]),
+            csize=layout.ind_size,
+            cpos=layout.lane_origin,
         )
         self.add(self.indicator)
 
+    def set_look(self, rgb, texture_name):
+        self.color.rgb = rgb
+        texture = self.textures[texture_name]
+        if texture is not self.texture:
+            self.texture = texture
+            self.indicator.texture = texture
+
+    def pitch_to_ypos(self, pitch):
+        ind_y = self.layout.lane_origin[1]
+        if pitch < self.min_pitch:
+            return ind_y + self.min_pitch
+        elif pitch > self.max_pitch:
+            return self.layout.pitch_to_ypos(self.max_pitch)
+        return self.layout.pitch_to_ypos(pitch)
+
     def on_update(self, pitch, confidence, sung_volume):
         self.pitch = pitch
         self.confidence = confidence
 
         if self.confidence >= 0.7 and sung_volume > 5:
-            ypos = self.ind_cent[1] + self.divisions * (self.pitch - self.min_pitch + 1)
-            if self.pitch < self.min_pitch:
-                ypos = self.ind_cent[1] + self.min_pitch
-            elif self.pitch > self.max_pitch:
-                ypos = self.ind_cent[1] + self.divisions * (
-                    self.max_pitch - self.min_pitch + 1
-                )
-
-            self.indicator.cpos = (self.ind_cent[0], ypos)
+            ypos = self.pitch_to_ypos(self.pitch)
+            self.indicator.cpos = (self.layout.now_x, ypos)
 
-    def on_resize(self, win_size):
-        w = win_size[0]
-        h = win_size[1]
-        updated_size = min(ind_size * w, ind_size * h)
-        self.ind_size = (updated_size, updated_size)
-        self.divisions = now_height * 0.7307 * w / (self.max_pitch - self.min_pitch + 1)
-        self.indicator.csize = self.ind_size
-
-        if h > 0.7307 * w:
-            ind_x = record_x * w
-            ind_y = (
-                now_cent * (0.7307 * w)
-                - (now_height * 0.7307 * w) / 2
-                + (h - 0.7307 * w) / 2
-            )
-            self.divisions = (
-                now_height * 0.7307 * w / (self.max_pitch - self.min_pitch + 1)
-            )
-        else:
-            ind_x = record_x * (h / 0.7307) + (w - h / 0.7307) / 2
-            ind_y = now_cent * h - now_height / 2 * h
-            self.divisions = now_height * h / (self.max_pitch - self.min_pitch + 1)
-        self.ind_cent = (ind_x, ind_y)
+    def on_layout(self):
+        self.indicator.csize = self.layout.ind_size
+        self.indicator.cpos = (self.layout.now_x, self.pitch_to_ypos(self.pitch))
 
 
 class LineDisplay(InstructionGroup):
@@ -181,11 +238,11 @@ class LineDisplay(InstructionGroup):
     Draws a single Line (rectangle) for pitch matching and moves it across the screen
     """
 
-    def __init__(self, pitch, start_time, duration, min_pitch, max_pitch):
+    def __init__(self, pitch, start_time, duration, layout):
         super(LineDisplay, self).__init__()
 
-        self.window_width = Window.width
-        self.window_height = Window.height
+        # shared anchors of the game view, updated in place on resize
+        self.layout = layout
 
         # will dictate the ypos of the rectangle on the screen
         self.pitch = pitch
@@ -195,9 +252,7 @@ class LineDisplay(InstructionGroup):
         self.duration = duration
 
         # default initialization of rectangle (can ignore)
-        self.line = Rectangle(
-            size=(50, 50), pos=(record_x * self.window_width, self.window_height / 2)
-        )
+        self.line = Rectangle(size=(50, 50), pos=(layout.now_x, layout.now_y))
 
         self.start_xpos = 0
         self.end_xpos = 0
@@ -209,144 +264,62 @@ class LineDisplay(InstructionGroup):
         # True if right of the nowbar, False if left of it
         self.active = True
 
-        self.ind_cent = (
-            record_x * self.window_width,
-            now_cent * self.window_height - now_height / 2 * self.window_height,
-        )
-        self.min_pitch = min_pitch
-        self.max_pitch = max_pitch
-        self.divisions = (
-            now_height * self.window_height / (self.max_pitch - self.min_pitch + 1)
-        )
-
-    def time_to_xpos(self, time):
-        speed = -300
-        return (self.window_width * record_x) - (time * speed)
-
-    def pitch_to_ypos(self, pitch):
-        return self.ind_cent[1] + self.divisions * (pitch - self.min_pitch + 1)
-
     def on_update(self, now_time):
-        self.start_xpos = self.time_to_xpos(self.start_time - now_time)
-        self.end_xpos = self.time_to_xpos(self.start_time - now_time + self.duration)
-        self.ypos = self.pitch_to_ypos(self.pitch)
+        layout = self.layout
+        self.start_xpos = layout.time_to_xpos(self.start_time - now_time)
+        self.end_xpos = layout.time_to_xpos(self.start_time - now_time + self.duration)
+        self.ypos = layout.pitch_to_ypos(self.pitch)
 
         # if within bounds of the screen, update position and return true
-        if self.start_xpos <= self.window_width and self.end_xpos >= 0:
+        if self.start_xpos <= layout.win_size[0] and self.end_xpos >= 0:
             self.line.pos = (self.start_xpos, self.ypos)
             self.line.size = (self.end_xpos - self.start_xpos, 10)
-            if self.end_xpos < self.ind_cent[0]:
+            if self.end_xpos < layout.now_x:
                 self.active = False
             return True
 
         if self.end_xpos < 0:
             return False
 
-    def on_resize(self, win_size):
-        w = win_size[0]
-        h = win_size[1]
-        self.window_width = w
-        self.window_height = h
-        self.divisions = now_height * h / (self.max_pitch - self.min_pitch + 1)
-        ind_x = record_x * w
-        ind_y = now_cent * h - now_height / 2 * h
-        if h > 0.7307 * w:
-            ind_y = (
-                now_cent * (0.7307 * w)
-                - (now_height * 0.7307 * w) / 2
-                + (h - 0.7307 * w) / 2
-            )
-            self.divisions = (
-                now_height * 0.7307 * w / (self.max_pitch - self.min_pitch + 1)
-            )
-        else:
-            ind_x = record_x * (h / 0.7307) + (w - h / 0.7307) / 2
-        self.ind_cent = (ind_x, ind_y)
-
 
 class RecordDisplay(InstructionGroup):
-    def __init__(self, song_choice):
+    def __init__(self, song, layout):
         super(RecordDisplay, self).__init__()
-        self.win_size = Window.width, Window.height
-        w, h = self.win_size
-        self.img_w = w * 1
-        self.img_h = 0.7307 * self.img_w
-
-        self.xcent = record_x * w
-        self.ycent = record_y * h
+        self.layout = layout
         self.angle = 0
         kivyClock.schedule_interval(self.on_update, 1.0 / 60.0)
 
-        if song_choice == "valerie":
-            self.bgtexture = Image("bg_valerie.png").texture
-            self.record_texture = Image("vinyl_valerie.png").texture
-        elif song_choice == "allstar":
-            self.bgtexture = Image("bg_allstar.png").texture
-            self.record_texture = Image("vinyl_allstar.png").texture
-        elif song_choice == "bohemian":
-            self.bgtexture = Image("bg_bohemian.png").texture
-            self.record_texture = Image("vinyl_bohemian.png").texture
+        self.bgtexture = Image(song.artwork["background"]).texture
+        self.record_texture = Image(song.artwork["record"]).texture
         self.armtexture = Image("tonearm.png").texture
 
-        self.bg = CRectangle(
-            texture=self.bgtexture,
-            csize=(self.img_w, self.img_h),
-            cpos=(self.xcent, self.ycent),
-        )
-        self.record = CRectangle(
-            texture=self.record_texture,
-            csize=(self.img_w, self.img_h),
-            cpos=(self.xcent, self.ycent),
-        )
-        self.arm = CRectangle(
-            texture=self.armtexture,
-            csize=(self.img_w, self.img_h),
-            cpos=(self.xcent, self.ycent),
-        )
+        self.bg = CRectangle(texture=self.bgtexture)
+        self.record = CRectangle(texture=self.record_texture)
+        self.arm = CRectangle(texture=self.armtexture)
 
         # Adding to canvas
         self.add(self.bg)
         self.add(PushMatrix())
-        self.rotation = Rotate(angle=self.angle, origin=(self.xcent, self.ycent))
+        self.rotation = Rotate(angle=self.angle)
         self.add(self.rotation)
         self.add(self.record)
 
         self.add(PopMatrix())
         self.add(self.arm)
 
-        self.nowbar = CRectangle(
-            csize=(5, now_height * self.img_h),
-            cpos=(record_x * self.img_w, now_cent * self.img_h),
-        )
+        self.nowbar = CRectangle()
         self.add(self.nowbar)
 
-    def on_resize(self, win_size):
-        # Calculate scale factors
-        w, h = win_size
-        if w / self.img_w < h / self.img_h:
-            scale = w / self.img_w
-        else:
-            scale = h / self.img_h
-
-        csize = (self.img_w * scale, self.img_h * scale)
-        cpos = (w / 2, h / 2)
-        self.bg.cpos = cpos
-        self.bg.csize = csize
-        self.record.cpos = cpos
-        self.record.csize = csize
-        self.arm.csize = csize
-        self.arm.cpos = cpos
-        self.nowbar.csize = (now_width * csize[0], now_height * csize[1])
-        self.nowbar.cpos = (
-            record_x * csize[0] + (w - csize[0]) / 2,
-            now_cent * csize[1] + (h - csize[1]) / 2,
-        )
-        self.xcent = record_x * csize[0] + (w - csize[0]) / 2
-        self.ycent = record_y * csize[1] + (h - csize[1]) / 2
-        self.rotation.origin = (self.xcent, self.ycent)
+        self.on_layout()
 
-        # update self.win_size to the new win_size
-        self.win_size = win_size
+    def on_layout(self):
+        layout = self.layout
+        for rect in (self.bg, self.record, self.arm):
+            rect.csize = layout.img_size
+            rect.cpos = layout.img_cent
+        self.nowbar.csize = layout.nowbar_size
+        self.nowbar.cpos = (layout.now_x, layout.now_y)
+        self.rotation.origin = layout.record_cent
 
     def on_update(self, dt):
         self.angle += dt * 30  # Adjust rotation speed as needed
@@ -354,195 +327,156 @@ class RecordDisplay(InstructionGroup):
 
 
 class InputVolumeDisplay(InstructionGroup):
-    def __init__(self):
+    def __init__(self, layout):
         super(InputVolumeDisplay, self).__init__()
 
-        self.window_width = Window.width
-        self.window_height = Window.height
+        self.layout = layout
 
         self.add(Color((1, 1, 1)))
-        self.outline_bar = Rectangle(
-            pos=(9 * self.window_width / 10, 8.5 * self.window_height / 10),
-            size=(25, 150),
-        )
+        self.outline_bar = Rectangle(size=(25, 150))
         self.add(self.outline_bar)
 
         self.add(Color(hsv=(0.39, 1, 1)))
-        self.loudness_bar = Rectangle(
-            pos=(9 * self.window_width / 10, 8.5 * self.window_height / 10),
-            size=(25, 0),
-        )
+        self.loudness_bar = Rectangle(size=(25, 0))
         self.add(self.loudness_bar)
 
         self.add(Color(1, 0, 0))
-        self.threshold_line = Rectangle(
-            pos=(9 * self.window_width / 10, (8.5 * self.window_height / 10) + 5),
-            size=(25, 2),
-        )
+        self.threshold_line = Rectangle(size=(25, 2))
         self.add(self.threshold_line)
 
+        self.on_layout()
+
     def on_update(self, sung_volume):
         self.loudness_bar.size = (25, sung_volume)
 
-    def on_resize(self, win_size):
-        self.window_width = win_size[0]
-        self.window_height = win_size[1]
-        self.remove(self.outline_bar)
-        self.outline_bar = Rectangle(
-            pos=(9 * self.window_width / 10, 8.5 * self.window_height / 10),
-            size=(25, 150),
-        )
-        self.add(Color((1, 1, 1)))
-        self.add(self.outline_bar)
-        self.remove(self.loudness_bar)
-        self.add(Color(hsv=(0.39, 1, 1)))
-        self.loudness_bar = Rectangle(
-            pos=(9 * self.window_width / 10, 8.5 * self.window_height / 10),
-            size=(25, 0),
-        )
-        self.add(self.loudness_bar)
-
-        self.remove(self.threshold_line)
-        self.add(Color(1, 0, 0))
-        self.threshold_line = Rectangle(
-            pos=(9 * self.window_width / 10, (8.5 * self.window_height / 10) + 5),
-            size=(25, 2),
-        )
-        self.add(self.threshold_line)
+    def on_layout(self):
+        x, y = self.layout.volume_pos
+        self.outline_bar.pos = (x, y)
+        self.loudness_bar.pos = (x, y)
+        self.threshold_line.pos = (x, y + 5)
 
 
 class GameDisplay(InstructionGroup):
-    def __init__(self, song_choice):
+    def __init__(
+        self,
+        song,
+        transpose=0,
+        octave_equivalent=False,
+        detect_range=True,
+        part="lead",
+        lane=0,
+        num_lanes=1,
+    ):
+        """
+        :param transpose: semitones the player sings away from the chart.
+        :param octave_equivalent: if True, any octave of a note counts as the note.
+        :param detect_range: if True, the octave the player sings in is detected from their
+            first seconds of singing, and added to *transpose*.
+        :param part: the part of the song the player sings (see ``songpkg.Song.parts``).
+        :param lane: with several singers, the index of the player's lane, out of
+            *num_lanes*. Only the first lane's display draws what they share: the artwork,
+            the record and the nowbar.
+        """
         super(GameDisplay, self).__init__()
 
-        valerie_file = "valerie_notes.txt"
-        valerie_lines = open(valerie_file).readlines()
-        allstar_file = "allstar_notes.txt"
-        allstar_lines = open(allstar_file).readlines()
-        bohemian_file = "bohemian_notes.txt"
-        bohemian_lines = open(bohemian_file).readlines()
-        self.max_points = 1
-
-        if song_choice == "bohemian":
-            song_lines = bohemian_lines
-            self.max_points = 1450300
-            self.gold = Image("vinyl_bohemian_gold.png").texture
-            self.plat = Image("vinyl_bohemian_platinum.png").texture
-        elif song_choice == "allstar":
-            song_lines = allstar_lines
-            self.max_points = 1074506
-            self.gold = Image("vinyl_allstar_gold.png").texture
-            self.plat = Image("vinyl_allstar_platinum.png").texture
-        elif song_choice == "valerie":
-            song_lines = valerie_lines
-            self.max_points = 902500
-            self.gold = Image("vinyl_valerie_gold.png").texture
-            self.plat = Image("vinyl_valerie_platinum.png").texture
-
-        def notes_from_line(line):
-            if song_choice == "allstar":
-                pitch, start, duration = (
-                    line.strip().split("\t")[1],
-                    line.strip().split("\t")[0],
-                    line.strip().split("\t")[2],
-                )
-                return (
-                    69 + 12 * math.log2(float(pitch) / 440) - 12,
-                    float(start),
-                    float(duration),
-                )
-            else:
-                pitch, start, duration = (
-                    line.strip().split("\t")[1],
-                    line.strip().split("\t")[0],
-                    line.strip().split("\t")[2],
-                )
-                return (
-                    69 + 12 * math.log2(float(pitch) / 440),
-                    float(start),
-                    float(duration),
-                )
-
-        self.line_data = [notes_from_line(l1) for l1 in song_lines]
-        first_column_values = [item[0] for item in self.line_data]
-
-        # Getting the minimum and maximum values
-        w = Window.width
-        h = Window.height
-        self.min_value = min(first_column_values)
-        self.max_value = max(first_column_values)
-        self.divisions = (now_height * h) / (self.max_value - self.min_value - 1)
+        self.song = song
+        self.part = part
+        notes = song.parts[part]
+        # points are earned per second of song time spent on pitch, so the score doesn't
+        # depend on the frame rate. The max score is derived from the chart.
+        self.scorer = ScoringEngine(
+            notes, transpose=transpose, octave_equivalent=octave_equivalent
+        )
+        self.range_detector = RangeDetector(self.scorer) if detect_range else None
+        self.max_points = self.scorer.max_score
+        self.last_time = None
+        self.last_accuracy = 0
+        self.hop_time = pitchtrack.HOP_SIZE / Audio.sample_rate
+        self.gold = Image(song.artwork["gold"]).texture
+        self.plat = Image(song.artwork["platinum"]).texture
+
+        # the part's chart is memory-mapped from the song package, one row per note
+        self.min_value = float(notes["pitch"].min())
+        self.max_value = float(notes["pitch"].max())
+
+        # every element below positions itself from these anchors. On resize, the
+        # anchors are recomputed and the existing instructions are moved in place.
+        self.layout = GameLayout(
+            Window.size, self.min_value, self.max_value, lane, num_lanes
+        )
+        self.resizer = ResizeDebouncer(self.apply_resize)
 
         self.success = False
 
-        self.ind_cent = (record_x * w, now_cent * h - now_height / 2 * h)
+        self.record_display = None
+        if lane == 0:
+            self.record_display = RecordDisplay(song, self.layout)
+            self.add(self.record_display)
 
-        self.record_display = RecordDisplay(song_choice)
-
-        self.add(self.record_display)
-
-        self.add(Color(1, 1, 1, 0.5))
-        self.backdrop = Rectangle(
-            pos=(self.ind_cent[0], self.ind_cent[1]),
-            size=((w * (1 - record_x)), now_height * h),
-        )
+        self.add(Color(0.3, 0.3, 0.3, 0.9))
+        self.backdrop = Rectangle(pos=self.layout.lane_origin, size=self.layout.lane_size)
         self.add(self.backdrop)
         self.add(Color(1, 1, 1))
 
+        # note lines live in their own group, so they always draw under the indicator
+        self.lane = InstructionGroup()
+        self.add(self.lane)
+
         self.ps = ParticleSystem("particle/particle.pex")
-        self.ps.emitter_x = self.ind_cent[0]
-        self.ps.emitter_y = self.ind_cent[1]
+        self.ps.emitter_x = self.layout.now_x
+        self.ps.emitter_y = self.layout.lane_origin[1]
 
-        self.pitch_indicator = PitchIndicator(self.min_value, self.max_value)
+        self.pitch_indicator = PitchIndicator(self.layout)
         self.add(self.pitch_indicator)
 
-        self.recent_pitches = []
-
-        self.vocal_range = "tenor"
-        self.base_pitch = 48
+        # smoothed pitch of the recent readings, updated in constant time per reading.
+        # Silent and unconfident readings are left out.
+        self.smoother = PitchSmoother()
 
         self.score = 0
 
         self.add(Color(0, 0, 0))
-        self.scoreboard = CLabelRect(
-            (4 * Window.width / 5, 9 * Window.height / 10),
-            "",
+        # the score changes almost every frame, so it is drawn from cached glyphs
+        self.scoreboard = CGlyphLabel(
+            self.layout.scoreboard_cpos,
             font_size=20,
             font_name="Arial",
+            prefix="Score: " if num_lanes == 1 else "P{} Score: ".format(lane + 1),
         )
         self.add(self.scoreboard)
 
-        self.return_home = CLabelRect(
-            (8 * Window.width / 10, 1 * Window.height / 10),
-            "Press R to Exit",
-            font_size=15,
-            font_name="Arial",
-        )
-        self.add(self.return_home)
+        self.return_home = None
+        if lane == 0:
+            self.return_home = CLabelRect(
+                self.layout.return_home_cpos,
+                "Press R to Exit",
+                font_size=15,
+                font_name="Arial",
+            )
+            self.add(self.return_home)
 
         self.current_line = None
 
-        # data format: (pitch, start_time, duration)
-        self.lines = []
-        for line in self.line_data:
-            self.lines.append(
-                LineDisplay(line[0], line[1], line[2], self.min_value, self.max_value)
+        self.lines = [
+            LineDisplay(pitch, start, duration, self.layout)
+            for start, duration, pitch in zip(
+                notes["start"].tolist(),
+                notes["duration"].tolist(),
+                notes["pitch"].tolist(),
             )
+        ]
 
         for line in self.lines:
-            self.add(line)
+            self.lane.add(line)
 
-        self.input_volume_display = InputVolumeDisplay()
+        self.input_volume_display = InputVolumeDisplay(self.layout)
         self.add(self.input_volume_display)
-        self.arrow_color = Color(1, 0, 0)
 
     def light_up_arrow(self, color):
         self.success = True
 
         if color == "gold":
-            color = Color(0.83, 0.69, 0.22)
-            self.arrow_color = color
-            self.pitch_indicator.indicator.texture = Image("arrow.png").texture
+            self.pitch_indicator.set_look((0.83, 0.69, 0.22), "hit")
             self.ps.start_color[0] = 0.83
             self.ps.start_color[1] = 0.69
             self.ps.start_color[2] = 0.22
@@ -550,55 +484,35 @@ class GameDisplay(InstructionGroup):
             self.ps.end_color[1] = 0.69
             self.ps.end_color[2] = 0.22
         if color == "plat":
-            color = Color(0.9, 0.9, 0.95)
-            self.arrow_color = color
-            self.pitch_indicator.indicator.texture = Image("arrow.png").texture
+            self.pitch_indicator.set_look((0.9, 0.9, 0.95), "hit")
             self.ps.end_color[0] = 0.9
             self.ps.start_color[1] = 0.9
             self.ps.start_color[2] = 0.95
             self.ps.end_color[0] = 0.9
             self.ps.end_color[1] = 0.9
             self.ps.end_color[2] = 0.95
-        self.ps.start()
-        self.add(self.arrow_color)
-        self.remove(self.pitch_indicator)
-        self.add(self.pitch_indicator)
+        # keeps emitting while the player stays on pitch, then stops by itself
+        self.ps.sustain()
 
     def darken_arrow(self):
         self.success = False
-        color = Color(1, 0, 0)
-        self.arrow_color = color
         self.ps.stop()
-        self.pitch_indicator.indicator.texture = Image("failarrow.png").texture
-        self.add(self.arrow_color)
-        self.remove(self.pitch_indicator)
-        self.add(self.pitch_indicator)
+        self.pitch_indicator.set_look((1, 0, 0), "fail")
 
     def get_current_line(self, lines):
         """
         returns the line currently intersecting the nowbar (if one exists)
         """
 
+        now_x = self.layout.now_x
         for line in lines:
-            if (
-                line.start_xpos <= self.ind_cent[0]
-                and line.end_xpos >= self.ind_cent[0]
-            ):
+            if line.start_xpos <= now_x and line.end_xpos >= now_x:
                 return line
         return None
 
     def add_to_score(self, new_points):
         self.score += new_points
 
-    def amount_off_to_points_earned(self, amount_off, sung_volume):  # slop window
-
-        if amount_off > 0.1 and amount_off <= 0.3 and sung_volume > 5:
-            return int(100 - (amount_off - 0.1) / 0.2 * 100)
-        elif amount_off <= 0.1:
-            return 100
-        else:
-            return 0
-
     def determine_pitch_type(self, current_pitch, average_pitch, reference_pitch):
         """
         Takes in the current pitch from this frame and the average pitch from recent frames
@@ -612,19 +526,136 @@ class GameDisplay(InstructionGroup):
         else:
             return current_off, "curr"
 
-    def on_update(self, sung_pitch, confidence, now_time, paused, sung_volume):
+    def smooth_readings(self, readings):
+        """
+        Feeds a batch of pitch readings to the smoother.
+
+        :returns: the smoothed (average) pitch after each reading that passed the smoother's
+            gate, and the reading's own pitch after the others: a gated reading (silence,
+            noise) must not score with the average of what was sung before it.
+        """
+        averages = np.empty(len(readings))
+        for i, (_, pitch, confidence, volume) in enumerate(readings):
+            accepted = self.smoother.push(pitch, confidence, volume, self.hop_time)
+            averages[i] = self.smoother.mean if accepted else pitch
+        return averages
+
+    def score_readings(self, readings, averages):
+        """
+        Scores a batch of pitch readings, one per analysis hop, each over the song time its hop
+        covers. Either the hop's pitch or the average pitch after it counts, whichever is
+        closer.
+        """
+        times, pitches, confidences, volumes = readings.T
+        hop_time = self.hop_time
+
+        # consecutive hops cover consecutive song time, and no time is scored twice
+        ends = np.maximum.accumulate(times)
+        if self.last_time is not None:
+            ends = np.maximum(ends, self.last_time)
+            prev = np.concatenate(([self.last_time], ends[:-1]))
+        else:
+            prev = np.concatenate(([-np.inf], ends[:-1]))
+        starts = np.maximum(ends - hop_time, prev)
+        self.last_time = ends[-1]
+
+        candidates = np.column_stack((pitches, averages))
+        points, accuracy, _ = self.scorer.score_spans(starts, ends, candidates, volumes)
+        self.add_to_score(float(np.sum(points)))
+        self.last_accuracy = accuracy[-1]
+
+        if self.range_detector is not None and not self.range_detector.done:
+            self.range_detector.add_spans(starts, ends, pitches, confidences, volumes)
+
+    def reset(self):
+        """
+        Starts a new performance: clears the score, the song time scored so far, the smoothed
+        pitch and, if it hasn't chosen yet, what range detection has heard. The player's
+        settings (see :meth:`get_settings`) are kept. A new GameDisplay created with those
+        settings scores exactly like this one after a reset.
+        """
+        self.score = 0
+        self.scorer.reset()
+        self.last_time = None
+        self.last_accuracy = 0
+        self.smoother.reset()
+        if self.range_detector is not None and not self.range_detector.done:
+            self.scorer.octave_equivalent = self.range_detector.octave_equivalent
+            self.range_detector = RangeDetector(self.scorer)
+
+    def set_transpose(self, transpose):
+        """
+        Sets the player's offset from the chart by hand, which stops range detection.
+        """
+        if self.range_detector is not None:
+            self.range_detector.cancel()
+        self.scorer.set_transpose(transpose)
+
+    def toggle_octave_equivalent(self):
+        if self.range_detector is not None:
+            self.range_detector.cancel()
+        self.scorer.octave_equivalent = not self.scorer.octave_equivalent
+
+    def get_settings(self):
+        """
+        :returns: the current scoring settings, as keyword arguments for a new GameDisplay.
+            Session logs record them, so that replays are scored the same way.
+        """
+        detecting = self.range_detector is not None and not self.range_detector.done
+        if detecting:
+            octave_equivalent = self.range_detector.octave_equivalent
+        else:
+            octave_equivalent = self.scorer.octave_equivalent
+        return {
+            "transpose": self.scorer.transpose,
+            "octave_equivalent": octave_equivalent,
+            "detect_range": detecting,
+            "part": self.part,
+        }
+
+    def on_key(self, key):
+        """
+        Handles the keys that change how the player is scored. Replays go through here too.
+        """
+        # sing the song in another key (a semitone at a time) or in any octave
+        if key in ("up", "down"):
+            step = 1 if key == "up" else -1
+            self.set_transpose(self.scorer.transpose + step)
+        elif key == "o":
+            self.toggle_octave_equivalent()
+
+    def on_update(
+        self, sung_pitch, confidence, now_time, paused, sung_volume, readings=None
+    ):
         self.ps.emitter_y = self.pitch_indicator.indicator.cpos[1]
         self.ps.emitter_x = self.pitch_indicator.indicator.cpos[0]
 
-        self.recent_pitches.append(sung_pitch)
-        if len(self.recent_pitches) > 30:
-            self.recent_pitches.pop(0)
+        pitch_type = "curr"
 
-        average_pitch = sum(self.recent_pitches) / len(self.recent_pitches)
+        # every analysis hop since the last frame is smoothed and scored, so heavy frames
+        # don't cost points. The arrow only shows the result of the latest one.
+        metrics.begin("scoring")
+        if readings is not None and len(readings):
+            averages = self.smooth_readings(readings)
+            if not paused:
+                self.score_readings(readings, averages)
+        metrics.end("scoring")
 
-        pitch_type = "curr"
+        average_pitch = self.smoother.mean
+        if average_pitch is None:
+            average_pitch = sung_pitch
 
         self.current_line = self.get_current_line(self.lines)
+
+        # sung pitches are shown, and compared to the current line, where they fall on the
+        # chart once the player's transpose (and octave) is undone
+        reference = self.current_line.pitch if self.current_line else None
+        sung_pitch = self.scorer.to_chart(sung_pitch, reference)
+        average_pitch = self.scorer.to_chart(average_pitch, reference)
+        smooth_pitch = self.smoother.smooth
+        if smooth_pitch is not None:
+            smooth_pitch = self.scorer.to_chart(smooth_pitch, reference)
+
         if self.current_line:
             current_reference_pitch = self.current_line.pitch
 
@@ -632,13 +663,10 @@ class GameDisplay(InstructionGroup):
                 sung_pitch, average_pitch, current_reference_pitch
             )
 
-            points_earned = self.amount_off_to_points_earned(amount_off, sung_volume)
-
             if not paused:
-                self.add_to_score(points_earned)
-                if points_earned == 100:
+                if self.last_accuracy == 1:
                     self.light_up_arrow("plat")
-                elif points_earned > 0:
+                elif self.last_accuracy > 0:
                     self.light_up_arrow("gold")
                 else:
                     self.darken_arrow()
@@ -646,69 +674,57 @@ class GameDisplay(InstructionGroup):
             self.current_line = None
             self.darken_arrow()
 
+        # the indicator follows the filtered pitch rather than the raw one, so it doesn't
+        # jitter on a held note
         if pitch_type == "avg":
             self.pitch_indicator.on_update(average_pitch, confidence, sung_volume)
+        elif smooth_pitch is not None:
+            self.pitch_indicator.on_update(smooth_pitch, confidence, sung_volume)
         else:
             self.pitch_indicator.on_update(sung_pitch, confidence, sung_volume)
 
-        if self.score > 0.1 * self.max_points:
+        if self.record_display is None:
+            pass
+        elif self.score > 0.1 * self.max_points:
             self.record_display.record.texture = self.plat
         elif self.score > 0.05 * self.max_points:
             self.record_display.record.texture = self.gold
 
-        self.scoreboard.set_text("Score: " + str(self.score))
+        self.scoreboard.set_value(int(self.score))
 
+        metrics.begin("lanes")
         for line in self.lines:
             visible = line.on_update(now_time)
             if visible:
-                if line not in self.children:
-                    self.add(line)
+                if line not in self.lane.children:
+                    self.lane.add(line)
             else:
-                self.remove(line)
+                self.lane.remove(line)
+        metrics.end("lanes")
 
         self.input_volume_display.on_update(sung_volume)
 
     def on_resize(self, win_size):
-        self.record_display.on_resize(win_size)
-        self.pitch_indicator.on_resize(win_size)
-        self.ind_cent = self.pitch_indicator.ind_cent
+        # dragging the window sends a burst of events. Only the last one is applied.
+        self.resizer.on_resize(win_size)
 
-        self.remove(self.backdrop)
-        self.add(Color(0.3, 0.3, 0.3, 0.9))
-        self.backdrop = Rectangle(
-            pos=(self.ind_cent[0], self.ind_cent[1]),
-            size=((win_size[0] * (1 - record_x)), now_height * win_size[1]),
-        )
-        self.add(self.backdrop)
-        self.add(Color(1, 1, 1))
+    def apply_resize(self, win_size):
+        if not self.layout.update(win_size):
+            return
 
-        for line in self.lines:
-            line.on_resize(win_size)
+        # everything below moves existing instructions. Nothing is added or removed.
+        if self.record_display is not None:
+            self.record_display.on_layout()
+            self.return_home.cpos = self.layout.return_home_cpos
+        self.pitch_indicator.on_layout()
+        self.input_volume_display.on_layout()
 
-        self.remove(self.pitch_indicator)
-        self.add(self.arrow_color)
-        self.add(self.pitch_indicator)
-        self.input_volume_display.on_resize(win_size)
-        self.ps.emitter_x = self.pitch_indicator.ind_cent[0]
+        self.backdrop.pos = self.layout.lane_origin
+        self.backdrop.size = self.layout.lane_size
 
-        self.remove(self.scoreboard)
-        self.add(Color(0, 0, 0))
-        self.scoreboard = CLabelRect(
-            (4 * win_size[0] / 5, 9 * win_size[1] / 10),
-            "",
-            font_size=20,
-            font_name="Arial",
-        )
-        self.add(self.scoreboard)
+        self.scoreboard.cpos = self.layout.scoreboard_cpos
 
-        self.remove(self.return_home)
-        self.return_home = CLabelRect(
-            (8 * win_size[0] / 10, 1 * win_size[1] / 10),
-            "Press R to Exit",
-            font_size=15,
-            font_name="Arial",
-        )
-        self.add(self.return_home)
+        self.ps.emitter_x = self.layout.now_x
 
 
 class AudioController(object):
@@ -731,6 +747,12 @@ class AudioController(object):
         self.backing_track.pause()
         self.music.pause()
 
+        # the song time being heard. The position of the generated audio (get_time) runs
+        # ahead of it by the output latency, and only moves once per audio buffer.
+        self.clock = AudioClock(
+            self.audio.get_latency()[1], time_func=self.audio.get_clock_time
+        )
+
     def get_total_duration(self):
         return self.total_duration
 
@@ -739,173 +761,565 @@ class AudioController(object):
         self.backing_track.play_toggle()
         self.music.play_toggle()
 
-    # return current time (in seconds) of song
+    # position (in seconds) of the audio generated so far. It runs ahead of what is
+    # heard, see now()
     def get_time(self):
         return self.backing_track.frame / self.audio.sample_rate
 
+    # smooth song time being heard, for scrolling and scoring
+    def now(self):
+        return self.clock.now()
+
     # needed to update audio
     def on_update(self):
         self.audio.on_update()
         self.paused = self.backing_track.paused
+        self.clock.update(self.backing_track.frame, self.paused)
 
 
 class SongSelectScreen(Screen):
-    def __init__(self, **kwargs):
+    def __init__(
+        self,
+        library,
+        page_size=9,
+        session_dir=None,
+        latency_probe=None,
+        profiler=None,
+        num_singers=1,
+        pitch_method=None,
+        **kwargs
+    ):
+        """
+        :param session_dir: if given, every song played is recorded to a session log there.
+        :param latency_probe: optional :class:`latency.LatencyProbe` for the songs played.
+        :param profiler: optional :class:`imslib.profiler.SamplingProfiler`, toggled with F
+            while a song plays.
+        :param num_singers: number of players, each singing into their own input channel.
+        :param pitch_method: pitch detection method of the songs played (see GameScreen).
+        """
         super(SongSelectScreen, self).__init__(**kwargs)
 
+        # songs are browsed from the library index, so no song files are opened until one
+        # is picked. Its GameScreen is created then, and kept for the next time.
+        self.library = library
+        self.page_size = page_size
+        self.page = 0
+        self.session_dir = session_dir
+        self.latency_probe = latency_probe
+        self.profiler = profiler
+        self.num_singers = num_singers
+        self.pitch_method = pitch_method
+
         self.info = topleft_label()
         self.info.text = "Home Screen\n"
 
-        self.song_select_display = SongSelectDisplay()
+        self.song_select_display = SongSelectDisplay(page_size)
         self.canvas.add(self.song_select_display)
 
+    def on_enter(self):
+        # pick up songs that were compiled since the last visit
+        self.library.refresh()
+        self.show_page(self.page)
+
+    def show_page(self, page):
+        num_pages = self.library.num_pages(self.page_size)
+        self.page = min(max(page, 0), num_pages - 1)
+        self.song_select_display.show_page(
+            self.library.page(self.page, self.page_size), self.page, num_pages
+        )
+
+    def play(self, entry):
+        name = "game_" + entry["id"]
+        if not any(s.name == name for s in self.manager.screens):
+            song = self.library.load_song(entry["id"])
+            self.manager.add_screen(
+                GameScreen(
+                    song,
+                    session_dir=self.session_dir,
+                    latency_probe=self.latency_probe,
+                    profiler=self.profiler,
+                    num_singers=self.num_singers,
+                    pitch_method=self.pitch_method,
+                    name=name,
+                )
+            )
+        self.switch_to(name)
+
     def on_key_down(self, keycode, modifiers):
-        if keycode[1] == "1":
-            self.switch_to("allstar")
-        if keycode[1] == "2":
-            self.switch_to("valerie")
-        if keycode[1] == "3":
-            self.switch_to("bohemian")
+        key = keycode[1]
+        if key == "left":
+            self.show_page(self.page - 1)
+        elif key == "right":
+            self.show_page(self.page + 1)
+        elif key is not None and key.isdigit() and key != "0":
+            entries = self.library.page(self.page, self.page_size)
+            slot = int(key) - 1
+            if slot < len(entries):
+                self.play(entries[slot])
 
     def on_update(self):
-        """
-        self.info.text = "Home Screen\n"
-        self.info.text += "1: All Star by Smash Mouth\n"
-        self.info.text += "2: Valerie by Amy Winehouse\n"
-        self.info.text += "3: Bohemian Rhapsody by Queen\n"
-        """
+        pass
 
     def on_resize(self, win_size):
         self.song_select_display.on_resize(win_size)
 
 
 class SongSelectDisplay(InstructionGroup):
-    def __init__(self):
+    def __init__(self, page_size):
         super(SongSelectDisplay, self).__init__()
 
-        self.window_width = Window.width
-        self.window_height = Window.height
-
-        self.add(Color(0, 0, 0, 0))
-        self.all_star_button = CRectangle(
-            cpos=((self.window_width / 2) - 500, self.window_height / 2),
-            csize=(1000, 100),
-        )
-        self.add(self.all_star_button)
-        self.add(Color(1, 1, 1))
-        self.all_star_text = CLabelRect(
-            cpos=((self.window_width / 2) - 600, (self.window_height / 2)),
-            text='"1": All Star by Smash Mouth',
-            font_size="14",
-        )
-        self.add(self.all_star_text)
-
-        self.add(Color(0, 0, 0, 0))
-        self.valerie_button = CRectangle(
-            cpos=(self.window_width / 2, self.window_height / 2), csize=(1000, 100)
-        )
-        self.add(self.valerie_button)
         self.add(Color(1, 1, 1))
-        self.valerie_text = CLabelRect(
-            cpos=((self.window_width / 2), (self.window_height / 2)),
-            text='"2": Valerie by Amy Winehouse',
-            font_size="14",
-        )
-        self.add(self.valerie_text)
+        self.heading = CLabelRect(cpos=(0, 0), text="Choose a song!", font_size="24")
+        self.add(self.heading)
+
+        # one label per song on a page, reused when paging
+        self.slots = []
+        for i in range(page_size):
+            slot = CLabelRect(cpos=(0, 0), text=" ", font_size="14")
+            self.slots.append(slot)
+            self.add(slot)
+
+        self.footer = CLabelRect(cpos=(0, 0), text=" ", font_size="14")
+        self.add(self.footer)
+
+        self.on_resize(Window.size)
+
+    def show_page(self, entries, page, num_pages):
+        for i, slot in enumerate(self.slots):
+            if i < len(entries):
+                entry = entries[i]
+                slot.set_text(
+                    '"{}": {} by {}'.format(i + 1, entry["title"], entry["artist"])
+                )
+            else:
+                slot.set_text(" ")
 
-        self.add(Color(0, 0, 0, 0))
-        self.bohemian_button = CRectangle(
-            cpos=((self.window_width / 2) + 500, self.window_height / 2),
-            csize=(1000, 100),
-        )
-        self.add(self.bohemian_button)
-        self.add(Color(1, 1, 1))
-        self.bohemian_text = CLabelRect(
-            cpos=((self.window_width / 2) + 600, (self.window_height / 2)),
-            text='"3": Bohemian Rhapsody by Queen',
-            font_size="14",
-        )
-        self.add(self.bohemian_text)
+        if entries:
+            footer = "Page {} of {}".format(page + 1, num_pages)
+            if num_pages > 1:
+                footer += "   (left / right to browse)"
+        else:
+            footer = "No songs found. Run: python harmony_hero.py compile"
+        self.footer.set_text(footer)
 
     def on_resize(self, win_size):
-        self.window_width = win_size[0]
-        self.window_height = win_size[1]
-        self.bohemian_text.cpos = (self.window_width / 2 + 600, self.window_height / 2)
-        self.valerie_text.cpos = (self.window_width / 2, self.window_height / 2)
-        self.all_star_text.cpos = (self.window_width / 2 - 600, self.window_height / 2)
+        w, h = win_size
+        self.heading.cpos = (w / 2, 0.85 * h)
+        for i, slot in enumerate(self.slots):
+            slot.cpos = (w / 2, (0.72 - 0.06 * i) * h)
+        self.footer.cpos = (w / 2, 0.1 * h)
 
 
 class GameScreen(Screen):
-    def __init__(self, title, **kwargs):
+    def __init__(
+        self,
+        song,
+        session_dir=None,
+        latency_probe=None,
+        profiler=None,
+        num_singers=1,
+        pitch_method=None,
+        **kwargs
+    ):
+        """
+        :param session_dir: if given, each time the song is played, a session log is
+            recorded there (see sessionlog.py).
+        :param latency_probe: optional :class:`latency.LatencyProbe`, to time each stage
+            from the microphone to the screen.
+        :param profiler: optional :class:`imslib.profiler.SamplingProfiler`, started and
+            stopped with F.
+        :param num_singers: number of players. Each sings into their own channel of the
+            audio interface, and is scored in their own lane against a part of the song.
+        :param pitch_method: pitch detection method, one of ``pitchtrack.METHODS``. Defaults
+            to the game's, or with several singers, to a cheaper one.
+        """
         super(GameScreen, self).__init__(**kwargs)
 
-        song_name = title + ".wav"
-        song_name2 = title + "_music.wav"
-        self.song_choice = title
+        # everything about the song comes from its compiled package
+        # (see songpkg.py and `python harmony_hero.py compile`)
+        self.song = song
+        self.song_choice = song.id
 
-        # Create Audio for stereo output AND mono input. Incoming audio data from microphone
-        # gets sent to the callback self.receive_audio()
+        # Create Audio for stereo output AND one input channel per singer. Incoming audio
+        # data from the microphones gets sent to the callback self.receive_audio()
 
-        self.audio_controller = AudioController(song_name, song_name2)
-        self.audio = Audio(2, input_func=self.receive_audio, num_input_channels=1)
+        self.audio_controller = AudioController(self.song.stems["mix"], self.song.stems["music"])
+        self.audio = Audio(
+            2, input_func=self.receive_audio, num_input_channels=num_singers
+        )
         self.mixer = Mixer()
         self.audio.set_generator(self.mixer)
-        self.pitch_detector = PitchDetector()
+
+        # one pitch detector per singer. With several singers, they use aubio's FFT version
+        # of YIN (see pitchtrack.py): the same readings as "yin" for a fraction of the cost,
+        # so that four singers take less time per hop than a single "yin" detector. They run
+        # one after the other: aubio holds the GIL, so threads wouldn't run them any faster.
+        method = pitch_method
+        if method is None:
+            method = pitchtrack.METHOD if num_singers == 1 else pitchtrack.OFFLINE_METHOD
+        self.pitch_detectors = [
+            PitchDetector(probe=latency_probe if i == 0 else None, method=method)
+            for i in range(num_singers)
+        ]
+        self.pitch_detector = self.pitch_detectors[0]
+        self.input_latency = self.audio.get_latency()[0]
         self.volume = self.pitch_detector.volume
 
-        self.game_display = GameDisplay(self.song_choice)
+        # one lane per singer, scored against the parts of the song in turn: the lead first,
+        # then the harmony parts (the lead again if the song has none)
+        parts = list(self.song.parts)
+        self.game_displays = [
+            GameDisplay(
+                self.song, part=parts[i % len(parts)], lane=i, num_lanes=num_singers
+            )
+            for i in range(num_singers)
+        ]
+        self.game_display = self.game_displays[0]
         self.particle_sys = self.game_display.ps
 
-        self.canvas.add(self.game_display)
-        self.add_widget(self.particle_sys)
+        for game_display in self.game_displays:
+            self.canvas.add(game_display)
+            self.add_widget(game_display.ps)
+
+        # per-frame timings of each part of the game, shown with H (see imslib.core.metrics)
+        self.hud = MetricsHUD()
+        self.canvas.after.add(self.hud)
+        self.profiler = profiler
+
+        self.session_dir = session_dir
+        self.session = None
+        register_terminate_func(self.end_session)
+
+        self.latency_probe = latency_probe
+        if latency_probe is not None:
+            input_latency = self.audio.get_latency()[0]
+            output_latency = self.audio_controller.audio.get_latency()[1]
+            latency_probe.set_audio_latency((input_latency, output_latency))
+            Window.bind(on_flip=latency_probe.drawn)
+
+    def on_enter(self):
+        # the garbage collector is held back while the song plays (see imslib.core.GCPolicy)
+        gc_policy.begin()
+        # screens are kept between visits: each visit is a new performance, which session
+        # logs replay from a fresh GameDisplay
+        for game_display in self.game_displays:
+            game_display.reset()
+        if self.session_dir is not None:
+            meta = {
+                "song": self.song.id,
+                "max_score": self.song.max_score,
+                "settings": self.game_display.get_settings(),
+                "score": self.game_display.score,
+                "sample_rate": Audio.sample_rate,
+                "hop_size": pitchtrack.HOP_SIZE,
+                "pitch_method": self.pitch_detector.method,
+                "num_singers": len(self.pitch_detectors),
+            }
+            path = sessionlog.session_path(self.session_dir, self.song.id)
+            self.session = sessionlog.SessionWriter(path, meta)
+
+    def on_exit(self):
+        self.end_session()
+        gc_policy.end()
+
+    def end_session(self):
+        if self.session is not None:
+            self.session.write_end(
+                self.audio_controller.now(), self.game_display.score
+            )
+            self.session.close()
+            self.session = None
 
     def on_update(self):
+        # audio i/o. The pitch detectors' share of it is timed separately.
+        metrics.begin("audio")
         self.audio.on_update()
 
         pitch = self.pitch_detector.pitch
         conf = self.pitch_detector.conf
 
         self.audio_controller.on_update()
-        now_time = self.audio_controller.get_time()
+        metrics.end("audio")
+        now_time = self.audio_controller.now()
         paused = self.audio_controller.paused
 
         self.volume = self.pitch_detector.volume
-        self.game_display.on_update(pitch, conf, now_time, paused, self.volume)
+        readings = [detector.get_readings() for detector in self.pitch_detectors]
+        if metrics.enabled:
+            metrics.set("hops", sum(len(r) for r in readings))
+            metrics.set(
+                "pitch queue",
+                max(len(detector.buffer.buffer) for detector in self.pitch_detectors),
+            )
+            metrics.set(
+                "underruns",
+                self.audio.get_underruns()
+                + self.audio_controller.audio.get_underruns(),
+            )
+        if self.latency_probe is not None:
+            self.latency_probe.consumed()
+        # session logs only record the first singer
+        if self.session is not None:
+            self.session.write_frame(
+                now_time, paused, pitch, conf, self.volume, readings[0]
+            )
+        for detector, game_display, singer_readings in zip(
+            self.pitch_detectors, self.game_displays, readings
+        ):
+            game_display.on_update(
+                detector.pitch,
+                detector.conf,
+                now_time,
+                paused,
+                detector.volume,
+                singer_readings,
+            )
 
-        """
-        self.info.text = f'fps:{kivyClock.get_fps():.1f}\n'
-        self.info.text += f'audio load: {self.audio.get_cpu_load():.2f}\n'
-        self.info.text += f'pitch: {pitch:.2f}\n'
-        self.info.text += f'conf: {conf:.2f}\n'
-        self.info.text+=f'success: {self.game_display.success}\n'
-        self.info.text+=f'vocal range: {self.game_display.vocal_range}\n'
-        self.info.text += f"Press P to play/pause!"
-        """
+        self.hud.on_update()
 
     def receive_audio(self, frames, num_channels):
-        # this just handles one channel. If you want to support stereo input,
-        # mix down stereo to mono before proceeding
-        assert num_channels == 1
-        self.pitch_detector.insert(frames)
+        # the last frame was heard (and sung) the input latency ago
+        end_time = self.audio_controller.now() - self.input_latency
+        if num_channels == 1:
+            self.pitch_detector.insert(frames, end_time)
+            return
+
+        # frames are interleaved, one channel per singer. Each singer's samples are a strided
+        # view of them: nothing is copied until the detectors buffer their hops.
+        for i, detector in enumerate(self.pitch_detectors):
+            detector.insert(frames[i::num_channels], end_time)
 
     def on_key_down(self, keycode, modifiers):
         # play / pause toggle
         if keycode[1] == "p":
             self.audio_controller.toggle()
+            if self.audio_controller.paused:
+                gc_policy.pause()
         elif keycode[1] == "r":
             self.switch_to("song_select_screen")
-            self.game_display.score = 0
+            for game_display in self.game_displays:
+                game_display.score = 0
+        elif keycode[1] == "h":
+            self.hud.toggle()
+        elif keycode[1] == "f" and self.profiler is not None:
+            self.profiler.toggle()
+        else:
+            for game_display in self.game_displays:
+                game_display.on_key(keycode[1])
+
+        if self.session is not None and keycode[1] is not None:
+            self.session.write_key(self.audio_controller.now(), keycode[1])
+
+    def on_resize(self, win_size):
+        for game_display in self.game_displays:
+            game_display.on_resize(win_size)
+
+
+def replay_record(game_display, record):
+    """
+    Feeds a frame or key record of a session log to *game_display*, as GameScreen did.
+    """
+    if isinstance(record, sessionlog.Frame):
+        game_display.on_update(
+            record.pitch,
+            record.confidence,
+            record.time,
+            record.paused,
+            record.volume,
+            record.readings,
+        )
+    elif isinstance(record, sessionlog.Key):
+        game_display.on_key(record.key)
+
+
+def load_session(path, lib_dir=None):
+    """
+    :returns: ``(reader, game_display)``: the session log and a GameDisplay set up like the
+        one it was recorded from.
+    """
+    reader = sessionlog.SessionReader(path)
+    song = songpkg.load_song(reader.meta["song"], lib_dir)
+    game_display = GameDisplay(song, **reader.meta["settings"])
+    game_display.score = reader.meta["score"]
+    return reader, game_display
+
+
+def replay_session(path, lib_dir=None):
+    """
+    Plays a session log back through a GameDisplay, as fast as possible, without audio.
+
+    :returns: ``(game_display, recorded_score, num_frames)``. The recorded score is the one
+        the game showed at the end of the session, or None if the log was cut short.
+    """
+    reader, game_display = load_session(path, lib_dir)
+    recorded_score = None
+    num_frames = 0
+    for record in reader:
+        if isinstance(record, sessionlog.End):
+            recorded_score = record.score
+        else:
+            replay_record(game_display, record)
+            num_frames += isinstance(record, sessionlog.Frame)
+    return game_display, recorded_score, num_frames
+
+
+class ReplayScreen(Screen):
+    """
+    Plays a session log back on screen, *speed* times as fast as it was recorded.
+    """
+
+    def __init__(self, path, lib_dir=None, speed=1.0, **kwargs):
+        super(ReplayScreen, self).__init__(**kwargs)
+
+        reader, self.game_display = load_session(path, lib_dir)
+        self.records = [r for r in reader if not isinstance(r, sessionlog.End)]
+        self.index = 0
+        self.speed = speed
+        self.start = None
+
+        self.canvas.add(self.game_display)
+        self.add_widget(self.game_display.ps)
+
+    def on_update(self):
+        if not self.records:
+            return
+        if self.start is None:
+            self.start = time.perf_counter()
+
+        # every record up to the song time the replay has reached
+        records = self.records
+        now_time = records[0].time + (time.perf_counter() - self.start) * self.speed
+        while self.index < len(records) and records[self.index].time <= now_time:
+            replay_record(self.game_display, records[self.index])
+            self.index += 1
 
     def on_resize(self, win_size):
         self.game_display.on_resize(win_size)
 
 
 # Screen Manager Setup
-sm = ScreenManager()
-
-sm.add_screen(SongSelectScreen(name="song_select_screen"))
-sm.add_screen(GameScreen(title="allstar", name="allstar"))
-sm.add_screen(GameScreen(title="valerie", name="valerie"))
-sm.add_screen(GameScreen(title="bohemian", name="bohemian"))
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Harmony Hero")
+    parser.add_argument(
+        "--record",
+        metavar="DIR",
+        help="record a session log of every song played to DIR, for "
+        "`python harmony_hero.py replay`",
+    )
+    parser.add_argument(
+        "--mic-file",
+        metavar="WAV",
+        help="sing from a WAV file instead of the microphone, without any audio device",
+    )
+    parser.add_argument(
+        "--audio-out", metavar="WAV", help="with --mic-file, save the game's audio output"
+    )
+    parser.add_argument(
+        "--speed",
+        type=float,
+        default=1.0,
+        help="with --mic-file, how many times faster than real time to run",
+    )
+    parser.add_argument(
+        "--latency",
+        action="store_true",
+        help="time each stage from the microphone to the screen, and print percentiles "
+        "on exit",
+    )
+    parser.add_argument(
+        "--metrics",
+        metavar="FILE",
+        help="collect per-frame timings of the whole session and save them to FILE on "
+        "exit (.csv or .json)",
+    )
+    parser.add_argument(
+        "--profile",
+        metavar="FILE",
+        help="sample the game's stacks from the start, and write them to FILE as "
+        "collapsed stacks for flame graphs (F starts and stops sampling in a song)",
+    )
+    parser.add_argument(
+        "--profile-rate",
+        type=float,
+        default=200,
+        help="profiler samples per second (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--gc",
+        choices=GCPolicy.MODES,
+        default="defer",
+        help="garbage collection while a song plays: left alone, made rarer, or deferred "
+        "to pauses and the end of the song (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--trace-allocations",
+        action="store_true",
+        help="with --metrics or the H overlay, also trace the memory allocated each frame, "
+        "and print where the most memory is held on exit",
+    )
+    parser.add_argument(
+        "--pitch-method",
+        choices=pitchtrack.METHODS,
+        help="pitch detection method (default: {}, or {} with several singers; compare "
+        "them with `python harmony_hero.py evaluate`)".format(
+            pitchtrack.METHOD, pitchtrack.OFFLINE_METHOD
+        ),
+    )
+    parser.add_argument(
+        "--singers",
+        type=int,
+        choices=range(1, 5),
+        default=1,
+        help="number of players, each singing into their own channel of the audio "
+        "interface (default: %(default)s)",
+    )
+    args = parser.parse_args()
+
+    latency_probe = None
+    if args.latency:
+        latency_probe = LatencyProbe()
+        register_terminate_func(lambda: print(latency_probe.format_report()))
+
+    gc_policy.mode = args.gc
+    metrics.trace_allocations = args.trace_allocations
+    if args.trace_allocations:
+        register_terminate_func(lambda: print(metrics.top_allocations()))
+
+    if args.metrics:
+        # keep up to an hour of frames at 60fps
+        metrics.reset(60 * 60 * 60)
+        metrics.enable()
+        register_terminate_func(lambda: metrics.export(args.metrics))
+
+    # F toggles the profiler during a song. Each time it stops, all the samples so far are
+    # written out.
+    profiler = SamplingProfiler(args.profile_rate, args.profile or "profile.txt")
+    if args.profile:
+        profiler.start()
+
+    def stop_profiler():
+        if profiler.running:
+            profiler.stop()
+            print(profiler.summary())
+
+    register_terminate_func(stop_profiler)
+
+    if args.mic_file:
+        Audio.backend = FileBackend(args.mic_file, args.audio_out, args.speed)
+        register_terminate_func(Audio.backend.close)
+
+    sm = ScreenManager()
+
+    sm.add_screen(
+        SongSelectScreen(
+            SongIndex(),
+            session_dir=args.record,
+            latency_probe=latency_probe,
+            profiler=profiler,
+            num_singers=args.singers,
+            pitch_method=args.pitch_method,
+            name="song_select_screen",
+        )
+    )
 
-run(sm)
+    run(sm)
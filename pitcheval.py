@@ -0,0 +1,358 @@
+# offline evaluation of the pitch detection methods (pitchtrack.METHODS). Each method is run
+# over a corpus of labelled vocal recordings, hop by hop as the game runs it, and its readings
+# are compared to the labels. A corpus is a directory of pairs of files:
+#
+#   <name>.wav   a recording (16 bit, any sample rate, channels are mixed down)
+#   <name>.csv   its reference pitch: one "time,frequency" row per frame, in seconds and Hz,
+#                with a frequency of 0 where nobody sings (MDB-stem-synth's format)
+#
+# For each method, the report gives:
+#
+#   accuracy  mir_eval's melody metrics: raw pitch and chroma accuracy (readings within 50
+#             cents of the reference, in any octave for chroma), voicing recall and false
+#             alarms, and the overall accuracy of voicing and pitch together
+#   latency   from each note onset to the first correct reading, in audio time: how long
+#             the player waits to see a new note, not counting audio i/o
+#   cost      CPU time per hop, as a share of one core at real time, and percentiles of the
+#             time each hop took
+#
+# Recordings and methods are evaluated in parallel, one process per job (aubio holds the
+# GIL). make_corpus() writes synthetic vocals, labelled exactly, for when no corpus is at hand.
+
+import glob
+import os
+import time
+import wave
+
+import numpy as np
+
+import chart
+import pitchtrack
+
+# a reading is voiced when it has a pitch and this confidence: what the game's pitch
+# indicator needs to follow it
+MIN_CONFIDENCE = 0.7
+
+# readings within this many cents of the reference are correct
+TOLERANCE_CENTS = 50
+
+# a note onset is where singing starts, or where the reference moves by at least a
+# semitone within ONSET_WINDOW seconds. Such moments closer than that make a single onset.
+ONSET_WINDOW = 0.05
+
+# vocal ranges (midi) of the synthetic singers, one per recording in turn
+VOICES = {
+    "bass": (40, 55),
+    "tenor": (48, 64),
+    "alto": (53, 70),
+    "soprano": (60, 79),
+}
+
+SAMPLE_RATE = 44100
+
+# seconds between the labels of synthetic recordings
+LABEL_STEP = 0.01
+
+# the values of evaluate_file() summed over the files of a method
+COUNTS = (
+    "frames",
+    "voiced",
+    "unvoiced",
+    "correct",
+    "correct_chroma",
+    "recalled",
+    "false_alarms",
+    "overall",
+    "cpu",
+)
+
+
+def read_labels(path):
+    """:returns: ``(times, frequencies)`` of a reference pitch file. Header rows are skipped."""
+    data = np.genfromtxt(path, delimiter=",", comments="#", ndmin=2)
+    data = data[~np.isnan(data[:, :2]).any(axis=1)]
+    return data[:, 0], data[:, 1]
+
+
+def find_corpus(corpus_dir):
+    """:returns: the ``(wav, csv)`` paths of the labelled recordings in *corpus_dir*."""
+    pairs = []
+    for wav_path in sorted(glob.glob(os.path.join(corpus_dir, "*.wav"))):
+        csv_path = os.path.splitext(wav_path)[0] + ".csv"
+        if os.path.exists(csv_path):
+            pairs.append((wav_path, csv_path))
+    return pairs
+
+
+def to_midi(freqs):
+    """:returns: *freqs* (Hz) in midi, 0 where they are 0."""
+    freqs = np.asarray(freqs, dtype=float)
+    midi = np.zeros(len(freqs))
+    voiced = freqs > 0
+    midi[voiced] = 69 + 12 * np.log2(freqs[voiced] / 440.0)
+    return midi
+
+
+def synthetic_voice(voice, seconds, rng, sample_rate=SAMPLE_RATE):
+    """
+    Sings a random melody in the range of *voice* (see :data:`VOICES`): phrases of notes
+    joined by short glides, with vibrato, a harmonic spectrum, breath noise, and rests
+    between phrases.
+
+    :returns: ``(samples, label_times, label_freqs)``.
+    """
+    low, high = VOICES[voice]
+    num_samples = int(seconds * sample_rate)
+    midi = np.zeros(num_samples)
+    voiced = np.zeros(num_samples, dtype=bool)
+
+    pos = int(rng.uniform(0.2, 0.6) * sample_rate)
+    pitch = rng.uniform(low + 3, high - 3)
+    while pos < num_samples:
+        # a phrase of notes, each gliding from the one before
+        for note in range(rng.integers(3, 9)):
+            length = int(rng.uniform(0.2, 0.8) * sample_rate)
+            end = min(pos + length, num_samples)
+            target = float(np.clip(pitch + rng.integers(-4, 5), low, high))
+            glide = min(int(0.03 * sample_rate), end - pos) if note else 0
+            midi[pos:end] = target
+            midi[pos : pos + glide] = np.linspace(pitch, target, glide)
+            voiced[pos:end] = True
+            pitch = target
+            pos = end
+            if pos >= num_samples:
+                break
+        pos += int(rng.uniform(0.3, 1.0) * sample_rate)
+
+    t = np.arange(num_samples) / sample_rate
+    vibrato = rng.uniform(0.15, 0.4) * np.sin(2 * np.pi * rng.uniform(4.5, 6.5) * t)
+    contour = np.where(voiced, midi + vibrato, 0.0)
+    freqs = np.where(voiced, 440 * 2 ** ((contour - 69) / 12.0), 0.0)
+
+    # harmonics falling off by 6dB per octave, under the Nyquist frequency
+    phase = 2 * np.pi * np.cumsum(freqs) / sample_rate
+    signal = np.zeros(num_samples)
+    for h in range(1, 13):
+        audible = freqs * h < sample_rate / 2
+        signal += np.where(audible, np.sin(h * phase) / h, 0.0)
+
+    # 20ms fades in and out of each phrase
+    fade = int(0.02 * sample_rate)
+    envelope = np.convolve(voiced.astype(float), np.ones(fade) / fade, "same")
+    noise = rng.uniform(0.002, 0.03) * rng.standard_normal(num_samples)
+    samples = 0.15 * envelope * signal + noise
+
+    label_times = np.arange(0, seconds, LABEL_STEP)
+    idx = np.minimum((label_times * sample_rate).astype(int), num_samples - 1)
+    return samples, label_times, freqs[idx]
+
+
+def make_corpus(out_dir, num_files=8, seconds=10.0, seed=1):
+    """
+    Writes *num_files* synthetic labelled recordings (see :func:`synthetic_voice`) to
+    *out_dir*, cycling through the voices.
+
+    :returns: their ``(wav, csv)`` paths.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    voices = sorted(VOICES)
+    pairs = []
+    for i in range(num_files):
+        voice = voices[i % len(voices)]
+        samples, label_times, label_freqs = synthetic_voice(voice, seconds, rng)
+        name = os.path.join(out_dir, "synthetic_{:02d}_{}".format(i, voice))
+        with wave.open(name + ".wav", "wb") as f:
+            f.setnchannels(1)
+            f.setsampwidth(2)
+            f.setframerate(SAMPLE_RATE)
+            f.writeframes((np.clip(samples, -1, 1) * 32767).astype(np.int16).tobytes())
+        np.savetxt(
+            name + ".csv", np.column_stack((label_times, label_freqs)), "%.6f", ","
+        )
+        pairs.append((name + ".wav", name + ".csv"))
+    return pairs
+
+
+def find_onsets(times, midi):
+    """
+    :returns: the note onsets of a reference pitch track (see :data:`ONSET_WINDOW`), and the
+        pitch each one settles on.
+    """
+    voiced = midi > 0
+    step = max(1, int(round(ONSET_WINDOW / max(np.median(np.diff(times)), 1e-6))))
+    previous = np.concatenate((np.zeros(step), midi[:-step]))
+    starts = voiced & (previous == 0)
+    jumps = voiced & (previous > 0) & (np.abs(midi - previous) >= 1)
+    changing = np.flatnonzero(starts | jumps)
+    if len(changing) == 0:
+        return np.zeros(0), np.zeros(0)
+
+    # runs of changing frames, each an onset that settles where its run ends
+    breaks = np.flatnonzero(np.diff(times[changing]) > ONSET_WINDOW)
+    firsts = changing[np.concatenate(([0], breaks + 1))]
+    lasts = changing[np.concatenate((breaks, [len(changing) - 1]))]
+    settled = np.minimum(lasts + 1, len(midi) - 1)
+    keep = midi[settled] > 0
+    return times[firsts[keep]], midi[settled[keep]]
+
+
+def evaluate_file(
+    wav_path,
+    csv_path,
+    method,
+    buf_size=pitchtrack.BUF_SIZE,
+    hop_size=pitchtrack.HOP_SIZE,
+    min_confidence=MIN_CONFIDENCE,
+):
+    """
+    Runs *method* over one recording and compares its readings to the labels.
+
+    :returns: a dictionary of frame counts (summed over files by :func:`evaluate`), onset
+        ``"delays"`` (seconds, NaN when missed), ``"hop_times"`` (seconds per hop) and
+        ``"cpu"`` (seconds).
+    """
+    blocks, sample_rate = chart.read_stem(wav_path)
+    samples = np.concatenate(list(blocks)).astype(np.float32)
+    num_hops = len(samples) // hop_size
+    hops = samples[: num_hops * hop_size].reshape(num_hops, hop_size)
+
+    pitch_o = pitchtrack.make_pitch_o(sample_rate, method, buf_size, hop_size)
+    pitch = np.zeros(num_hops)
+    confidence = np.zeros(num_hops)
+    hop_times = np.zeros(num_hops)
+    cpu = time.process_time()
+    for i in range(num_hops):
+        t0 = time.perf_counter()
+        pitch[i] = pitch_o(hops[i])[0]
+        confidence[i] = pitch_o.get_confidence()
+        hop_times[i] = time.perf_counter() - t0
+    cpu = time.process_time() - cpu
+
+    # each reading describes the window it analysed, centered half a window before the end
+    # of its hop, when it is reported
+    reported = (np.arange(num_hops) + 1) * hop_size / sample_rate
+    centers = reported - buf_size / 2 / sample_rate
+
+    label_times, label_freqs = read_labels(csv_path)
+    label_midi = to_midi(label_freqs)
+    idx = np.clip(np.searchsorted(label_times, centers), 1, len(label_times) - 1)
+    nearer = centers - label_times[idx - 1] < label_times[idx] - centers
+    reference = label_midi[np.where(nearer, idx - 1, idx)]
+
+    ref_voiced = reference > 0
+    has_pitch = pitch > 0
+    est_voiced = has_pitch & (confidence >= min_confidence)
+    error = np.abs(pitch - reference)
+    correct = ref_voiced & has_pitch & (error * 100 <= TOLERANCE_CENTS)
+    octave_error = np.abs(error - 12 * np.round(error / 12))
+    correct_chroma = ref_voiced & has_pitch & (octave_error * 100 <= TOLERANCE_CENTS)
+
+    # the first voiced and correct reading reported after each onset, before the next one
+    onsets, targets = find_onsets(label_times, label_midi)
+    next_onsets = np.concatenate((onsets[1:], [np.inf]))
+    delays = np.full(len(onsets), np.nan)
+    for k, (onset, target) in enumerate(zip(onsets, targets)):
+        start = np.searchsorted(reported, onset)
+        end = np.searchsorted(reported, next_onsets[k])
+        hits = est_voiced[start:end] & (
+            np.abs(pitch[start:end] - target) * 100 <= TOLERANCE_CENTS
+        )
+        if hits.any():
+            delays[k] = reported[start + np.argmax(hits)] - onset
+
+    return {
+        "frames": num_hops,
+        "voiced": int(ref_voiced.sum()),
+        "unvoiced": int((~ref_voiced).sum()),
+        "correct": int(correct.sum()),
+        "correct_chroma": int(correct_chroma.sum()),
+        "recalled": int((ref_voiced & est_voiced).sum()),
+        "false_alarms": int((~ref_voiced & est_voiced).sum()),
+        "overall": int(((~ref_voiced & ~est_voiced) | (correct & est_voiced)).sum()),
+        "delays": delays,
+        "hop_times": hop_times,
+        "cpu": cpu,
+        "hop_duration": hop_size / sample_rate,
+    }
+
+
+def _evaluate_job(job):
+    method, args = job
+    return method, evaluate_file(*args)
+
+
+def _ratio(a, b):
+    return a / b if b else float("nan")
+
+
+def evaluate(
+    pairs,
+    methods=pitchtrack.METHODS,
+    processes=1,
+    buf_size=pitchtrack.BUF_SIZE,
+    hop_size=pitchtrack.HOP_SIZE,
+    min_confidence=MIN_CONFIDENCE,
+):
+    """
+    Evaluates every method of *methods* on every recording of *pairs*.
+
+    :param pairs: ``(wav, csv)`` paths, as returned by :func:`find_corpus`.
+    :param processes: number of worker processes. 1 runs everything in this process. The
+        hop time percentiles are only meaningful with no more processes than cores.
+
+    :returns: a dictionary of method -> results: the accuracies (fractions), ``"latency_ms"``
+        and ``"hop_us"`` (:func:`latency.percentiles`), ``"missed"`` onsets, ``"cpu_us"`` per
+        hop and ``"core"``, the share of one core it takes to keep up with real time.
+    """
+    jobs = [
+        (method, (wav, csv, method, buf_size, hop_size, min_confidence))
+        for method in methods
+        for wav, csv in pairs
+    ]
+    if processes > 1 and len(jobs) > 1:
+        from multiprocessing import Pool
+
+        with Pool(min(processes, len(jobs))) as pool:
+            outputs = pool.map(_evaluate_job, jobs)
+    else:
+        outputs = [_evaluate_job(job) for job in jobs]
+
+    # imports the audio module, and with it kivy: not in the worker processes
+    from latency import percentiles
+
+    results = {}
+    for method in methods:
+        files = [r for m, r in outputs if m == method]
+        total = {key: sum(r[key] for r in files) for key in COUNTS}
+        delays = np.concatenate([r["delays"] for r in files])
+        hop_times = np.concatenate([r["hop_times"] for r in files])
+        cpu_per_hop = _ratio(total["cpu"], total["frames"])
+        hop_duration = files[0]["hop_duration"] if files else float("nan")
+        results[method] = {
+            "files": len(files),
+            "hops": total["frames"],
+            "raw_pitch": _ratio(total["correct"], total["voiced"]),
+            "raw_chroma": _ratio(total["correct_chroma"], total["voiced"]),
+            "voicing_recall": _ratio(total["recalled"], total["voiced"]),
+            "voicing_false_alarm": _ratio(total["false_alarms"], total["unvoiced"]),
+            "overall": _ratio(total["overall"], total["frames"]),
+            "latency_ms": percentiles(1000 * delays),
+            "missed": int(np.sum(np.isnan(delays))),
+            "onsets": len(delays),
+            "cpu_us": 1e6 * cpu_per_hop,
+            "core": cpu_per_hop / hop_duration,
+            "hop_us": percentiles(1e6 * hop_times),
+        }
+    return results
+
+
+def cheapest(results, min_accuracy, metric="raw_pitch"):
+    """
+    :returns: the method of *results* with the lowest CPU time per hop among those with at
+        least *min_accuracy* of *metric*, or None.
+    """
+    passing = [m for m, r in results.items() if r[metric] >= min_accuracy]
+    if not passing:
+        return None
+    return min(passing, key=lambda m: results[m]["cpu_us"])
@@ -0,0 +1,165 @@
+# pitch tracking shared by the game and the offline tools. The game's PitchDetector and the
+# chart generator (chart.py) both build their pitch objects here, so that charts are
+# generated with exactly the configuration used to score players.
+#
+# Several pitch detection methods can be used (METHODS): aubio's, and "pyin", a NumPy
+# probabilistic YIN. They all behave like an ``aubio.pitch``: called with exactly hop_size
+# float32 samples, they return ``[pitch]`` in midi (0 when no pitch is found), and
+# get_confidence() tells how sure they were. Both are float32, like aubio's, so that session
+# logs (sessionlog.py) store them exactly. `python harmony_hero.py evaluate` compares them
+# (see pitcheval.py).
+
+import aubio
+import numpy as np
+
+# aubio pitch method, window size, hop size and YIN tolerance used throughout the game
+METHOD = "yin"
+BUF_SIZE = 4096
+HOP_SIZE = 1024
+TOLERANCE = 0.5
+
+# offline tools use aubio's FFT implementation of YIN. It computes the same difference
+# function, so its readings match "yin" (to within 1e-4 semitones), about 10x faster.
+OFFLINE_METHOD = "yinfast"
+
+AUBIO_METHODS = ("yin", "yinfast", "yinfft", "mcomb")
+METHODS = AUBIO_METHODS + ("pyin",)
+
+# aubio methods whose confidence is always 0. Their readings are given a confidence of 1
+# when they find a pitch, so that the game doesn't ignore them.
+NO_CONFIDENCE = ("yinfft", "mcomb")
+
+# lowest and highest frequencies (Hz) "pyin" looks for: the range of the human voice
+VOICE_RANGE = (60.0, 1100.0)
+
+# "pyin" prior on the YIN threshold: a beta distribution with mean 0.1, as in pYIN
+PYIN_BETA = (2, 18)
+
+
+def make_pitch_o(sample_rate, method=METHOD, buf_size=BUF_SIZE, hop_size=HOP_SIZE):
+    """
+    :param method: one of :data:`METHODS`.
+
+    :returns: a pitch object that reports pitch in midi, configured like the game's. It must
+        be called with exactly *hop_size* float32 samples at a time.
+    """
+    if method == "pyin":
+        return PYin(sample_rate, buf_size, hop_size)
+    if method not in AUBIO_METHODS:
+        raise ValueError("unknown pitch method {!r}".format(method))
+
+    pitch_o = aubio.pitch(method, buf_size, hop_size, sample_rate)
+    pitch_o.set_tolerance(TOLERANCE)
+    pitch_o.set_unit("midi")
+    if method in NO_CONFIDENCE:
+        return FoundConfidence(pitch_o)
+    return pitch_o
+
+
+class FoundConfidence(object):
+    """
+    Wraps an aubio pitch object that has no confidence: the confidence of a reading is 1 if
+    a pitch was found, 0 if not.
+    """
+
+    def __init__(self, pitch_o):
+        super(FoundConfidence, self).__init__()
+        self.pitch_o = pitch_o
+        self.confidence = 0.0
+
+    def __call__(self, data):
+        pitch = self.pitch_o(data)
+        self.confidence = 1.0 if pitch[0] > 0 else 0.0
+        return pitch
+
+    def get_confidence(self):
+        return self.confidence
+
+
+class PYin(object):
+    """
+    Probabilistic YIN (Mauch and Dixon, 2014) in NumPy, without its HMM, which needs the
+    readings that follow: the game smooths readings itself. Each hop, the YIN difference
+    function of the last *buf_size* samples is computed from their autocorrelation (by FFT)
+    and normalized. Every dip of it is a pitch candidate, chosen for the range of thresholds
+    under which it is the first dip: its probability is the prior's mass over that range.
+    The reading is the most likely candidate, and its confidence the total probability that
+    the hop is voiced.
+    """
+
+    def __init__(
+        self, sample_rate, buf_size=BUF_SIZE, hop_size=HOP_SIZE, voice_range=VOICE_RANGE
+    ):
+        super(PYin, self).__init__()
+        self.sample_rate = sample_rate
+        self.hop_size = hop_size
+        self.window = np.zeros(buf_size)
+
+        # lags of the difference function, integrated over half the window
+        self.width = buf_size // 2
+        self.min_lag = max(2, int(sample_rate / voice_range[1]))
+        self.max_lag = min(self.width - 2, int(np.ceil(sample_rate / voice_range[0])))
+        self.lags = np.arange(self.width)
+
+        # cumulative distribution of the threshold prior, on a grid of 100 thresholds
+        a, b = PYIN_BETA
+        self.thresholds = (np.arange(100) + 0.5) / 100
+        weights = self.thresholds ** (a - 1) * (1 - self.thresholds) ** (b - 1)
+        self.threshold_cdf = np.concatenate(([0.0], np.cumsum(weights) / np.sum(weights)))
+
+        self.confidence = 0.0
+
+    def _prior_cdf(self, values):
+        return self.threshold_cdf[np.searchsorted(self.thresholds, values, "right")]
+
+    def difference(self):
+        """:returns: the cumulative mean normalized difference function of the window."""
+        x = self.window
+        w = self.width
+        size = len(x)
+        # d(lag) = sum((x[j] - x[j + lag])^2 for j < w) = e(0) + e(lag) - 2 acf(lag)
+        spectrum = np.conj(np.fft.rfft(x[:w], size)) * np.fft.rfft(x, size)
+        acf = np.fft.irfft(spectrum, size)[:w]
+        energy = np.concatenate(([0.0], np.cumsum(x * x)))
+        diff = energy[w] + energy[w : 2 * w] - energy[:w] - 2 * acf
+        diff[0] = 0.0
+
+        total = np.cumsum(diff)
+        normalized = np.ones(w)
+        np.divide(diff * self.lags, total, out=normalized, where=total > 1e-12)
+        normalized[0] = 1.0
+        return np.maximum(normalized, 0.0)
+
+    def __call__(self, data):
+        hop = self.hop_size
+        self.window[:-hop] = self.window[hop:]
+        self.window[-hop:] = data
+
+        normalized = self.difference()
+        lo, hi = self.min_lag, self.max_lag
+        d = normalized[lo - 1 : hi + 2]
+        dips = np.flatnonzero((d[1:-1] < d[:-2]) & (d[1:-1] <= d[2:])) + 1
+        if len(dips) == 0:
+            self.confidence = 0.0
+            return np.zeros(1, dtype=np.float32)
+
+        # a dip is the first one under the thresholds between its value and the lowest dip
+        # before it
+        values = d[dips]
+        lowest_before = np.minimum.accumulate(np.concatenate(([1.0], values[:-1])))
+        probs = np.maximum(self._prior_cdf(lowest_before) - self._prior_cdf(values), 0.0)
+        self.confidence = np.float32(min(np.sum(probs), 1.0))
+        if self.confidence == 0.0:
+            return np.zeros(1, dtype=np.float32)
+
+        best = dips[np.argmax(probs)]
+        # parabolic interpolation of the dip
+        left, mid, right = d[best - 1], d[best], d[best + 1]
+        curve = left - 2 * mid + right
+        offset = 0.5 * (left - right) / curve if curve > 0 else 0.0
+        lag = lo - 1 + best + offset
+        freq = self.sample_rate / lag
+        return np.array([69 + 12 * np.log2(freq / 440.0)], dtype=np.float32)
+
+    def get_confidence(self):
+        return self.confidence
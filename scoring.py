@@ -0,0 +1,250 @@
+# time-based scoring. A perfectly sung note is worth songpkg.POINTS_PER_SECOND points per
+# second of its duration, whatever the frame rate: points are integrated over spans of song
+# time (from the audio clock), not counted per frame. The max score of a chart is the score
+# of singing all of its notes perfectly.
+#
+# Players don't have to sing in the chart's key or octave: the engine can score against the
+# chart transposed by a per-player offset, or by pitch class only (any octave counts), and a
+# RangeDetector picks the octave a player sings in from their first seconds of singing.
+
+import numpy as np
+
+import songpkg
+
+# how far off (in semitones) a pitch can be and still earn full points, and how far off it
+# can be and still earn some
+PERFECT_WINDOW = 0.1
+SLOP_WINDOW = 0.3
+
+# pitches only earn points when sung louder than this: quieter readings are silence or noise
+MIN_VOLUME = 5
+
+# the octave shifts (semitones) the range detector chooses from, how much singing inside
+# notes it listens to before choosing, and the confidence a reading needs to be heard
+OCTAVE_SHIFTS = (-24, -12, 0, 12, 24)
+DETECT_SECONDS = 5.0
+DETECT_CONFIDENCE = 0.7
+
+
+class ScoringEngine(object):
+    """
+    Scores a performance of a chart. Each call to :meth:`score_spans` scores spans of song
+    time, each sung at a single pitch, and adds their points to :attr:`score`.
+    """
+
+    def __init__(
+        self,
+        notes,
+        points_per_second=songpkg.POINTS_PER_SECOND,
+        transpose=0,
+        octave_equivalent=False,
+    ):
+        """
+        :param notes: the chart, a notes array (see ``songpkg.NOTE_DTYPE``).
+        :param points_per_second: points earned per second of perfectly sung notes.
+        :param transpose: semitones the player sings away from the chart.
+        :param octave_equivalent: if True, only pitch classes are compared, so any octave
+            of a note counts as the note.
+        """
+        super(ScoringEngine, self).__init__()
+        self.points_per_second = points_per_second
+        self.octave_equivalent = octave_equivalent
+
+        order = np.argsort(notes["start"], kind="stable")
+        self.starts = np.asarray(notes["start"], dtype=float)[order]
+        self.ends = self.starts + np.asarray(notes["duration"], dtype=float)[order]
+        self.pitches = np.asarray(notes["pitch"], dtype=float)[order]
+        # the latest end of all notes so far, to find the notes overlapping a span
+        self.ends_max = np.maximum.accumulate(self.ends)
+
+        self.max_score = songpkg.chart_max_score(notes, points_per_second)
+        self.score = 0.0
+        self.set_transpose(transpose)
+
+    def reset(self):
+        self.score = 0.0
+
+    def set_transpose(self, transpose):
+        """
+        Sets the player's offset from the chart. The pitch each note expects is precomputed
+        here, once, so scoring costs the same whatever the offset.
+
+        :param transpose: semitones the player sings away from the chart.
+        """
+        self.transpose = transpose
+        self.targets = self.pitches + transpose
+
+    def distance(self, pitch, target):
+        """
+        :returns: how far off (in semitones) *pitch* is from *target*. With
+            :attr:`octave_equivalent`, the distance to the closest octave of *target*, at
+            most 6.
+        """
+        off = np.abs(np.asarray(pitch, dtype=float) - target)
+        if self.octave_equivalent:
+            off = np.abs((off + 6) % 12 - 6)
+        return off
+
+    def to_chart(self, pitch, reference=None):
+        """
+        Maps a sung pitch to where it shows on the chart: the player's transpose is undone
+        and, with :attr:`octave_equivalent`, the pitch is moved to the octave closest to
+        *reference* (the note being sung).
+        """
+        pitch = pitch - self.transpose
+        if self.octave_equivalent and reference is not None:
+            pitch = reference + (pitch - reference + 6) % 12 - 6
+        return pitch
+
+    def note_index(self, times):
+        """
+        :returns: for each of *times*, the index of the note being sung then (the latest one
+            to start, if notes overlap), or -1 between notes.
+        """
+        idx = np.searchsorted(self.starts, times, side="right") - 1
+        inside = (idx >= 0) & (self.ends[np.maximum(idx, 0)] > times)
+        return np.where(inside, idx, -1)
+
+    def accuracy(self, amount_off, volume):
+        """
+        :param amount_off: distance to the reference pitch, in semitones.
+        :param volume: how loud the singer is.
+
+        :returns: the fraction of full points earned when louder than :data:`MIN_VOLUME`: 1
+            within :data:`PERFECT_WINDOW`, fading out linearly to 0 at :data:`SLOP_WINDOW`. 0
+            when quieter.
+        """
+        amount_off = np.asarray(amount_off, dtype=float)
+        fade = 1.0 - (amount_off - PERFECT_WINDOW) / (SLOP_WINDOW - PERFECT_WINDOW)
+        fade = np.where(amount_off <= SLOP_WINDOW, np.minimum(fade, 1.0), 0.0)
+        return np.where(np.asarray(volume) > MIN_VOLUME, fade, 0.0)
+
+    def score_spans(self, t0, t1, pitch, volume):
+        """
+        Scores spans of song time ``[t0, t1)``, each sung at a constant pitch. Only the time
+        spent inside notes earns points, split exactly at note boundaries, so splitting a span
+        into smaller ones (ie, rendering at a higher frame rate) doesn't change the result.
+
+        :param t0: start times of the spans (sec).
+        :param t1: end times of the spans (sec).
+        :param pitch: sung pitch of each span, in midi. Either one pitch per span or an array
+            of shape ``(num_spans, k)`` of candidate pitches, the closest of which is scored.
+        :param volume: sung volume of each span.
+
+        :returns: ``(points, accuracy, note)`` arrays: the points earned in each span, its best
+            accuracy (see :meth:`accuracy`) against the notes it overlaps and the index of the
+            last of those notes (-1 if none). The points are also added to :attr:`score`.
+        """
+        t0 = np.atleast_1d(np.asarray(t0, dtype=float))
+        t1 = np.maximum(np.atleast_1d(np.asarray(t1, dtype=float)), t0)
+        num_spans = len(t0)
+        pitch = np.asarray(pitch, dtype=float).reshape(num_spans, -1)
+        volume = np.broadcast_to(np.asarray(volume, dtype=float), (num_spans,))
+
+        # the notes overlapping each span are a contiguous range [lo, hi): they start before
+        # the span ends, and are not entirely before it. Spans are short (a frame or a hop),
+        # so each overlaps no more than a couple of notes.
+        hi = np.searchsorted(self.starts, t1, side="left")
+        lo = np.minimum(np.searchsorted(self.ends_max, t0, side="right"), hi)
+        counts = hi - lo
+        span = np.repeat(np.arange(num_spans), counts)
+        note = lo[span] + np.arange(len(span)) - np.repeat(np.cumsum(counts) - counts, counts)
+
+        overlap = np.minimum(t1[span], self.ends[note]) - np.maximum(
+            t0[span], self.starts[note]
+        )
+        overlap = np.maximum(overlap, 0.0)
+        amount_off = np.min(self.distance(pitch[span], self.targets[note][:, None]), axis=1)
+        accuracy = np.where(overlap > 0, self.accuracy(amount_off, volume[span]), 0.0)
+
+        points = np.zeros(num_spans)
+        np.add.at(points, span, accuracy * overlap * self.points_per_second)
+        span_accuracy = np.zeros(num_spans)
+        np.maximum.at(span_accuracy, span, accuracy)
+        span_note = np.full(num_spans, -1)
+        np.maximum.at(span_note, span, np.where(overlap > 0, note, -1))
+
+        self.score += float(np.sum(points))
+        return points, span_accuracy, span_note
+
+
+class RangeDetector(object):
+    """
+    Finds the octave a player sings a chart in. Readings inside notes are collected until
+    :data:`DETECT_SECONDS` of singing have been heard, then the shift from
+    :data:`OCTAVE_SHIFTS` that brings them closest to the notes is added to the engine's
+    transpose. Until then, the engine matches pitch classes only, so that no points are lost
+    while listening.
+    """
+
+    def __init__(self, engine, seconds=DETECT_SECONDS, shifts=OCTAVE_SHIFTS):
+        """
+        :param engine: the :class:`ScoringEngine` to adjust.
+        :param seconds: how much singing inside notes to listen to.
+        :param shifts: candidate octave shifts, in semitones.
+        """
+        super(RangeDetector, self).__init__()
+        self.engine = engine
+        self.seconds = seconds
+        self.shifts = np.asarray(shifts, dtype=float)
+
+        self.offsets = []  # sung pitch minus note pitch, per batch of readings
+        self.sung_time = 0.0
+        self.shift = None
+
+        self.octave_equivalent = engine.octave_equivalent
+        engine.octave_equivalent = True
+
+    @property
+    def done(self):
+        return self.shift is not None
+
+    def cancel(self):
+        """
+        Stops listening and leaves the engine's transpose as it is.
+        """
+        if not self.done:
+            self.shift = 0
+            self.engine.octave_equivalent = self.octave_equivalent
+
+    def add_spans(self, t0, t1, pitch, confidence, volume):
+        """
+        Listens to spans of song time ``[t0, t1)``, each sung at a constant pitch.
+
+        :returns: the chosen shift once enough has been heard, None until then.
+        """
+        if self.done:
+            return self.shift
+
+        t0, t1, pitch, confidence, volume = (
+            np.asarray(a, dtype=float) for a in (t0, t1, pitch, confidence, volume)
+        )
+        note = self.engine.note_index(0.5 * (t0 + t1))
+        heard = (
+            (note >= 0)
+            & (pitch > 0)
+            & (confidence >= DETECT_CONFIDENCE)
+            & (volume > MIN_VOLUME)
+        )
+        self.offsets.append(pitch[heard] - self.engine.targets[note[heard]])
+        self.sung_time += float(np.sum(t1[heard] - t0[heard]))
+
+        if self.sung_time >= self.seconds:
+            self.choose()
+        return self.shift
+
+    def choose(self):
+        """
+        Picks the shift with the smallest median distance to the notes, over a table of the
+        distances of every reading heard to every candidate shift.
+        """
+        offsets = np.concatenate(self.offsets)
+        self.offsets = []
+        if len(offsets) == 0:
+            self.cancel()
+            return
+
+        table = np.abs(offsets[:, None] - self.shifts[None, :])
+        self.shift = int(self.shifts[np.argmin(np.median(table, axis=0))])
+        self.engine.octave_equivalent = self.octave_equivalent
+        self.engine.set_transpose(self.engine.transpose + self.shift)
@@ -0,0 +1,175 @@
+# session logs. While a song plays, the game can record everything that affects its score:
+# the pitch readings of every analysis hop, the song clock and the game's inputs at every
+# frame, and key presses. Replaying a log through GameDisplay (`python harmony_hero.py
+# replay`) reproduces the session exactly, without a microphone, sound card or window.
+#
+# A log is a header followed by records, all little-endian:
+#
+#   header   MAGIC, u16 format version, u32 length, JSON metadata (song, scoring settings)
+#   record   u8 kind, u32 payload length, payload
+#
+# Payloads:
+#
+#   FRAME    f8 song time, u8 paused, f4 pitch, f4 confidence, f4 volume, u16 n,
+#            then n readings of READING_DTYPE
+#   KEY      f8 song time, key name (utf-8)
+#   END      f8 song time, f8 score
+#
+# Pitch and confidence come from the pitch methods (pitchtrack.py) as float32, and so does
+# volume, so storing them as f4 is lossless and a replay scores exactly like the session did.
+
+import collections
+import json
+import os
+import struct
+import time
+
+import numpy as np
+
+MAGIC = b"HHSL"
+FORMAT_VERSION = 1
+
+# file extension of session logs
+EXTENSION = ".hhs"
+
+FRAME, KEY, END = 1, 2, 3
+
+READING_DTYPE = np.dtype(
+    [("time", "<f8"), ("pitch", "<f4"), ("confidence", "<f4"), ("volume", "<f4")]
+)
+
+_HEADER = struct.Struct("<4sHI")
+_RECORD = struct.Struct("<BI")
+_FRAME = struct.Struct("<dBfffH")
+_TIME = struct.Struct("<d")
+_END = struct.Struct("<dd")
+
+Frame = collections.namedtuple(
+    "Frame", ["time", "paused", "pitch", "confidence", "volume", "readings"]
+)
+Key = collections.namedtuple("Key", ["time", "key"])
+End = collections.namedtuple("End", ["time", "score"])
+
+
+def session_path(session_dir, song_id):
+    """
+    :returns: a new log path in *session_dir*, named after the song and the current time.
+        The (empty) file is created, so that sessions started in the same second get
+        different paths: the later ones are numbered ``-2``, ``-3``...
+    """
+    os.makedirs(session_dir, exist_ok=True)
+    stamp = "{}-{}".format(song_id, time.strftime("%Y%m%d-%H%M%S"))
+    n = 1
+    while True:
+        name = stamp if n == 1 else "{}-{}".format(stamp, n)
+        path = os.path.join(session_dir, name + EXTENSION)
+        try:
+            open(path, "xb").close()
+            return path
+        except FileExistsError:
+            n += 1
+
+
+class SessionWriter(object):
+    """
+    Writes a session log. Records are buffered by the file object, so writing a frame costs
+    a couple of small memory copies.
+    """
+
+    def __init__(self, path, meta):
+        """
+        :param path: the log file to create.
+        :param meta: JSON-serializable metadata: the song and the settings the game was
+            scored with.
+        """
+        super(SessionWriter, self).__init__()
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.file = open(path, "wb")
+
+        header = json.dumps(dict(meta, recorded=time.time())).encode()
+        self.file.write(_HEADER.pack(MAGIC, FORMAT_VERSION, len(header)))
+        self.file.write(header)
+
+    def _write(self, kind, payload):
+        self.file.write(_RECORD.pack(kind, len(payload)))
+        self.file.write(payload)
+
+    def write_frame(self, now_time, paused, pitch, confidence, volume, readings=None):
+        """
+        Records the inputs of one call to ``GameDisplay.on_update``.
+
+        :param readings: the pitch readings of the frame, as returned by
+            ``PitchDetector.get_readings`` (shape ``(n, 4)``).
+        """
+        if readings is None:
+            readings = np.zeros((0, 4))
+        rows = np.empty(len(readings), dtype=READING_DTYPE)
+        for i, name in enumerate(READING_DTYPE.names):
+            rows[name] = readings[:, i]
+        self._write(
+            FRAME,
+            _FRAME.pack(now_time, paused, pitch, confidence, volume, len(rows))
+            + rows.tobytes(),
+        )
+
+    def write_key(self, now_time, key):
+        self._write(KEY, _TIME.pack(now_time) + key.encode())
+
+    def write_end(self, now_time, score):
+        self._write(END, _END.pack(now_time, score))
+
+    def close(self):
+        if not self.file.closed:
+            self.file.close()
+
+
+class SessionReader(object):
+    """
+    Reads a session log. Iterating over it yields its records as :class:`Frame`,
+    :class:`Key` and :class:`End` tuples, in the order they were written.
+    """
+
+    def __init__(self, path):
+        super(SessionReader, self).__init__()
+        self.path = path
+        with open(path, "rb") as f:
+            self.data = f.read()
+
+        magic, version, length = _HEADER.unpack_from(self.data, 0)
+        if magic != MAGIC:
+            raise ValueError("{}: not a session log".format(path))
+        if version != FORMAT_VERSION:
+            raise ValueError(
+                "{}: unsupported session log format {}".format(path, version)
+            )
+        start = _HEADER.size
+        self.meta = json.loads(self.data[start : start + length].decode())
+        self.records_start = start + length
+
+    def __iter__(self):
+        data = self.data
+        pos = self.records_start
+        while pos + _RECORD.size <= len(data):
+            kind, length = _RECORD.unpack_from(data, pos)
+            pos += _RECORD.size
+            payload = data[pos : pos + length]
+            pos += length
+            if len(payload) < length:
+                # the game was interrupted while writing the last record
+                return
+
+            if kind == FRAME:
+                now_time, paused, pitch, confidence, volume, n = _FRAME.unpack_from(payload)
+                rows = np.frombuffer(
+                    payload, dtype=READING_DTYPE, count=n, offset=_FRAME.size
+                )
+                readings = np.column_stack(
+                    [rows[name].astype(float) for name in READING_DTYPE.names]
+                ).reshape(-1, 4)
+                yield Frame(now_time, bool(paused), pitch, confidence, volume, readings)
+            elif kind == KEY:
+                (now_time,) = _TIME.unpack_from(payload)
+                yield Key(now_time, payload[_TIME.size :].decode())
+            elif kind == END:
+                yield End(*_END.unpack_from(payload))
@@ -0,0 +1,215 @@
+# smoothing of pitch readings. Every filter here keeps a fixed-size numpy window and does
+# a constant amount of work per reading, however long the song: running sums instead of
+# re-summing the window, and an in-place sorted window for the median.
+
+import math
+
+import numpy as np
+
+# readings below this confidence or volume are ignored. They are what the pitch tracker
+# reports for silence and noise, and would drag the smoothed pitch towards 0.
+MIN_CONFIDENCE = 0.7
+MIN_VOLUME = 5
+
+# the running sums are recomputed from the window this often, so rounding errors don't
+# add up
+RESUM_PERIOD = 1024
+
+
+class RunningMean(object):
+    """
+    Weighted mean of the last *size* values, updated in O(1) per value.
+    """
+
+    def __init__(self, size):
+        super(RunningMean, self).__init__()
+        self.values = np.zeros(size)
+        self.weights = np.zeros(size)
+        self.index = 0
+        self.count = 0
+        self.pushes = 0
+        self.weighted_sum = 0.0
+        self.weight_sum = 0.0
+
+    def reset(self):
+        self.values[:] = 0
+        self.weights[:] = 0
+        self.index = self.count = self.pushes = 0
+        self.weighted_sum = self.weight_sum = 0.0
+
+    def push(self, value, weight=1.0):
+        i = self.index
+        self.weighted_sum += value * weight - self.values[i] * self.weights[i]
+        self.weight_sum += weight - self.weights[i]
+        self.values[i] = value
+        self.weights[i] = weight
+        self.index = (i + 1) % len(self.values)
+        self.count = min(self.count + 1, len(self.values))
+
+        self.pushes += 1
+        if self.pushes % RESUM_PERIOD == 0:
+            self.weighted_sum = float(np.dot(self.values, self.weights))
+            self.weight_sum = float(np.sum(self.weights))
+
+    @property
+    def value(self):
+        """The mean, or None before the first value (or if all weights are 0)."""
+        if self.weight_sum <= 0:
+            return None
+        return self.weighted_sum / self.weight_sum
+
+
+class RunningMedian(object):
+    """
+    Median of the last *size* values. The window is kept sorted, so each new value costs one
+    binary search and one shift of a small fixed-size array.
+    """
+
+    def __init__(self, size):
+        super(RunningMedian, self).__init__()
+        self.values = np.zeros(size)  # in arrival order (ring)
+        self.sorted = np.zeros(size)  # the first count entries, sorted
+        self.index = 0
+        self.count = 0
+
+    def reset(self):
+        self.index = self.count = 0
+
+    def push(self, value):
+        size = len(self.values)
+        s = self.sorted
+        if self.count == size:
+            # remove the oldest value
+            old = np.searchsorted(s[: self.count], self.values[self.index])
+            s[old : self.count - 1] = s[old + 1 : self.count]
+            self.count -= 1
+
+        pos = np.searchsorted(s[: self.count], value)
+        s[pos + 1 : self.count + 1] = s[pos : self.count]
+        s[pos] = value
+        self.count += 1
+
+        self.values[self.index] = value
+        self.index = (self.index + 1) % size
+
+    @property
+    def value(self):
+        """The median, or None before the first value."""
+        n = self.count
+        if n == 0:
+            return None
+        if n % 2:
+            return float(self.sorted[n // 2])
+        return 0.5 * float(self.sorted[n // 2 - 1] + self.sorted[n // 2])
+
+
+class OneEuroFilter(object):
+    """
+    Adaptive low-pass filter (the "1 euro filter"): heavy smoothing while the value holds
+    still, little smoothing (and little lag) while it moves quickly.
+    """
+
+    def __init__(self, min_cutoff=1.0, beta=0.5, d_cutoff=1.0):
+        """
+        :param min_cutoff: cutoff frequency (Hz) when the value is still. Lower is
+            smoother.
+        :param beta: how much the cutoff rises with the speed of the value. Higher is less
+            laggy.
+        :param d_cutoff: cutoff frequency (Hz) for the speed estimate.
+        """
+        super(OneEuroFilter, self).__init__()
+        self.min_cutoff = min_cutoff
+        self.beta = beta
+        self.d_cutoff = d_cutoff
+        self.reset()
+
+    def reset(self):
+        self.value = None
+        self.speed = 0.0
+
+    @staticmethod
+    def _alpha(cutoff, dt):
+        tau = 1.0 / (2 * math.pi * cutoff)
+        return 1.0 / (1.0 + tau / dt)
+
+    def filter(self, value, dt):
+        """
+        :param value: the new raw value.
+        :param dt: time since the previous value (sec).
+
+        :returns: the filtered value.
+        """
+        if self.value is None or dt <= 0:
+            self.value = value
+            return value
+
+        speed = (value - self.value) / dt
+        a = self._alpha(self.d_cutoff, dt)
+        self.speed += a * (speed - self.speed)
+
+        cutoff = self.min_cutoff + self.beta * abs(self.speed)
+        self.value += self._alpha(cutoff, dt) * (value - self.value)
+        return self.value
+
+
+class PitchSmoother(object):
+    """
+    Smooths a stream of pitch readings. Readings are gated on confidence and volume, then fed
+    to three filters, all available after each reading:
+
+    - :attr:`mean`: mean of the last *size* readings, weighted by confidence.
+    - :attr:`median`: median of the last *median_size* readings. Rejects octave errors.
+    - :attr:`smooth`: the median, through a :class:`OneEuroFilter`. Steady but responsive,
+      for display.
+    """
+
+    def __init__(
+        self,
+        size=30,
+        median_size=5,
+        min_confidence=MIN_CONFIDENCE,
+        min_volume=MIN_VOLUME,
+        **euro_params
+    ):
+        """
+        :param euro_params: passed on to :class:`OneEuroFilter`.
+        """
+        super(PitchSmoother, self).__init__()
+        self.min_confidence = min_confidence
+        self.min_volume = min_volume
+        self.running_mean = RunningMean(size)
+        self.running_median = RunningMedian(median_size)
+        self.euro = OneEuroFilter(**euro_params)
+        self.smooth = None
+        self.elapsed = 0.0
+
+    def reset(self):
+        self.running_mean.reset()
+        self.running_median.reset()
+        self.euro.reset()
+        self.smooth = None
+        self.elapsed = 0.0
+
+    def push(self, pitch, confidence, volume, dt):
+        """
+        :param dt: time since the previous reading (sec), whether it was accepted or not.
+
+        :returns: True if the reading passed the gate and updated the filters.
+        """
+        self.elapsed += dt
+        if confidence < self.min_confidence or volume <= self.min_volume or pitch <= 0:
+            return False
+
+        self.running_mean.push(pitch, confidence)
+        self.running_median.push(pitch)
+        self.smooth = self.euro.filter(self.running_median.value, self.elapsed)
+        self.elapsed = 0.0
+        return True
+
+    @property
+    def mean(self):
+        return self.running_mean.value
+
+    @property
+    def median(self):
+        return self.running_median.value
@@ -0,0 +1,417 @@
+# batch building of the song library. Every song source (a chart, stems and artwork) is
+# preprocessed into a song package (see songpkg.py) by a pool of worker processes:
+#
+#   hash      content hash of all the inputs, to skip songs that haven't changed
+#   notes     parse the chart into a notes array
+#   audio     decode the stems, resample them to the game's format if needed, and compute
+#             the RMS envelope of the vocals
+#   package   compute the max score and write the package
+#
+# Packages are written to a temporary directory next to their final location and swapped
+# in once complete, so an interrupted build never leaves a half-written package behind.
+#
+# A song source is either one of the songpkg.LEGACY_SONGS, or a directory holding a
+# song.json like:
+#
+#   {"id": "valerie", "title": "Valerie", "artist": "Amy Winehouse",
+#    "notes": "notes.txt", "transpose": 0,
+#    "stems": {"mix": "mix.wav", "music": "music.wav"},
+#    "artwork": {"background": "bg.png", "record": "vinyl.png",
+#                "gold": "vinyl_gold.png", "platinum": "vinyl_platinum.png"},
+#    "parts": {"alto": "alto.txt"}}
+#
+# with file names relative to that directory. All the stems and artwork above are required (the
+# game plays and shows each of them): a source missing any fails to build. "transpose" and
+# "parts" (harmony parts for duet mode, in the notes format) are optional. Parts already in a package and not in its source,
+# like the ones added with `python harmony_hero.py compile --part`, are kept when it is rebuilt.
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+import wave
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+import songpkg
+
+# bump to rebuild every package after a change to the build itself
+BUILD_VERSION = 3
+
+# the format the game plays stems in (see imslib.audio.Audio and imslib.wavesrc.WaveFile)
+SAMPLE_RATE = 44100
+SAMPLE_WIDTH = 2
+
+# samples per value of the vocal RMS envelope (the pitch tracker's hop size)
+ENVELOPE_HOP = 1024
+
+# frames decoded at a time
+CHUNK_FRAMES = 1 << 18
+
+# remembers the content hash of every input file by (size, mtime), in the library directory
+CACHE_NAME = ".build_cache.json"
+
+STAGES = ("hash", "notes", "audio", "package")
+
+
+def legacy_source(song_id, src_dir=None):
+    """
+    :returns: the song source of one of the ``songpkg.LEGACY_SONGS``.
+    """
+    src_dir = src_dir or songpkg.root_dir
+    info = songpkg.LEGACY_SONGS[song_id]
+    stems, artwork = songpkg.legacy_sources(song_id, src_dir)
+    return {
+        "id": song_id,
+        "title": info["title"],
+        "artist": info["artist"],
+        "notes": os.path.join(src_dir, info["notes"]),
+        "transpose": info["transpose"],
+        "stems": stems,
+        "artwork": artwork,
+        "parts": {},
+    }
+
+
+def read_source(source_dir):
+    """
+    :returns: the song source described by ``song.json`` in *source_dir*, with absolute paths.
+    """
+    with open(os.path.join(source_dir, "song.json")) as f:
+        source = json.load(f)
+
+    def path(name):
+        return os.path.join(source_dir, name)
+
+    source.setdefault("id", os.path.basename(os.path.normpath(source_dir)))
+    source.setdefault("transpose", 0)
+    source["notes"] = path(source["notes"])
+    source["stems"] = {k: path(v) for k, v in source.get("stems", {}).items()}
+    source["artwork"] = {k: path(v) for k, v in source.get("artwork", {}).items()}
+    source["parts"] = {k: path(v) for k, v in source.get("parts", {}).items()}
+    return source
+
+
+def check_source(source):
+    """
+    Raises ValueError if *source* lacks any of the ``songpkg.STEM_NAMES`` or
+    ``songpkg.ARTWORK_NAMES``, which the game needs to play the song.
+    """
+    missing = []
+    for kind, names in (("stems", songpkg.STEM_NAMES), ("artwork", songpkg.ARTWORK_NAMES)):
+        names = [name for name in names if not source[kind].get(name)]
+        if names:
+            missing.append("{} {}".format(kind, ", ".join(names)))
+    if missing:
+        raise ValueError("{}: missing {}".format(source["id"], "; ".join(missing)))
+
+
+def find_sources(src_dirs=(), legacy=True):
+    """
+    :param src_dirs: directories whose subdirectories are song sources (holding a song.json).
+    :param legacy: whether to include the ``songpkg.LEGACY_SONGS``.
+
+    :returns: a list of song sources, sorted by id.
+    """
+    sources = {}
+    if legacy:
+        for song_id in songpkg.LEGACY_SONGS:
+            sources[song_id] = legacy_source(song_id)
+    for src_dir in src_dirs:
+        for name in sorted(os.listdir(src_dir)):
+            if os.path.exists(os.path.join(src_dir, name, "song.json")):
+                source = read_source(os.path.join(src_dir, name))
+                sources[source["id"]] = source
+    return [sources[k] for k in sorted(sources)]
+
+
+def input_files(source):
+    """
+    :returns: the paths of all the files *source* is built from.
+    """
+    files = [source["notes"]]
+    files.extend(source["stems"][k] for k in sorted(source["stems"]))
+    files.extend(source["artwork"][k] for k in sorted(source["artwork"]))
+    files.extend(source["parts"][k] for k in sorted(source["parts"]))
+    return files
+
+
+def file_hash(path, cache):
+    """
+    :param cache: dictionary of path to ``[size, mtime_ns, hash]``, updated in place.
+
+    :returns: the sha1 hex digest of the file, reused from *cache* when its size and
+        modification time are unchanged.
+    """
+    st = os.stat(path)
+    cached = cache.get(path)
+    if cached is not None and cached[0] == st.st_size and cached[1] == st.st_mtime_ns:
+        return cached[2]
+
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    cache[path] = [st.st_size, st.st_mtime_ns, h.hexdigest()]
+    return cache[path][2]
+
+
+def source_hash(source, cache):
+    """
+    :returns: a hash of everything that goes into the package of *source*.
+    """
+    h = hashlib.sha1()
+    files = ("notes", "stems", "artwork", "parts")
+    settings = {k: v for k, v in source.items() if k not in files}
+    h.update(json.dumps([BUILD_VERSION, settings], sort_keys=True).encode())
+    h.update(json.dumps(sorted(source["stems"])).encode())
+    h.update(json.dumps(sorted(source["artwork"])).encode())
+    h.update(json.dumps(sorted(source["parts"])).encode())
+    for path in input_files(source):
+        h.update(file_hash(path, cache).encode())
+    return h.hexdigest()
+
+
+def _read_frames(wav, num_frames):
+    raw = wav.readframes(num_frames)
+    samples = np.frombuffer(raw, dtype=np.int16).astype(np.float32) * (1 / 32768.0)
+    return samples.reshape(-1, wav.getnchannels())
+
+
+def convert_wave(src, dst, sample_rate=SAMPLE_RATE):
+    """
+    Converts a 16 bit wave file to *sample_rate* (linear interpolation), block by block.
+    """
+    with wave.open(src, "rb") as wav, wave.open(dst, "wb") as out:
+        if wav.getsampwidth() != SAMPLE_WIDTH:
+            raise ValueError("{}: only 16 bit wave files are supported".format(src))
+        channels = wav.getnchannels()
+        ratio = wav.getframerate() / sample_rate
+        out.setnchannels(channels)
+        out.setsampwidth(SAMPLE_WIDTH)
+        out.setframerate(sample_rate)
+
+        # output frame k is input frame k * ratio. Keep one frame of the previous block,
+        # to interpolate across block boundaries.
+        prev = np.zeros((0, channels), dtype=np.float32)
+        in_start = 0  # input frame index of prev[0]
+        out_pos = 0
+        total_in = wav.getnframes()
+        total_out = int(total_in / ratio)
+        while out_pos < total_out:
+            block = _read_frames(wav, CHUNK_FRAMES)
+            if len(block) == 0:
+                break
+            frames = np.concatenate((prev, block))
+            in_end = in_start + len(frames) - 1
+            last = total_out if in_end >= total_in - 1 else int(in_end / ratio)
+            positions = np.arange(out_pos, last) * ratio - in_start
+            idx = np.arange(len(frames))
+            resampled = np.stack(
+                [np.interp(positions, idx, frames[:, c]) for c in range(channels)], axis=1
+            )
+            out.writeframes(
+                (np.clip(resampled, -1.0, 1.0) * 32767).astype(np.int16).tobytes()
+            )
+            out_pos = last
+            prev = frames[-1:]
+            in_start = in_end
+
+
+def _mono_blocks(path):
+    with wave.open(path, "rb") as wav:
+        while True:
+            block = _read_frames(wav, CHUNK_FRAMES)
+            if len(block) == 0:
+                break
+            yield block.mean(axis=1)
+
+
+def vocal_envelope(mix_path, music_path=None, hop=ENVELOPE_HOP):
+    """
+    :returns: float32 RMS of the vocals (the mix minus the music) for every *hop* samples.
+    """
+    levels = []
+    music = _mono_blocks(music_path) if music_path else None
+    leftover = np.zeros(0, dtype=np.float32)
+    for block in _mono_blocks(mix_path):
+        if music is not None:
+            other = next(music, np.zeros(0, dtype=np.float32))[: len(block)]
+            block[: len(other)] -= other
+        block = np.concatenate((leftover, block))
+        n = len(block) // hop
+        hops = block[: n * hop].reshape(n, hop)
+        leftover = block[n * hop :]
+        levels.append(np.sqrt(np.mean(np.square(hops), axis=1)))
+    if not levels:
+        return np.zeros(0, dtype=np.float32)
+    return np.concatenate(levels).astype(np.float32)
+
+
+def _wave_format(path):
+    with wave.open(path, "rb") as wav:
+        return wav.getframerate(), wav.getsampwidth()
+
+
+def build_song(source, lib_dir, cache, force=False):
+    """
+    Builds the package of one song source, unless it is up to date. Runs in a worker process.
+
+    :param cache: file hash cache (see :func:`file_hash`) for this song's inputs.
+    :param force: build even if the inputs are unchanged.
+
+    :returns: a dictionary with the song ``id``, its ``status`` (``"built"``, ``"skipped"``
+        or ``"failed"``), an ``error`` message, ``timings`` of each stage in seconds, and the
+        updated ``cache``.
+    """
+    result = {"id": source["id"], "status": "built", "error": None, "timings": {}}
+    timings = result["timings"]
+    out_dir = os.path.join(lib_dir, source["id"])
+    tmp_dir = None
+
+    try:
+        check_source(source)
+        t = time.perf_counter()
+        # the harmony parts of the existing package are built into the new one, unless the
+        # source has its own version of them
+        parts = songpkg.package_parts(out_dir)
+        parts.update(source["parts"])
+        source = dict(source, parts=parts)
+        digest = source_hash(source, cache)
+        timings["hash"] = time.perf_counter() - t
+
+        if not force:
+            try:
+                with open(os.path.join(out_dir, "manifest.json")) as f:
+                    if json.load(f).get("source_hash") == digest:
+                        result["status"] = "skipped"
+                        return result
+            except (OSError, ValueError):
+                pass
+
+        t = time.perf_counter()
+        notes = songpkg.read_notes_txt(source["notes"], source["transpose"])
+        parts = {
+            name: songpkg.read_part(path, source["transpose"])
+            for name, path in source["parts"].items()
+        }
+        timings["notes"] = time.perf_counter() - t
+
+        t = time.perf_counter()
+        os.makedirs(lib_dir, exist_ok=True)
+        tmp_dir = tempfile.mkdtemp(prefix="." + source["id"] + ".", dir=lib_dir)
+        work_dir = os.path.join(tmp_dir, "work")
+        os.mkdir(work_dir)
+        stems = {}
+        for name, path in source["stems"].items():
+            if _wave_format(path) == (SAMPLE_RATE, SAMPLE_WIDTH):
+                stems[name] = path
+            else:
+                stems[name] = os.path.join(work_dir, name + ".wav")
+                convert_wave(path, stems[name])
+        extra = {"source_hash": digest}
+        if "mix" in stems:
+            envelope = vocal_envelope(stems["mix"], stems.get("music"))
+            np.save(os.path.join(work_dir, "envelope.npy"), envelope)
+            extra["envelope"] = "envelope.npy"
+            extra["envelope_hop"] = ENVELOPE_HOP
+        timings["audio"] = time.perf_counter() - t
+
+        t = time.perf_counter()
+        pkg_dir = os.path.join(tmp_dir, "package")
+        songpkg.compile_package(
+            pkg_dir,
+            source["id"],
+            source["title"],
+            source["artist"],
+            notes,
+            stems,
+            source["artwork"],
+            extra,
+            parts,
+        )
+        if "envelope" in extra:
+            os.replace(
+                os.path.join(work_dir, "envelope.npy"),
+                os.path.join(pkg_dir, "envelope.npy"),
+            )
+
+        # swap the finished package in
+        old_dir = os.path.join(tmp_dir, "old")
+        if os.path.exists(out_dir):
+            os.replace(out_dir, old_dir)
+        os.replace(pkg_dir, out_dir)
+        timings["package"] = time.perf_counter() - t
+
+    except Exception as e:
+        result["status"] = "failed"
+        result["error"] = "{}: {}".format(type(e).__name__, e)
+
+    finally:
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        result["cache"] = cache
+
+    return result
+
+
+def _load_cache(lib_dir):
+    try:
+        with open(os.path.join(lib_dir, CACHE_NAME)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_cache(lib_dir, cache):
+    path = os.path.join(lib_dir, CACHE_NAME)
+    with open(path + ".tmp", "w") as f:
+        json.dump(cache, f)
+    os.replace(path + ".tmp", path)
+
+
+def build_library(sources, lib_dir=None, workers=None, force=False, progress=None):
+    """
+    Builds the packages of *sources* in parallel.
+
+    :param lib_dir: the library directory. Defaults to ``songpkg.library_dir``.
+    :param workers: number of worker processes. Defaults to the number of cpus.
+    :param force: rebuild every package, even unchanged ones.
+    :param progress: optional function called with each result of :func:`build_song`, as
+        songs complete.
+
+    :returns: the results of :func:`build_song`, in the order of *sources*.
+    """
+    lib_dir = lib_dir or songpkg.library_dir
+    os.makedirs(lib_dir, exist_ok=True)
+    cache = _load_cache(lib_dir)
+
+    def song_cache(source):
+        return {p: cache[p] for p in input_files(source) if p in cache}
+
+    results = {}
+    if workers == 1:
+        for source in sources:
+            result = build_song(source, lib_dir, song_cache(source), force)
+            results[source["id"]] = result
+            if progress:
+                progress(result)
+    else:
+        with ProcessPoolExecutor(workers) as executor:
+            futures = [
+                executor.submit(build_song, source, lib_dir, song_cache(source), force)
+                for source in sources
+            ]
+            for future in as_completed(futures):
+                result = future.result()
+                results[result["id"]] = result
+                if progress:
+                    progress(result)
+
+    for result in results.values():
+        cache.update(result.pop("cache"))
+    _save_cache(lib_dir, cache)
+    return [results[source["id"]] for source in sources]
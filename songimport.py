@@ -0,0 +1,297 @@
+# importer for the note lists in songs/. Most of those files hold long lists of midi note
+# tuples
+#
+#   (pitch, start, len); (pitch, start, len); ...
+#
+# with start and len in ticks, and pitch 0 marking a rest. Some lists (songs/allstar_data)
+# store the end tick instead of the length; read_tuples() tells the two apart.
+# Ticks are converted to seconds through a TempoMap, and the result is a notes array (see
+# songpkg.py) ready to be compiled into a song package. The lists carry no tempo, so the map is
+# usually fitted to the song's txt chart (fit_tempo_map()). Files in the txt chart format
+# (songs/valerie_data.txt) are already in seconds, but may start at another point of the song:
+# they are shifted to line up with the chart (fit_offset()). Both fits leave some of the chart's
+# notes out (split_reference()), and the import is checked against those (check_consistency()).
+
+import difflib
+import re
+
+import numpy as np
+
+import songpkg
+
+TUPLE_RE = re.compile(rb"\(\s*(-?\d+)\s*,\s*(-?\d+)\s*,\s*(-?\d+)\s*\)")
+
+# ticks per quarter note, as in imslib.clock
+TICKS_PER_QUARTER = 480
+
+# velocity of imported notes, the same as the one in the txt charts (100 / 127)
+DEFAULT_VELOCITY = 100 / 127
+
+# every HOLDOUT_STEP-th note of the txt chart is left out of the tempo map (or offset) fit,
+# and the import is checked against those notes only: the fitted ones line up by construction
+HOLDOUT_STEP = 5
+
+# an import is refused unless this fraction of the txt chart's notes have a match, and the 95th
+# percentiles of the start and duration differences (sec) of the held out notes are within these
+MIN_MATCHED = 0.9
+MAX_START_ERROR = 0.25
+MAX_DURATION_ERROR = 0.25
+
+# the legacy songs that have a note list in songs/
+LEGACY_IMPORT_FILES = {
+    "allstar": "songs/allstar_data",
+    "bohemian": "songs/bohemian_data.txt",
+    "valerie": "songs/valerie_data.txt",
+}
+
+
+class TempoMap(object):
+    """
+    Maps ticks to seconds by linear interpolation between ``(time, tick)`` points, like
+    ``imslib.clock.TempoMap``, without importing imslib.clock and the audio and kivy modules
+    it pulls in.
+    """
+
+    def __init__(self, data):
+        """
+        :param data: a list of ``(time, tick)`` points, starting at ``(0, 0)``.
+        """
+        super(TempoMap, self).__init__()
+        if len(data) < 2 or tuple(data[0]) != (0, 0):
+            raise ValueError("a tempo map needs points from (0, 0) on")
+        self.times, self.ticks = (np.array(a, dtype=float) for a in zip(*data))
+
+    def tick_to_time(self, tick):
+        """
+        :returns: the time (sec) of *tick*, a number or an array.
+        """
+        return np.interp(tick, self.ticks, self.times)
+
+
+def is_tuple_list(filepath):
+    """
+    :returns: True if *filepath* holds ``(pitch, start, len)`` tuples, False if it is in the
+        txt chart format (see ``songpkg.read_notes_txt``).
+    """
+    with open(filepath, "rb") as f:
+        return TUPLE_RE.search(f.read(4096)) is not None
+
+
+def read_tuples(filepath, third=None):
+    """
+    Parses a file of ``(pitch, start, len)`` tuples in one pass.
+
+    :param third: what the third value of each tuple is: ``"len"`` or ``"end"`` (in ticks).
+        If None, it is ``"end"`` when no tuple ends before it starts, ``"len"`` otherwise.
+
+    :returns: an int array of shape ``(n, 3)`` of pitch, start tick and length in ticks, in file
+        order. Rests are included.
+    """
+    with open(filepath, "rb") as f:
+        matches = TUPLE_RE.findall(f.read())
+    if not matches:
+        raise ValueError("{}: no (pitch, start, len) tuples found".format(filepath))
+
+    data = np.array(matches, dtype=np.int64)
+    if third is None:
+        third = "end" if np.all(data[:, 2] >= data[:, 1]) else "len"
+    if third == "end":
+        data[:, 2] -= data[:, 1]
+    elif third != "len":
+        raise ValueError("third must be 'len' or 'end', not {!r}".format(third))
+    return data
+
+
+def constant_tempo_map(bpm, last_tick, ticks_per_quarter=TICKS_PER_QUARTER):
+    """
+    :returns: a :class:`TempoMap` of a constant *bpm* that covers ticks up to *last_tick*.
+    """
+    last_tick = max(int(last_tick), ticks_per_quarter)
+    seconds_per_tick = 60.0 / (bpm * ticks_per_quarter)
+    return TempoMap(data=[(0, 0), (last_tick * seconds_per_tick, last_tick)])
+
+
+def tuples_to_notes(data, tempo_map, transpose=0, velocity=DEFAULT_VELOCITY):
+    """
+    Converts tuples from :func:`read_tuples` into a notes array. Rests (pitch 0) and notes
+    with no length are dropped.
+
+    :param tempo_map: the :class:`TempoMap` that maps ticks to seconds.
+    :param transpose: semitones added to every pitch.
+
+    :returns: a notes array of ``songpkg.NOTE_DTYPE``, sorted by start time.
+    """
+    data = data[(data[:, 0] > 0) & (data[:, 2] > 0)]
+    start = tempo_map.tick_to_time(data[:, 1])
+    end = tempo_map.tick_to_time(data[:, 1] + data[:, 2])
+    return songpkg.make_notes(start, end - start, data[:, 0] + transpose, velocity)
+
+
+def match_notes(notes, reference):
+    """
+    Pairs up the notes of two charts of the same song by aligning their pitch sequences.
+    Pitches are compared as pitch classes, so charts an octave apart still line up.
+
+    :returns: two index arrays ``(i, j)``, such that ``notes[i]`` matches ``reference[j]``.
+    """
+    a = np.round(notes["pitch"]).astype(int) % 12
+    b = np.round(reference["pitch"]).astype(int) % 12
+    matcher = difflib.SequenceMatcher(None, a.tolist(), b.tolist(), autojunk=False)
+    i, j = [], []
+    for block in matcher.get_matching_blocks():
+        i.extend(range(block.a, block.a + block.size))
+        j.extend(range(block.b, block.b + block.size))
+    return np.array(i, dtype=int), np.array(j, dtype=int)
+
+
+def fit_tempo_map(data, reference):
+    """
+    Builds a tempo map that places imported notes at the times of the matching notes in
+    *reference*, for songs whose tuple list has no tempo information.
+
+    :param data: tuples from :func:`read_tuples`.
+    :param reference: a notes array of the same song, in seconds.
+
+    :returns: a :class:`TempoMap`.
+    """
+    notes = data[(data[:, 0] > 0) & (data[:, 2] > 0)]
+    order = np.argsort(notes[:, 1], kind="stable")
+    ticks = notes[order, 1]
+
+    # match in tick units first: a constant tempo keeps the note order
+    unit = songpkg.make_notes(ticks, notes[order, 2], notes[order, 0])
+    i, j = match_notes(unit, reference)
+    if len(i) < 2:
+        raise ValueError("too few matching notes to fit a tempo map")
+    ticks = ticks[i]
+    times = reference["start"][j]
+
+    # keep the points where both ticks and times strictly increase
+    keep = np.ones(len(ticks), dtype=bool)
+    last_tick, last_time = 0, 0.0
+    for k in range(len(ticks)):
+        if ticks[k] > last_tick and times[k] > last_time:
+            last_tick, last_time = ticks[k], times[k]
+        else:
+            keep[k] = False
+    ticks, times = ticks[keep], times[keep]
+
+    # extend past the last match at the tempo of the last segment
+    last_end = int(np.max(notes[:, 1] + notes[:, 2]))
+    points = [(0, 0)] + list(zip(times.tolist(), ticks.tolist()))
+    if last_end > ticks[-1]:
+        if len(ticks) > 1:
+            rate = (times[-1] - times[-2]) / (ticks[-1] - ticks[-2])
+        else:
+            rate = times[-1] / ticks[-1]
+        points.append((times[-1] + (last_end - ticks[-1]) * rate, last_end))
+    return TempoMap(data=points)
+
+
+def split_reference(reference, step=HOLDOUT_STEP):
+    """
+    :returns: ``(fitted, held_out)``: the notes of *reference* to fit to, and a boolean mask
+        of the notes of *reference* held out of the fit (every *step*-th one).
+    """
+    held_out = np.arange(len(reference)) % step == step - 1
+    return reference[~held_out], held_out
+
+
+def fit_offset(notes, reference):
+    """
+    Shifts a chart in seconds to line up with *reference*, a chart of the same song that may
+    start at another point of the song.
+
+    :returns: ``(notes, offset)``: a shifted copy of *notes*, and the offset added to their
+        start times (sec).
+    """
+    i, j = match_notes(notes, reference)
+    if len(i) == 0:
+        raise ValueError("no matching notes to fit an offset")
+    offset = float(np.median(reference["start"][j] - notes["start"][i]))
+    notes = np.array(notes)
+    notes["start"] += offset
+    return notes, offset
+
+
+def check_consistency(notes, reference, held_out=None):
+    """
+    Compares an imported chart to a reference chart of the same song, like the txt charts
+    the game shipped with.
+
+    :param held_out: optional boolean mask of the reference notes that the import wasn't
+        fitted to (see :func:`split_reference`). Timing errors are measured on those only.
+
+    :returns: a dictionary of:
+
+        - ``num_notes``, ``num_reference``: the note counts.
+        - ``matched``: the fraction of reference notes that have a matching imported note.
+        - ``checked``: the number of matched notes whose timing is measured.
+        - ``octave_offset``: median pitch difference of matched notes, in octaves.
+        - ``start_error``: median and 95th percentile of the absolute start time difference
+          of checked notes, in seconds.
+        - ``duration_error``: median and 95th percentile of the absolute duration difference
+          of checked notes, in seconds.
+    """
+    i, j = match_notes(notes, reference)
+    result = {
+        "num_notes": len(notes),
+        "num_reference": len(reference),
+        "matched": len(j) / max(1, len(reference)),
+        "checked": 0,
+        "octave_offset": None,
+        "start_error": None,
+        "duration_error": None,
+    }
+    if len(i):
+        result["octave_offset"] = int(
+            np.round(np.median(notes["pitch"][i] - reference["pitch"][j]) / 12)
+        )
+    if held_out is not None:
+        keep = held_out[j]
+        i, j = i[keep], j[keep]
+    result["checked"] = len(i)
+    if len(i):
+        a, b = notes[i], reference[j]
+        start_error = np.abs(a["start"] - b["start"])
+        duration_error = np.abs(a["duration"] - b["duration"])
+        result["start_error"] = (
+            float(np.median(start_error)),
+            float(np.percentile(start_error, 95)),
+        )
+        result["duration_error"] = (
+            float(np.median(duration_error)),
+            float(np.percentile(duration_error, 95)),
+        )
+    return result
+
+
+def consistency_problems(check):
+    """
+    :param check: the result of :func:`check_consistency`.
+
+    :returns: the reasons (strings) to refuse the import, if any.
+    """
+    problems = []
+    if check["matched"] < MIN_MATCHED:
+        problems.append(
+            "only {:.0%} of the notes match (at least {:.0%} needed)".format(
+                check["matched"], MIN_MATCHED
+            )
+        )
+    if check["start_error"] is None:
+        problems.append("no notes to check the timing of")
+        return problems
+    if check["start_error"][1] > MAX_START_ERROR:
+        problems.append(
+            "start times are off by up to {:.3f}s (95th percentile, at most {}s)".format(
+                check["start_error"][1], MAX_START_ERROR
+            )
+        )
+    if check["duration_error"][1] > MAX_DURATION_ERROR:
+        problems.append(
+            "durations are off by up to {:.3f}s (95th percentile, at most {}s)".format(
+                check["duration_error"][1], MAX_DURATION_ERROR
+            )
+        )
+    return problems
@@ -0,0 +1,168 @@
+# the song library index. A library is a directory of song packages (see songpkg.py). The
+# index caches the metadata of every package in a single JSON-lines file, one song per line,
+# so that the song select screen can list thousands of songs without opening a single
+# manifest, chart or audio file. refresh() brings the index up to date by only re-reading
+# the manifests whose modification time changed since the last refresh.
+
+import json
+import os
+
+import songpkg
+
+INDEX_NAME = "index.jsonl"
+
+# the manifest values copied into the index
+INDEXED_KEYS = (
+    "id",
+    "title",
+    "artist",
+    "duration",
+    "num_notes",
+    "pitch_range",
+    "max_score",
+    "stems",
+    "artwork",
+)
+
+
+class SongIndex(object):
+    """
+    Metadata of all the songs in a library directory. Each entry is a dictionary of the
+    :data:`INDEXED_KEYS` values of a package's manifest, plus:
+
+    - ``dir``: the name of the package directory in the library.
+    - ``mtime``: modification time of the manifest when it was indexed.
+    - ``thumbnail``: path of the small image to show when browsing, relative to the package
+      (the record artwork itself for packages compiled without a thumbnail), or None.
+
+    Entries are sorted by title, then artist.
+    """
+
+    def __init__(self, lib_dir=None, index_path=None):
+        """
+        :param lib_dir: the library directory. Defaults to ``songpkg.library_dir``.
+        :param index_path: where to store the index. Defaults to ``index.jsonl`` in *lib_dir*.
+        """
+        super(SongIndex, self).__init__()
+        self.lib_dir = lib_dir or songpkg.library_dir
+        self.index_path = index_path or os.path.join(self.lib_dir, INDEX_NAME)
+        self.entries = []
+        self.by_id = {}
+        self._load()
+
+    def _load(self):
+        entries = []
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                for line in f:
+                    line = line.strip()
+                    if line:
+                        entries.append(json.loads(line))
+        self._set_entries(entries)
+
+    def _set_entries(self, entries):
+        entries.sort(key=lambda e: (e["title"].lower(), e["artist"].lower(), e["id"]))
+        self.entries = entries
+        self.by_id = {e["id"]: e for e in entries}
+
+    def _save(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.index_path)), exist_ok=True)
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            for e in self.entries:
+                f.write(json.dumps(e))
+                f.write("\n")
+        os.replace(tmp_path, self.index_path)
+
+    def refresh(self):
+        """
+        Scans the library directory and updates the entries of packages that were added,
+        changed or removed since the last refresh. Only the manifests of new or changed
+        packages are read. The index file is rewritten if anything changed.
+
+        :returns: ``(added, updated, removed)`` counts.
+        """
+        old = {e["dir"]: e for e in self.entries}
+        entries = []
+        added = updated = 0
+
+        if os.path.isdir(self.lib_dir):
+            with os.scandir(self.lib_dir) as it:
+                for d in it:
+                    if not d.is_dir():
+                        continue
+                    manifest_path = os.path.join(d.path, "manifest.json")
+                    try:
+                        mtime = os.stat(manifest_path).st_mtime
+                    except FileNotFoundError:
+                        continue
+
+                    entry = old.get(d.name)
+                    if entry is not None and entry["mtime"] == mtime:
+                        entries.append(entry)
+                        continue
+
+                    try:
+                        entries.append(self._read_entry(d.name, manifest_path, mtime))
+                    except (ValueError, KeyError) as e:
+                        print("warning: skipping song package {}: {!r}".format(d.path, e))
+                        continue
+                    if entry is None:
+                        added += 1
+                    else:
+                        updated += 1
+
+        removed = len(old) - (len(entries) - added)
+        if added or updated or removed or not os.path.exists(self.index_path):
+            self._set_entries(entries)
+            self._save()
+        return added, updated, removed
+
+    def _read_entry(self, dir_name, manifest_path, mtime):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        if manifest.get("format") != songpkg.FORMAT_VERSION:
+            raise ValueError("unsupported format {}".format(manifest.get("format")))
+
+        entry = {key: manifest[key] for key in INDEXED_KEYS}
+        entry["dir"] = dir_name
+        entry["mtime"] = mtime
+        entry["thumbnail"] = manifest.get("thumbnail") or manifest["artwork"].get("record")
+        return entry
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, song_id):
+        """
+        :returns: the entry of *song_id*, or None if it is not in the library.
+        """
+        return self.by_id.get(song_id)
+
+    def num_pages(self, page_size):
+        """
+        :returns: the number of pages of *page_size* entries (at least 1).
+        """
+        return max(1, -(-len(self.entries) // page_size))
+
+    def page(self, page, page_size):
+        """
+        :returns: the entries on page number *page* (starting at 0), *page_size* per page.
+        """
+        start = page * page_size
+        return self.entries[start:start + page_size]
+
+    def package_path(self, entry, name=None):
+        """
+        :param name: a file name inside the package, like ``entry["thumbnail"]``.
+
+        :returns: the path of *entry*'s package directory, or of the file *name* in it.
+        """
+        path = os.path.join(self.lib_dir, entry["dir"])
+        return path if name is None else os.path.join(path, name)
+
+    def load_song(self, song_id):
+        """
+        :returns: the :class:`songpkg.Song` of *song_id*.
+        """
+        return songpkg.Song(self.package_path(self.by_id[song_id]))
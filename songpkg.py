@@ -0,0 +1,395 @@
+# song packages. A song package is a directory holding everything the game needs to play
+# one song:
+#
+#   manifest.json   metadata, precomputed values and the names of the files below
+#   notes.npy       the chart, as a structured array of (start, duration, pitch, velocity)
+#   part_*.npy      optional harmony parts, in the same format, for duet mode
+#   *.wav           audio stems
+#   *.png           artwork
+#   thumbnail.png   a small copy of the record artwork, for browsing the library
+#
+# Packages are built by compile_package() (or `python harmony_hero.py compile`) and loaded
+# by load_song(), which memory-maps the notes instead of parsing text.
+
+import json
+import os
+import shutil
+
+import numpy as np
+
+FORMAT_VERSION = 1
+
+# root of this checkout, where the legacy assets live
+root_dir = os.path.dirname(os.path.abspath(__file__))
+
+# where compiled packages go by default
+library_dir = os.path.join(root_dir, "library")
+
+# one row per note. start and duration are in seconds, pitch is in (fractional) midi.
+NOTE_DTYPE = np.dtype(
+    [("start", "<f8"), ("duration", "<f8"), ("pitch", "<f8"), ("velocity", "<f4")]
+)
+
+# the roles of the stems played by AudioController, and of the artwork used by GameDisplay
+STEM_NAMES = ("mix", "music")
+ARTWORK_NAMES = ("background", "record", "gold", "platinum")
+
+# largest width or height (pixels) of package thumbnails
+THUMBNAIL_SIZE = 128
+
+# points per second of perfectly sung notes (100 points per frame at 60 fps, as the game used
+# to score). The max score of a chart is derived from it.
+POINTS_PER_SECOND = 100 * 60
+
+# the songs that shipped as loose files in the root of the repo. The notes files hold one
+# note per line: start (sec), pitch (Hz), duration (sec), velocity, separated by tabs.
+LEGACY_SONGS = {
+    "allstar": {
+        "title": "All Star",
+        "artist": "Smash Mouth",
+        "notes": "allstar_notes.txt",
+        "transpose": -12,
+    },
+    "valerie": {
+        "title": "Valerie",
+        "artist": "Amy Winehouse",
+        "notes": "valerie_notes.txt",
+        "transpose": 0,
+    },
+    "bohemian": {
+        "title": "Bohemian Rhapsody",
+        "artist": "Queen",
+        "notes": "bohemian_notes.txt",
+        "transpose": 0,
+    },
+}
+
+
+class Song(object):
+    """
+    A loaded song package. ``notes`` is a read-only, memory-mapped array of :data:`NOTE_DTYPE`,
+    sorted by start time. ``stems`` and ``artwork`` map role names to absolute file paths.
+    ``parts`` maps part names to notes arrays: ``"lead"`` (the chart itself) first, then the
+    harmony parts, if any.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: the package directory.
+        """
+        super(Song, self).__init__()
+        self.path = os.path.abspath(path)
+
+        with open(os.path.join(self.path, "manifest.json")) as f:
+            self.manifest = json.load(f)
+        if self.manifest.get("format") != FORMAT_VERSION:
+            raise ValueError(
+                "{}: unsupported song package format {}".format(
+                    self.path, self.manifest.get("format")
+                )
+            )
+
+        self.id = self.manifest["id"]
+        self.title = self.manifest["title"]
+        self.artist = self.manifest["artist"]
+        self.duration = self.manifest["duration"]
+        self.max_score = self.manifest["max_score"]
+        self.pitch_range = tuple(self.manifest["pitch_range"])
+
+        self.notes = np.load(
+            os.path.join(self.path, self.manifest["notes"]), mmap_mode="r"
+        )
+        self.parts = {"lead": self.notes}
+        for name, f in self.manifest.get("parts", {}).items():
+            self.parts[name] = np.load(os.path.join(self.path, f), mmap_mode="r")
+        self.stems = self._paths(self.manifest["stems"])
+        self.artwork = self._paths(self.manifest["artwork"])
+
+    def _paths(self, files):
+        return {name: os.path.join(self.path, f) for name, f in files.items()}
+
+    def __repr__(self):
+        return "Song({!r}, {} notes)".format(self.id, len(self.notes))
+
+
+def package_parts(pkg_dir):
+    """
+    :returns: a dictionary of part name to the path of the part's file, for the harmony parts
+        of the package in *pkg_dir* (empty if there is no package there).
+    """
+    try:
+        with open(os.path.join(pkg_dir, "manifest.json")) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return {
+        name: os.path.join(pkg_dir, f) for name, f in manifest.get("parts", {}).items()
+    }
+
+
+def read_part(filepath, transpose=0):
+    """
+    Reads a harmony part: a notes file in the legacy txt format (see :func:`read_notes_txt`),
+    or the ``part_*.npy`` file of a package, read into memory.
+
+    :param transpose: semitones added to every pitch of a txt file. Package parts are already
+        transposed.
+
+    :returns: a notes array of :data:`NOTE_DTYPE`.
+    """
+    if filepath.endswith(".npy"):
+        return np.load(filepath)
+    return read_notes_txt(filepath, transpose)
+
+
+def load_song(song, lib_dir=None):
+    """
+    :param song: a song id (looked up in *lib_dir*) or the path of a package directory.
+    :param lib_dir: library directory. Defaults to :data:`library_dir`.
+
+    :returns: the loaded :class:`Song`.
+    """
+    if os.path.isdir(song):
+        return Song(song)
+    return Song(os.path.join(lib_dir or library_dir, song))
+
+
+def make_notes(start, duration, pitch, velocity=1.0):
+    """
+    :returns: a notes array of :data:`NOTE_DTYPE`, sorted by start time.
+    """
+    start = np.asarray(start, dtype=float)
+    notes = np.empty(len(start), dtype=NOTE_DTYPE)
+    notes["start"] = start
+    notes["duration"] = duration
+    notes["pitch"] = pitch
+    notes["velocity"] = velocity
+    return notes[np.argsort(notes["start"], kind="stable")]
+
+
+def read_notes_txt(filepath, transpose=0):
+    """
+    Reads a legacy tab-separated notes file (start, Hz, duration, velocity per line).
+
+    :param transpose: semitones added to every pitch.
+
+    :returns: a notes array of :data:`NOTE_DTYPE`.
+    """
+    data = np.loadtxt(filepath, delimiter="\t", ndmin=2)
+    pitch = 69 + 12 * np.log2(data[:, 1] / 440) + transpose
+    velocity = data[:, 3] if data.shape[1] > 3 else 1.0
+    return make_notes(data[:, 0], data[:, 2], pitch, velocity)
+
+
+def note_coverage(notes):
+    """
+    The total time covered by notes, as a function of song time. Overlapping notes count once.
+
+    :returns: breakpoints ``(times, covered)`` of the piecewise linear function, increasing in
+        both arrays, for use with ``np.interp``.
+    """
+    starts = np.asarray(notes["start"], dtype=float)
+    ends = starts + np.asarray(notes["duration"], dtype=float)
+    order = np.argsort(starts, kind="stable")
+    starts, ends = starts[order], ends[order]
+
+    # merge overlapping notes into disjoint intervals
+    ends = np.maximum.accumulate(ends)
+    new_run = np.concatenate(([True], starts[1:] > ends[:-1]))
+    run_starts = starts[new_run]
+    run_ends = np.concatenate((ends[np.flatnonzero(new_run)[1:] - 1], ends[-1:]))
+
+    times = np.column_stack((run_starts, run_ends)).ravel()
+    lengths = run_ends - run_starts
+    covered = np.column_stack((np.cumsum(lengths) - lengths, np.cumsum(lengths))).ravel()
+    return times, covered
+
+
+def chart_max_score(notes, points_per_second=POINTS_PER_SECOND):
+    """
+    :returns: the score for singing every note of the chart perfectly.
+    """
+    if len(notes) == 0:
+        return 0
+    return int(round(note_coverage(notes)[1][-1] * points_per_second))
+
+
+def _install_file(src, dst):
+    # hard link when possible, so that packages don't duplicate large audio files
+    if os.path.exists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+def make_thumbnail(src, dst, size=THUMBNAIL_SIZE):
+    """
+    Writes a copy of the image *src*, scaled down to fit in *size* x *size* pixels (each
+    thumbnail pixel is the mean of the pixels it covers), to the PNG file *dst*.
+    """
+    # kivy's SDL2 image loader reads and writes the PNGs, without opening a window
+    os.environ.setdefault("KIVY_NO_ARGS", "1")
+    from kivy.core.image.img_sdl2 import ImageLoaderSDL2
+
+    image = ImageLoaderSDL2(src, nocache=True)._data[0]
+    width, height = image.size
+    channels = len(image.fmt)
+    pixels = np.frombuffer(image.data, np.uint8).reshape(height, -1)
+    pixels = pixels[:, : width * channels].reshape(height, width, channels)
+    pixels = pixels.astype(np.float64)
+    if channels == 4:
+        # average colors weighted by alpha, so that transparent pixels don't darken edges
+        pixels[..., :3] *= pixels[..., 3:]
+
+    scale = min(1.0, float(size) / max(width, height))
+    thumb_w = max(1, int(round(width * scale)))
+    thumb_h = max(1, int(round(height * scale)))
+    rows = np.linspace(0, height, thumb_h + 1).astype(int)
+    cols = np.linspace(0, width, thumb_w + 1).astype(int)
+    sums = np.add.reduceat(np.add.reduceat(pixels, rows[:-1], axis=0), cols[:-1], axis=1)
+    thumb = sums / (np.diff(rows)[:, None, None] * np.diff(cols)[None, :, None])
+    if channels == 4:
+        alpha = thumb[..., 3:]
+        np.divide(thumb[..., :3], alpha, out=thumb[..., :3], where=alpha > 0)
+
+    thumb = np.clip(np.round(thumb), 0, 255).astype(np.uint8)
+    ImageLoaderSDL2.save(
+        dst, thumb_w, thumb_h, image.fmt, thumb.tobytes(), image.flip_vertical, "png"
+    )
+
+
+def compile_package(
+    out_dir, song_id, title, artist, notes, stems, artwork, extra=None, parts=None
+):
+    """
+    Builds a song package.
+
+    :param out_dir: the package directory to create (or overwrite).
+    :param song_id: short unique name of the song.
+    :param title: song title.
+    :param artist: song artist.
+    :param notes: a notes array (see :func:`make_notes`).
+    :param stems: dictionary of stem role (see :data:`STEM_NAMES`) to wave file path.
+    :param artwork: dictionary of artwork role (see :data:`ARTWORK_NAMES`) to image path.
+    :param extra: optional dictionary of additional manifest values.
+    :param parts: optional dictionary of part name to notes array: harmony parts, sung against
+        the lead (*notes*) by the other singers in duet mode.
+
+    A thumbnail of the record artwork is written too (see :func:`make_thumbnail`).
+
+    :returns: the loaded :class:`Song`.
+    """
+    if len(notes) == 0:
+        raise ValueError("{}: chart has no notes".format(song_id))
+    notes = np.ascontiguousarray(notes, dtype=NOTE_DTYPE)
+    parts = parts or {}
+    for name, part in parts.items():
+        if name == "lead" or len(part) == 0:
+            raise ValueError("{}: invalid part {!r}".format(song_id, name))
+
+    os.makedirs(out_dir, exist_ok=True)
+    np.save(os.path.join(out_dir, "notes.npy"), notes)
+    part_files = {}
+    for name, part in parts.items():
+        part_files[name] = "part_{}.npy".format(name)
+        part = np.ascontiguousarray(part, dtype=NOTE_DTYPE)
+        np.save(os.path.join(out_dir, part_files[name]), part)
+
+    files = {"stems": {}, "artwork": {}}
+    for kind, sources in (("stems", stems), ("artwork", artwork)):
+        for name, src in sources.items():
+            if src is None:
+                continue
+            dst_name = name + os.path.splitext(src)[1]
+            _install_file(src, os.path.join(out_dir, dst_name))
+            files[kind][name] = dst_name
+
+    thumbnail = None
+    if artwork.get("record") is not None:
+        thumbnail = "thumbnail.png"
+        make_thumbnail(artwork["record"], os.path.join(out_dir, thumbnail))
+
+    end_times = notes["start"] + notes["duration"]
+    manifest = {
+        "format": FORMAT_VERSION,
+        "id": song_id,
+        "title": title,
+        "artist": artist,
+        "notes": "notes.npy",
+        "num_notes": len(notes),
+        "duration": float(end_times.max()),
+        "pitch_range": [float(notes["pitch"].min()), float(notes["pitch"].max())],
+        "max_score": chart_max_score(notes),
+        "stems": files["stems"],
+        "artwork": files["artwork"],
+        "thumbnail": thumbnail,
+    }
+    if part_files:
+        manifest["parts"] = part_files
+    if extra:
+        manifest.update(extra)
+    with open(os.path.join(out_dir, "manifest.json"), "w") as f:
+        json.dump(manifest, f, indent=2)
+
+    return Song(out_dir)
+
+
+def legacy_sources(song_id, src_dir=None):
+    """
+    :returns: ``(stems, artwork)`` paths of a song stored as loose files in *src_dir*, using
+        the repo's naming conventions. Missing stems are left out.
+    """
+    src_dir = src_dir or root_dir
+
+    def path(name):
+        return os.path.join(src_dir, name)
+
+    stems = {"mix": path(song_id + ".wav"), "music": path(song_id + "_music.wav")}
+    stems = {name: p for name, p in stems.items() if os.path.exists(p)}
+    artwork = {
+        "background": path("bg_{}.png".format(song_id)),
+        "record": path("vinyl_{}.png".format(song_id)),
+        "gold": path("vinyl_{}_gold.png".format(song_id)),
+        "platinum": path("vinyl_{}_platinum.png".format(song_id)),
+    }
+    return stems, artwork
+
+
+def compile_legacy_song(song_id, lib_dir=None, src_dir=None, parts=None):
+    """
+    Builds the package of one of the :data:`LEGACY_SONGS` from the loose files in *src_dir*.
+
+    :param parts: optional dictionary of part name to the notes file of a harmony part, in the
+        format of the song's own notes file (and transposed like it). The parts of an existing
+        package are kept, unless replaced by one of these.
+
+    :returns: the loaded :class:`Song`.
+    """
+    info = LEGACY_SONGS[song_id]
+    src_dir = src_dir or root_dir
+    out_dir = os.path.join(lib_dir or library_dir, song_id)
+    notes = read_notes_txt(os.path.join(src_dir, info["notes"]), info["transpose"])
+    part_files = package_parts(out_dir)
+    part_files.update(
+        (name, os.path.join(src_dir, f)) for name, f in (parts or {}).items()
+    )
+    parts = {
+        name: read_part(path, info["transpose"]) for name, path in part_files.items()
+    }
+    stems, artwork = legacy_sources(song_id, src_dir)
+    for name in STEM_NAMES:
+        if name not in stems:
+            print("warning: {}: no {} stem found".format(song_id, name))
+
+    return compile_package(
+        out_dir,
+        song_id,
+        info["title"],
+        info["artist"],
+        notes,
+        stems,
+        artwork,
+        parts=parts,
+    )